@@ -0,0 +1,285 @@
+import re
+import math
+import time
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# 不影响问题含义的语气词和客套话，归一化时去掉
+FILLER_WORDS: Tuple[str, ...] = ("请问", "帮我", "查一下", "查询一下", "看一下", "告诉我", "一下", "呢", "吗", "吧", "啊", "呀")
+# 意图关键词，按顺序匹配，同一个问题可能有多个意图
+INTENT_KEYWORDS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("ring", ("环", "循环", "互相")),
+    ("receivables", ("应收", "收款", "欠它", "欠他")),
+    ("debt", ("欠", "债务", "应付", "付款")),
+    ("parent", ("母公司", "父公司", "集团", "上级")),
+    ("child", ("子公司", "下属", "下级")),
+)
+# 疑问词和不区分问题的虚词、泛称，比较修饰语时去掉，例如"欠了谁多少钱"和"欠哪些公司钱"的修饰语都为空
+QUESTION_WORDS: Tuple[str, ...] = ("哪几家", "哪些", "哪个", "哪家", "哪里", "什么", "多少", "谁", "是", "的", "了", "有",
+                                   "公司", "企业", "钱", "和", "与")
+# 标点和空白，数字之间的小数点保留，例如"1.5亿"
+_PUNCTUATION = re.compile(r"(?:(?!(?<=\d)\.(?=\d))[\s\W_])+", re.UNICODE)
+# 问题中的数量：阿拉伯数字或中文数字，以及紧跟的单位，例如"3个"、"两层"、"2023年"、"1.5亿"
+_NUMBER = re.compile(r"(\d+(?:\.\d+)?|[零〇一二两三四五六七八九十百千万亿]+)([万亿]*[个层级跳度年月日天家条笔项名元%]?)")
+_CHINESE_DIGITS: Dict[str, int] = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6,
+                                   "七": 7, "八": 8, "九": 9}
+_CHINESE_UNITS: Dict[str, int] = {"十": 10, "百": 100, "千": 1000}
+_CHINESE_SECTIONS: Dict[str, int] = {"万": 10 ** 4, "亿": 10 ** 8}
+
+
+def chinese_number(text: str) -> int:
+    """
+    # 中文数字转为整数，例如"三十五"为35、"一亿五千万"为150000000，没有单位的"二零二三"按位读为2023
+    """
+    if not any(char in _CHINESE_UNITS or char in _CHINESE_SECTIONS for char in text):
+        return int("".join(str(_CHINESE_DIGITS[char]) for char in text))
+    total, section, number = 0, 0, 0
+    for char in text:
+        if char in _CHINESE_DIGITS:
+            number = _CHINESE_DIGITS[char]
+        elif char in _CHINESE_UNITS:
+            section += (number or 1) * _CHINESE_UNITS[char]
+            number = 0
+        else:
+            total += (section + number or 1) * _CHINESE_SECTIONS[char]
+            section, number = 0, 0
+    return total + section + number
+
+
+class AnswerCache:
+    """
+    AnswerCache是DebtLLM.process_control前面的语义答案缓存，同一个问题的不同说法(例如"山东高速欠了谁多少钱"
+    和"请问山东高速欠谁钱")直接返回缓存的答案，不再经过大模型和图查询。
+    问题先归一化(全角转半角、小写、去掉标点和语气词)，提取出现的实体名称(按出现顺序)和句式骨架
+    (实体和意图关键词出现的先后顺序，区分"A欠谁"和"谁欠A")以及数量(跳数、条数、年份、金额，中文数字转为阿拉伯数字)，
+    "3个公司组成的环"不会命中"4个公司组成的环"的答案。
+    实体、骨架和数量完全相同的缓存条目中，再比较去掉实体、意图关键词、数量和疑问词(见 :data:`QUESTION_WORDS`)
+    之后剩下的修饰语，字符n-gram的余弦相似度不低于threshold时命中，两边都没有修饰语时相似度为1，
+    "山东高速欠谁钱最多"不会命中"山东高速欠谁钱"的答案。
+    没有识别出实体的问题(例如依赖上下文的追问)不缓存
+    """
+
+    def __init__(self, entities: Iterable[str] = (), threshold: float = 0.8, max_size: int = 2000,
+                 ttl: float = 600, ngram: int = 2, loader: Callable[[], Iterable[str]] = None):
+        """
+        :param entities: 实体名称，例如全部Level1和Level2节点的name
+        :param loader: 读取实体名称的函数，设置时在第一次使用缓存时才调用，代替entities，例如从neo4j读取
+        :param threshold: 命中需要的修饰语的最低相似度
+        :param max_size: 最多缓存的条数，超出后淘汰最久未使用的条目
+        :param ttl: 缓存的有效时间(秒)
+        :param ngram: 字符n-gram的n
+        """
+        self.threshold: float = threshold
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.ngram: int = ngram
+        # 首字 -> 以该字开头的实体名称，按长度从长到短
+        self._entities: Dict[str, List[str]] = {}
+        # 条目id -> (过期时间, (实体, 句式骨架, 数量), 修饰语的n-gram向量, 向量的模, 输出, 输出类型, 归一化后的问题)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # (实体, 句式骨架, 数量) -> 条目id
+        self._index: Dict[tuple, set] = {}
+        # 归一化后的问题 -> 条目id，同一个问题再次写入时替换原来的条目
+        self._texts: Dict[str, int] = {}
+        self._next_id: int = 0
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.loader: Callable[[], Iterable[str]] = loader
+        self._loaded: bool = False
+        self._load_lock = threading.Lock()
+        if loader is None:
+            self.set_entities(entities)
+
+    def set_entities(self, entities: Iterable[str]):
+        """
+        # 设置实体名称词表，实体名称同样会被归一化
+        :param entities: 实体名称
+        """
+        index: Dict[str, List[str]] = {}
+        for name in set(self.normalize(name) for name in entities if name):
+            if name:
+                index.setdefault(name[0], []).append(name)
+        for names in index.values():
+            names.sort(key=len, reverse=True)
+        self._entities = index
+        self._loaded = True
+
+    def _ensure_entities(self):
+        """
+        # 第一次使用时通过loader读取实体名称，读取失败时下次使用再重试
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.set_entities(self.loader())
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        # 全角转半角、小写、去掉标点空白和语气词
+        """
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        for word in FILLER_WORDS:
+            text = text.replace(word, "")
+        return _PUNCTUATION.sub("", text)
+
+    def _extract(self, text: str) -> Tuple[Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]], str]:
+        """
+        # 从归一化后的问题中按最长匹配提取实体(按出现顺序)，
+        # 实体(记为"E")和意图关键词按出现位置排列的句式骨架，例如"A欠谁"为("E", "debt")，
+        # 以及实体之外按出现顺序的数量，例如"3个"、"2023年"
+        :return: ((实体, 句式骨架, 数量), 去掉实体、意图关键词、数量和疑问词后剩下的修饰语)
+        """
+        self._ensure_entities()
+        entities: List[str] = []
+        rest: List[str] = []
+        i = 0
+        while i < len(text):
+            for name in self._entities.get(text[i], ()):
+                if text.startswith(name, i):
+                    entities.append(name)
+                    rest.append("\0")
+                    i += len(name)
+                    break
+            else:
+                rest.append(text[i])
+                i += 1
+        rest_text = "".join(rest)
+        marks: List[Tuple[int, str]] = [(i, "E") for i, char in enumerate(rest_text) if char == "\0"]
+        for intent, words in INTENT_KEYWORDS:
+            for word in words:
+                marks += [(m.start(), intent) for m in re.finditer(re.escape(word), rest_text)]
+        skeleton: List[str] = []
+        taken: set = set()
+        for pos, label in sorted(marks, key=lambda mark: mark[0]):
+            # 同一位置只取第一个匹配的意图，例如"应收"中的"收"不再算作其它意图
+            if pos in taken:
+                continue
+            taken.add(pos)
+            if not skeleton or skeleton[-1] != label:
+                skeleton.append(label)
+        numbers: List[str] = []
+        for m in _NUMBER.finditer(rest_text):
+            value = m.group(1)
+            if not value[0].isdigit():
+                value = str(chinese_number(value))
+            numbers.append(value + m.group(2))
+        modifier = _NUMBER.sub("", rest_text.replace("\0", ""))
+        for word in sorted((word for _, words in INTENT_KEYWORDS for word in words), key=len, reverse=True):
+            modifier = modifier.replace(word, "")
+        for word in QUESTION_WORDS:
+            modifier = modifier.replace(word, "")
+        return (tuple(entities), tuple(skeleton), tuple(numbers)), modifier
+
+    def _vector(self, text: str) -> Tuple[Counter, float]:
+        if not text:
+            return Counter(), 0
+        grams = Counter(text[i:i + self.ngram] for i in range(max(len(text) - self.ngram + 1, 1)))
+        return grams, math.sqrt(sum(v * v for v in grams.values()))
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        if self._texts.get(entry[6]) == entry_id:
+            del self._texts[entry[6]]
+        ids = self._index.get(entry[1])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._index[entry[1]]
+
+    def question_key(self, text: str) -> str:
+        """
+        # 不依赖对话上下文的问题(识别出了实体)返回归一化后的问题，否则返回None
+        :param text: 用户的问题
+        """
+        normalized = self.normalize(text)
+        return normalized if self._extract(normalized)[0][0] else None
+
+    def get(self, text: str) -> Tuple[bool, object, str]:
+        """
+        # 查询缓存
+        :param text: 用户的问题
+        :return: (是否命中, 输出, 输出类型)
+        """
+        normalized = self.normalize(text)
+        signature, modifier = self._extract(normalized)
+        if not signature[0]:
+            with self._lock:
+                self.misses += 1
+            return False, None, None
+        vector, norm = self._vector(modifier)
+        now = time.monotonic()
+        with self._lock:
+            best, best_score = None, self.threshold
+            for entry_id in list(self._index.get(signature, ())):
+                entry = self._entries[entry_id]
+                if entry[0] <= now:
+                    self._remove(entry_id)
+                    self.evictions += 1
+                    continue
+                if not norm or not entry[3]:
+                    score = 1 if not norm and not entry[3] else 0
+                else:
+                    score = sum(count * entry[2].get(gram, 0) for gram, count in vector.items()) / (norm * entry[3])
+                if score >= best_score:
+                    best, best_score = entry_id, score
+            if best is None:
+                self.misses += 1
+                return False, None, None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            entry = self._entries[best]
+            return True, entry[4], entry[5]
+
+    def put(self, text: str, output, output_type: str):
+        """
+        # 写入缓存，没有识别出实体的问题不缓存，同一个问题(归一化后相同)替换原来的条目
+        :param text: 用户的问题
+        :param output: process_control的输出
+        :param output_type: 输出类型
+        """
+        normalized = self.normalize(text)
+        signature, modifier = self._extract(normalized)
+        if not signature[0]:
+            return
+        vector, norm = self._vector(modifier)
+        with self._lock:
+            if normalized in self._texts:
+                self._remove(self._texts[normalized])
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (time.monotonic() + self.ttl, signature, vector, norm, output, output_type,
+                                       normalized)
+            self._index.setdefault(signature, set()).add(entry_id)
+            self._texts[normalized] = entry_id
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        """
+        # 清空全部缓存，债务图变化后调用，通过 :func:`add_invalidation_hook`注册后随Neo4jDao.invalidate_cache调用
+        """
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._texts.clear()
+
+    def stats(self) -> dict:
+        """
+        # 命中、未命中、淘汰次数、命中率和当前大小
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0,
+                "size": len(self._entries),
+            }
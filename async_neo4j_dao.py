@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Iterator, Tuple
+from neo4j_dao import Neo4jDao
+
+
+class AsyncNeo4jDao:
+    """
+    AsyncNeo4jDao是 :class:`Neo4jDao`的asyncio版本，Neo4jDao的每个查询方法(get_*)和select在这里都是同名的协程，
+    参数、分页和返回的数据与Neo4jDao完全相同。py2neo的查询是阻塞的，这里在线程池中执行，
+    事件循环只负责等待，因此一个问题的多个查询可以通过asyncio.gather并发执行，空闲的会话不占用线程。
+    线程数默认与Neo4jDao的连接池大小相同，详细见 :class:`Neo4jPool`
+    """
+
+    def __init__(self, dao: Neo4jDao = None, executor: ThreadPoolExecutor = None, chunk_size: int = 256):
+        """
+        :param dao: 执行查询的Neo4jDao，为None时新建
+        :param executor: 执行阻塞查询的线程池，为None时按连接池大小新建
+        :param chunk_size: 流模式下每次从线程池取回的记录数
+        """
+        self.dao: Neo4jDao = dao if dao is not None else Neo4jDao()
+        if executor is None:
+            workers = self.dao.pool.size if self.dao.pool is not None else 8
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="neo4j_dao")
+        self.executor: ThreadPoolExecutor = executor
+        self.chunk_size: int = chunk_size
+
+    async def _call(self, func, *args, **kwargs):
+        """
+        # 在线程池中执行阻塞的函数，并带上当前协程的contextvars(例如 :func:`streaming`)
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+
+    async def _aiter(self, iterator: Iterator) -> AsyncIterator:
+        """
+        # 将阻塞的生成器(例如 :class:`Neo4jDao.iter_ndjson`)转换为异步生成器，每次在线程池中取回chunk_size条。
+        # 提前结束(break、aclose或任务取消)时在线程池中关闭生成器，归还它占用的连接池连接
+        """
+        def take():
+            chunk = []
+            for item in iterator:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    break
+            return chunk
+
+        def finish(pending: Future):
+            # 等待还在执行的take结束，正在执行的生成器不能关闭
+            if pending is not None:
+                wait([pending])
+            close()
+
+        pending: Future = None
+        try:
+            while True:
+                pending = self.executor.submit(contextvars.copy_context().run, take)
+                chunk = await asyncio.wrap_future(pending)
+                if not chunk:
+                    return
+                for item in chunk:
+                    yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                loop = asyncio.get_running_loop()
+                # 任务被取消时关闭仍然在线程池中完成
+                await asyncio.shield(loop.run_in_executor(self.executor, finish, pending))
+
+    async def _result(self, func, *args, **kwargs) -> Tuple:
+        count, data = await self._call(func, *args, **kwargs)
+        if isinstance(data, Iterator):
+            data = self._aiter(data)
+        return count, data
+
+    async def select(self, cql: str, *args, **kwargs) -> Tuple:
+        """
+        # 详细见 :class:`Neo4jDao.select`，流模式下返回的数据为异步生成器
+        """
+        return await self._result(self.dao.select, cql, *args, **kwargs)
+
+    def close(self):
+        """
+        # 关闭线程池
+        """
+        self.executor.shutdown(wait=False)
+
+
+def _mirror(name: str):
+    """
+    # 生成与Neo4jDao同名查询方法对应的协程
+    """
+    method = getattr(Neo4jDao, name)
+
+    @functools.wraps(method)
+    async def coroutine(self: AsyncNeo4jDao, *args, **kwargs):
+        return await self._result(getattr(self.dao, name), *args, **kwargs)
+
+    return coroutine
+
+
+for _name in dir(Neo4jDao):
+    if _name.startswith("get_"):
+        setattr(AsyncNeo4jDao, _name, _mirror(_name))
@@ -0,0 +1,217 @@
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List
+
+# 当前上下文中请求的取消令牌，由 :func:`cancel_scope`设置，大模型、Neo4jDao和LLMBatcher在执行中检查
+current_cancel: ContextVar["CancelToken"] = ContextVar("cancel_token", default=None)
+
+
+class Cancelled(Exception):
+    """
+    请求已经被取消，执行中的大模型生成和图查询在检查点抛出
+    """
+
+
+class CancelToken:
+    """
+    一次请求的取消令牌。cancel之后 :func:`check_cancelled`抛出 :class:`Cancelled`，
+    通过on_cancel注册的回调(例如取消排队中的推理、终止正在执行的neo4j查询)立即执行
+    """
+
+    def __init__(self, session_id: str, request_id: str = None):
+        """
+        :param session_id: 会话id
+        :param request_id: 请求id，为None时生成一个
+        """
+        self.session_id: str = session_id
+        self.request_id: str = request_id or str(uuid.uuid4())
+        self.reason: str = None
+        self.started: float = time.perf_counter()
+        self.cancelled_at: float = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """
+        # 取消请求并执行注册的回调
+        :return: 是否是第一次取消
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(e)
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        # 注册取消时的回调，已经取消时立即执行
+        :return: 注销该回调的函数，回调对应的工作结束后调用
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """
+        # 已经取消时抛出 :class:`Cancelled`
+        """
+        if self._event.is_set():
+            raise Cancelled(f"request {self.request_id} {self.reason}")
+
+
+def check_cancelled():
+    """
+    # 检查点：当前上下文的请求已经取消时抛出 :class:`Cancelled`，没有取消令牌时什么也不做
+    """
+    token = current_cancel.get()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def cancel_scope(token: "CancelToken"):
+    """
+    # 在上下文中设置当前请求的取消令牌，TokenStream等后台线程通过contextvars继承
+    """
+    reset = current_cancel.set(token)
+    try:
+        yield token
+    finally:
+        current_cancel.reset(reset)
+
+
+class CancelRegistry:
+    """
+    CancelRegistry按会话记录正在执行的请求，同一个会话的新请求到达时取消上一个请求(用户打断)，
+    也可以通过 :class:`CancelRegistry.cancel`按会话或请求id取消。
+    统计被取消的请求从开始到真正停止的耗时(浪费的计算)，以及取消之后继续执行的耗时，用于对比取消的效果。
+    与 :class:`Neo4jPool`相同，通过 :class:`CancelRegistry.install`初始化
+    """
+
+    _registry: "CancelRegistry" = None
+
+    def __init__(self):
+        self._active: Dict[str, List[CancelToken]] = {}
+        self._lock = threading.Lock()
+        self.requests: int = 0
+        self.completed: int = 0
+        self.cancelled: int = 0
+        # 被取消的请求从开始到停止的总耗时
+        self.wasted_seconds: float = 0
+        # 被取消的请求在取消之后继续执行的总耗时
+        self.overrun_seconds: float = 0
+        self.overrun_max: float = 0
+
+    @classmethod
+    def install(cls, registry: "CancelRegistry"):
+        """
+        # 设置全局的CancelRegistry
+        """
+        cls._registry = registry
+
+    @classmethod
+    def get_registry(cls) -> "CancelRegistry":
+        """
+        # 获取全局的CancelRegistry，没有初始化时返回None
+        """
+        return cls._registry
+
+    def begin(self, session_id: str, request_id: str = None, supersede: bool = True) -> CancelToken:
+        """
+        # 开始一个请求
+        :param session_id: 会话id
+        :param request_id: 请求id，为None时生成一个
+        :param supersede: 是否取消同一个会话中还在执行的请求
+        :return: 请求的取消令牌，请求结束后调用 :class:`CancelRegistry.finish`
+        """
+        token = CancelToken(session_id, request_id)
+        with self._lock:
+            self.requests += 1
+            previous = self._active.get(session_id, []) if supersede else []
+            self._active.setdefault(session_id, []).append(token)
+        for old in list(previous):
+            if old is not token:
+                old.cancel("superseded")
+        return token
+
+    def cancel(self, session_id: str, request_id: str = None, reason: str = "cancelled") -> int:
+        """
+        # 取消会话中正在执行的请求
+        :param session_id: 会话id
+        :param request_id: 只取消该请求，为None时取消会话中的全部请求
+        :return: 取消的请求数
+        """
+        with self._lock:
+            tokens = [token for token in self._active.get(session_id, [])
+                      if request_id is None or token.request_id == request_id]
+        return sum(token.cancel(reason) for token in tokens)
+
+    def finish(self, token: CancelToken):
+        """
+        # 请求结束(完成、失败或取消后停止)
+        """
+        now = time.perf_counter()
+        with self._lock:
+            tokens = self._active.get(token.session_id, [])
+            if token in tokens:
+                tokens.remove(token)
+            if not tokens:
+                self._active.pop(token.session_id, None)
+            if token.cancelled:
+                self.cancelled += 1
+                self.wasted_seconds += now - token.started
+                self.overrun_seconds += now - token.cancelled_at
+                self.overrun_max = max(self.overrun_max, now - token.cancelled_at)
+            else:
+                self.completed += 1
+
+    @contextmanager
+    def request(self, session_id: str, request_id: str = None):
+        """
+        # 在with语句中执行一个请求：开始时取消同一个会话的上一个请求，并设置当前上下文的取消令牌
+        """
+        token = self.begin(session_id, request_id)
+        try:
+            with cancel_scope(token):
+                yield token
+        finally:
+            self.finish(token)
+
+    def stats(self) -> dict:
+        """
+        # 请求数、完成数、取消数、正在执行的请求数，被取消的请求浪费的总耗时、取消后继续执行的平均和最大耗时(秒)
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "active": sum(len(tokens) for tokens in self._active.values()),
+                "wasted_seconds": self.wasted_seconds,
+                "overrun_avg": self.overrun_seconds / self.cancelled if self.cancelled else 0,
+                "overrun_max": self.overrun_max,
+            }
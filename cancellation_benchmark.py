@@ -0,0 +1,111 @@
+"""
+用户打断(barge-in)负载下的取消测试：每个会话提出一个问题，回答还没有结束时又提出下一个问题，
+模拟的process_control先执行几次图查询再逐个生成token。对比不检查取消(原来的行为，被打断的回答一直执行到结束)
+和检查取消时，被打断的请求浪费的计算、取消后继续执行的耗时，以及新问题的响应时间
+使用方式 python cancellation_benchmark.py --sessions 8 --questions 5
+"""
+import time
+import random
+import argparse
+import threading
+from typing import Dict, Iterator, List
+from cancellation import Cancelled, CancelRegistry, cancel_scope, check_cancelled
+from llm_stream import stream_tokens
+
+
+def generate(tokens: int, token_time: float) -> Iterator[str]:
+    for i in range(tokens):
+        time.sleep(token_time)
+        yield f"t{i}"
+
+
+def process_control(queries: int, query_time: float, tokens: int, token_time: float) -> str:
+    """
+    # 模拟的问答：queries次图查询(每次查询前检查取消，与Neo4jDao的查询方法相同)，再流式生成tokens个token
+    """
+    for _ in range(queries):
+        check_cancelled()
+        time.sleep(query_time)
+    return stream_tokens(generate(tokens, token_time))
+
+
+def run(args, cancellable: bool) -> dict:
+    registry = CancelRegistry()
+    locks: Dict[str, threading.Lock] = {}
+    latencies: List[float] = []
+    # 实际执行process_control的耗时，以及其中属于被取消的请求的部分
+    busy = [0.0, 0.0]
+    stats_lock = threading.Lock()
+    full = args.queries * args.query_time + args.tokens * args.token_time
+
+    def handle(session_id: str):
+        token = registry.begin(session_id)
+        start = time.perf_counter()
+        try:
+            # 与SessionStore相同，同一个会话的请求串行执行
+            with locks[session_id]:
+                begin = time.perf_counter()
+                try:
+                    if cancellable:
+                        with cancel_scope(token):
+                            process_control(args.queries, args.query_time, args.tokens, args.token_time)
+                    else:
+                        process_control(args.queries, args.query_time, args.tokens, args.token_time)
+                finally:
+                    elapsed = time.perf_counter() - begin
+                    with stats_lock:
+                        busy[0] += elapsed
+                        if token.cancelled:
+                            busy[1] += elapsed
+        except Cancelled:
+            pass
+        finally:
+            registry.finish(token)
+        if not token.cancelled:
+            with stats_lock:
+                latencies.append(time.perf_counter() - start)
+
+    def session(index: int):
+        rng = random.Random(index)
+        session_id = f"s{index}"
+        locks[session_id] = threading.Lock()
+        threads: List[threading.Thread] = []
+        for question in range(args.questions):
+            thread = threading.Thread(target=handle, args=(session_id,))
+            thread.start()
+            threads.append(thread)
+            if question < args.questions - 1:
+                # 回答进行到一部分时用户提出下一个问题
+                time.sleep(rng.uniform(0.2, 0.6) * full)
+        for thread in threads:
+            thread.join()
+
+    start = time.perf_counter()
+    sessions = [threading.Thread(target=session, args=(i,)) for i in range(args.sessions)]
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    stats = registry.stats()
+    stats.update(wall=time.perf_counter() - start, busy=busy[0], wasted_compute=busy[1],
+                 latency_avg=sum(latencies) / len(latencies) if latencies else 0,
+                 latency_max=max(latencies) if latencies else 0)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=5, help="每个会话的问题数，除最后一个外都会被打断")
+    parser.add_argument("--queries", type=int, default=4, help="每个回答的图查询次数")
+    parser.add_argument("--query-time", type=float, default=0.1, help="每次图查询的耗时(秒)")
+    parser.add_argument("--tokens", type=int, default=60, help="每个回答生成的token数")
+    parser.add_argument("--token-time", type=float, default=0.02, help="每个token的生成耗时(秒)")
+    args = parser.parse_args()
+
+    for name, cancellable in (("before", False), ("after", True)):
+        stats = run(args, cancellable)
+        print(f"{name:>6}: requests={stats['requests']} cancelled={stats['cancelled']} wall={stats['wall']:.2f}s "
+              f"busy={stats['busy']:.2f}s wasted_compute={stats['wasted_compute']:.2f}s "
+              f"overrun_avg={stats['overrun_avg'] * 1000:.0f}ms overrun_max={stats['overrun_max'] * 1000:.0f}ms "
+              f"answer_latency_avg={stats['latency_avg']:.2f}s answer_latency_max={stats['latency_max']:.2f}s")
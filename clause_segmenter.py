@@ -0,0 +1,64 @@
+import re
+from typing import List
+
+
+class ClauseSegmenter:
+    """
+    ClauseSegmenter把流式返回的回答切成交给语音合成的分句：每次feed只扫描新收到的文本，
+    遇到标点且分句不短于min_len时切出一句，过短的分句与下一句合并，减少语音合成的调用次数；
+    没有标点的分句超过max_len时强制切开(结尾的标点可以超出一个字)，避免第一句的语音等待太久。
+    拼接全部分句与flush的结果等于输入的全部文本，不会丢失或重复文字
+    """
+
+    def __init__(self, punctuation: str = "，。！？?!,", min_len: int = 4, max_len: int = 60):
+        """
+        :param punctuation: 可以作为分句结尾的标点
+        :param min_len: 分句的最短长度(含标点)，短于该长度时继续与下一句合并
+        :param max_len: 分句的最大长度，没有标点时在该长度处切开
+        """
+        self.pattern = re.compile(f"[{re.escape(punctuation)}]")
+        self.min_len: int = min_len
+        self.max_len: int = max_len
+        self._pieces: List[str] = []
+        self._length: int = 0
+
+    def feed(self, text: str) -> List[str]:
+        """
+        # 送入新收到的一段文本
+        :return: 这段文本完成的分句，可能为空
+        """
+        clauses: List[str] = []
+        start = 0
+        for match in self.pattern.finditer(text):
+            self._append(text[start:match.start()], clauses)
+            # 标点总是留在分句的结尾，不会因为max_len被单独切成一句
+            self._pieces.append(match.group())
+            self._length += 1
+            start = match.end()
+            if self._length >= self.min_len:
+                clauses.append(self._take())
+        self._append(text[start:], clauses)
+        return clauses
+
+    def _append(self, piece: str, clauses: List[str]):
+        while self._length + len(piece) > self.max_len:
+            room = self.max_len - self._length
+            self._pieces.append(piece[:room])
+            self._length += room
+            clauses.append(self._take())
+            piece = piece[room:]
+        if piece:
+            self._pieces.append(piece)
+            self._length += len(piece)
+
+    def _take(self) -> str:
+        clause = "".join(self._pieces)
+        self._pieces, self._length = [], 0
+        return clause
+
+    def flush(self) -> str:
+        """
+        # 回答结束，取出剩余的文本
+        :return: 剩余的文本，没有时为空字符串
+        """
+        return self._take()
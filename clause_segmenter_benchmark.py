@@ -0,0 +1,84 @@
+"""
+服务器启动.py中流式回答分句的吞吐量测试：原来每收到一块文本都对整个缓冲区做re.findall、re.split和str.replace，
+与 :class:`ClauseSegmenter`只扫描新文本对比，同时检查分句拼接后是否与原文相同
+使用方式 python clause_segmenter_benchmark.py --lengths 1000 10000 100000 --chunk 20
+"""
+import re
+import time
+import random
+import argparse
+from typing import Callable, List
+from clause_segmenter import ClauseSegmenter
+
+
+def legacy_segment(chunks: List[str]) -> List[str]:
+    """
+    # 原来generator_result中的分句方式
+    """
+    clauses: List[str] = []
+    read_sentence = ""
+    pattern = r"[，。！？?!,]"
+    for chunk in chunks:
+        read_sentence += chunk
+        if len(re.findall(pattern, read_sentence)) >= 1:
+            remain_sentence = re.split(pattern, read_sentence)[-1]
+            read_sentence = read_sentence.replace(remain_sentence, "")
+            clauses.append(read_sentence)
+            read_sentence = remain_sentence
+    if read_sentence:
+        clauses.append(read_sentence)
+    return clauses
+
+
+def segmenter_segment(chunks: List[str], min_len: int = 4, max_len: int = 60) -> List[str]:
+    segmenter = ClauseSegmenter(min_len=min_len, max_len=max_len)
+    clauses: List[str] = []
+    for chunk in chunks:
+        clauses.extend(segmenter.feed(chunk))
+    remain = segmenter.flush()
+    if remain:
+        clauses.append(remain)
+    return clauses
+
+
+def make_answer(length: int, max_words: int = 6, seed: int = 0) -> str:
+    """
+    # 生成类似债券问答的回答：长短不一的分句，其中有重复出现的短语(会触发原来replace丢字的问题)
+    :param max_words: 每个分句最多的词数，很大时相当于没有标点的长回答(例如列表、代码)
+    """
+    rng = random.Random(seed)
+    words = ["山东高速", "欠款", "债券", "发行人", "担保", "到期", "金额", "亿元", "公司", "子公司"]
+    parts: List[str] = []
+    size = 0
+    while size < length:
+        part = "".join(rng.choice(words) for _ in range(rng.randint(1, max_words))) + rng.choice("，。！？,")
+        parts.append(part)
+        size += len(part)
+    return "".join(parts)[:length]
+
+
+def run(segment: Callable[[List[str]], List[str]], chunks: List[str], repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        clauses = segment(chunks)
+    return (time.perf_counter() - start) / repeat, clauses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunk", type=int, default=20, help="每个token事件的字数")
+    parser.add_argument("--max-words", type=int, nargs="+", default=[6, 2000],
+                        help="每个分句最多的词数，2000相当于几千字才有一个标点")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for max_words, length in ((m, n) for m in args.max_words for n in args.lengths):
+        answer = make_answer(length, max_words)
+        chunks = [answer[i:i + args.chunk] for i in range(0, len(answer), args.chunk)]
+        for name, segment in (("legacy", legacy_segment), ("segmenter", segmenter_segment)):
+            seconds, clauses = run(segment, chunks, args.repeat)
+            lost = len(answer) - len("".join(clauses))
+            print(f"{name:>9} max_words={max_words:>5} length={length:>7} time={seconds * 1000:9.2f}ms "
+                  f"throughput={length / seconds / 1e6:7.2f}M chars/s clauses={len(clauses):>6} "
+                  f"lost_chars={lost} lossless={''.join(clauses) == answer}")
@@ -0,0 +1,222 @@
+import json
+from array import array
+from collections import deque
+from typing import Dict, Iterator, List, Tuple
+from py2neo import Graph
+from neo4j_page import page_offset, resolve_after
+
+
+class DebtGraph:
+    """
+    DebtGraph是债务图在进程内的快照，将Level2之间的HAS_DEBT边以CSR(压缩稀疏行)的形式保存在整数数组中，
+    节点使用0..n-1的整数编号，用于代替 :class:`Neo4jDao`中基于变长路径的环查询。
+
+    环查询的语义与Cypher的 ``MATCH path=(child)-[*{jump}]->(child) WHERE SIZE(apoc.coll.toSet(nodes(path))) = $jump``
+    相同，即经过child、恰好有jump条边的简单环。搜索时先从起点沿反向边做深度不超过jump-1的BFS，
+    得到每个节点回到起点的最短距离，正向DFS时剪掉不可能在剩余步数内回到起点的节点，
+    因此只会展开能够成环的部分，而不是枚举全部长度为jump的路径。
+    返回的数据与 :class:`Neo4jDao`相同：({'total': num}的列表, json字符串)
+    """
+
+    def __init__(self, children: List[dict], parents: List[dict], debts: List[Tuple[int, int, dict]],
+                 memberships: List[Tuple[int, int, dict]]):
+        """
+        :param children: Level2节点的属性，下标即节点编号
+        :param parents: Level1节点的属性，下标即节点编号
+        :param debts: HAS_DEBT边(欠款子节点编号, 收款子节点编号, 边的属性)
+        :param memberships: HAS_PARENT边(子节点编号, 父节点编号, 边的属性)
+        """
+        self.children: List[dict] = [{"Node": props} for props in children]
+        self.parents: List[dict] = [{"Node": props} for props in parents]
+        self.debts: List[dict] = [{"HAS_DEBT": props} for _, _, props in debts]
+        src = [u for u, _, _ in debts]
+        dst = [v for _, v, _ in debts]
+        self.indptr, self.indices, self.edge_ids = self._csr(len(children), src, dst)
+        self.rindptr, self.rindices, _ = self._csr(len(children), dst, src)
+        self.child_index: Dict[str, List[int]] = self._name_index(children)
+        self.parent_index: Dict[str, List[int]] = self._name_index(parents)
+        # 父节点编号 -> [(子节点编号, HAS_PARENT边)]
+        self.members: Dict[int, List[Tuple[int, dict]]] = {}
+        for child, parent, props in memberships:
+            self.members.setdefault(parent, []).append((child, {"HAS_PARENT": props}))
+
+    @staticmethod
+    def _csr(num: int, src: List[int], dst: List[int]) -> Tuple[array, array, array]:
+        """
+        # 将边列表转换为CSR，indices[indptr[u]:indptr[u+1]]为u的出边终点，edge_ids为对应的边编号
+        """
+        indptr = array("l", [0]) * (num + 1)
+        for u in src:
+            indptr[u + 1] += 1
+        for i in range(num):
+            indptr[i + 1] += indptr[i]
+        pos = array("l", indptr[:num])
+        indices = array("l", [0]) * len(src)
+        edge_ids = array("l", [0]) * len(src)
+        for edge_id, (u, v) in enumerate(zip(src, dst)):
+            indices[pos[u]] = v
+            edge_ids[pos[u]] = edge_id
+            pos[u] += 1
+        return indptr, indices, edge_ids
+
+    @staticmethod
+    def _name_index(nodes: List[dict]) -> Dict[str, List[int]]:
+        index: Dict[str, List[int]] = {}
+        for i, props in enumerate(nodes):
+            index.setdefault(props.get("name"), []).append(i)
+        return index
+
+    @classmethod
+    def load(cls, graph: Graph) -> "DebtGraph":
+        """
+        # 从neo4j批量导入HAS_DEBT和HAS_PARENT构成的债务图
+        :param graph: neo4j的连接
+        :return: 债务图快照
+        """
+        children: List[dict] = []
+        child_ids: Dict[int, int] = {}
+        for record in graph.run("MATCH (n:Level2) RETURN id(n) AS id, properties(n) AS props"):
+            child_ids[record["id"]] = len(children)
+            children.append(record["props"])
+        parents: List[dict] = []
+        parent_ids: Dict[int, int] = {}
+        for record in graph.run("MATCH (n:Level1) RETURN id(n) AS id, properties(n) AS props"):
+            parent_ids[record["id"]] = len(parents)
+            parents.append(record["props"])
+        debts = [
+            (child_ids[record["src"]], child_ids[record["dst"]], record["props"])
+            for record in graph.run("""
+                MATCH (a:Level2)-[e:HAS_DEBT]->(b:Level2)
+                RETURN id(a) AS src, id(b) AS dst, properties(e) AS props
+            """)
+        ]
+        memberships = [
+            (child_ids[record["child"]], parent_ids[record["parent"]], record["props"])
+            for record in graph.run("""
+                MATCH (a:Level2)-[e:HAS_PARENT]->(b:Level1)
+                RETURN id(a) AS child, id(b) AS parent, properties(e) AS props
+            """)
+        ]
+        return cls(children, parents, debts, memberships)
+
+    def _distances_to(self, target: int, max_depth: int) -> Dict[int, int]:
+        """
+        # 沿反向边BFS，得到距离不超过max_depth的节点到target的最短距离
+        """
+        dist: Dict[int, int] = {target: 0}
+        queue = deque([target])
+        while queue:
+            v = queue.popleft()
+            if dist[v] >= max_depth:
+                continue
+            for k in range(self.rindptr[v], self.rindptr[v + 1]):
+                u = self.rindices[k]
+                if u not in dist:
+                    dist[u] = dist[v] + 1
+                    queue.append(u)
+        return dist
+
+    def cycles(self, start: int, jump: int) -> Iterator[Tuple[List[int], List[int]]]:
+        """
+        # 枚举经过start、恰好有jump条边的简单环
+        :param start: 子节点编号
+        :param jump: 环的边的数目
+        :return: (节点编号列表，首尾都是start, 边编号列表)
+        """
+        if jump < 1:
+            return
+        dist = self._distances_to(start, jump - 1)
+        nodes: List[int] = [start]
+        edges: List[int] = []
+
+        def dfs(u: int, depth: int):
+            remain = jump - depth - 1
+            for k in range(self.indptr[u], self.indptr[u + 1]):
+                w = self.indices[k]
+                if remain == 0:
+                    if w == start:
+                        yield nodes + [start], edges + [self.edge_ids[k]]
+                elif w != start and dist.get(w, jump) <= remain and w not in nodes:
+                    nodes.append(w)
+                    edges.append(self.edge_ids[k])
+                    yield from dfs(w, depth + 1)
+                    nodes.pop()
+                    edges.pop()
+
+        yield from dfs(start, 0)
+
+    def _path(self, nodes: List[int], edges: List[int]) -> list:
+        path: list = [self.children[nodes[0]]]
+        for edge, node in zip(edges, nodes[1:]):
+            path += [self.debts[edge], self.children[node]]
+        return path
+
+    @staticmethod
+    def _page(rows: Iterator[dict], skip: int = 0, limit: int = -1, after: str = None) -> Tuple[list, str]:
+        """
+        # 统计全部结果的数量，只序列化这一页的结果，after详细见 :func:`page_offset`
+        """
+        after = resolve_after(after)
+        total, page, next_token = page_offset(rows, after, skip, limit)
+        count: dict = {"total": total}
+        if after is not None:
+            count["next"] = next_token
+        return [count], json.dumps(page, ensure_ascii=False)
+
+    def get_child_ring(self, child: str, jump: int = 2, skip: int = 0, limit: int = -1,
+                       **kwargs) -> Tuple[list, str]:
+        """
+        # 与 :class:`Neo4jDao.get_child_ring`相同
+        """
+        rows = (
+            {"path": self._path(nodes, edges)}
+            for start in self.child_index.get(child, [])
+            for nodes, edges in self.cycles(start, jump)
+        )
+        return self._page(rows, skip, limit, kwargs.get("after"))
+
+    def get_parent_ring(self, parent: str, jump: int = 2, skip: int = 0, limit: int = -1,
+                        **kwargs) -> Tuple[list, str]:
+        """
+        # 与 :class:`Neo4jDao.get_parent_ring`相同
+        """
+        rows = (
+            {"path": self._path(nodes, edges), "child": self.children[start], "edge": edge,
+             "parent": self.parents[p]}
+            for p in self.parent_index.get(parent, [])
+            for start, edge in self.members.get(p, [])
+            for nodes, edges in self.cycles(start, jump)
+        )
+        return self._page(rows, skip, limit, kwargs.get("after"))
+
+    def get_child_with_child_ring(self, child1: str, child2: str, jump: int = 2, skip: int = 0, limit: int = -1,
+                                  **kwargs) -> Tuple[list, str]:
+        """
+        # 与 :class:`Neo4jDao.get_child_with_child_ring`相同
+        """
+        targets = set(self.child_index.get(child2, []))
+        rows = (
+            {"path": self._path(nodes, edges)}
+            for start in self.child_index.get(child1, [])
+            for nodes, edges in self.cycles(start, jump)
+            if targets.intersection(nodes)
+        )
+        return self._page(rows, skip, limit, kwargs.get("after"))
+
+    def get_parent_with_parent_ring(self, parent1: str, parent2: str, jump: int = 2, skip: int = 0,
+                                    limit: int = -1, **kwargs) -> Tuple[list, str]:
+        """
+        # 与 :class:`Neo4jDao.get_parent_with_parent_ring`相同
+        """
+        p2s = self.parent_index.get(parent2, [])
+        rows = (
+            {"path": self._path(nodes, edges), "child1": self.children[start], "child2": self.children[c2],
+             "parent1": self.parents[p1], "parent2": self.parents[p2]}
+            for p1 in self.parent_index.get(parent1, [])
+            for start, _ in self.members.get(p1, [])
+            for nodes, edges in self.cycles(start, jump)
+            for p2 in p2s
+            for c2, _ in self.members.get(p2, [])
+            if c2 in nodes
+        )
+        return self._page(rows, skip, limit, kwargs.get("after"))
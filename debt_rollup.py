@@ -0,0 +1,130 @@
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+from py2neo import Graph
+from neo4j_page import page_offset, resolve_after
+
+
+class DebtRollup:
+    """
+    DebtRollup是父节点级别的债务汇总索引，保存每个(父节点, 对方父节点, s_detail)的金额合计和边数，
+    用于直接回答"某集团欠了谁多少钱、按s_detail分类"这类问题，不必每次遍历全部子节点和HAS_DEBT边。
+    有多个父节点的子节点在每个父节点下各计一次，没有父节点的子节点归入 :attr:`DebtRollup.NO_PARENT`，
+    对方没有父节点的欠款不会丢失。
+    通过 :class:`DebtRollup.load`从neo4j批量构建，明细仍然通过 :class:`Neo4jDao.get_parent_debt`等方法下钻查询。
+    索引是构建时的快照，Neo4jDao中的索引在 :class:`Neo4jDao.invalidate_cache`后重新构建；
+    自己写入HAS_DEBT边的调用方可以通过 :class:`DebtRollup.apply_debt_change`增量更新，
+    HAS_PARENT的变化会影响子节点的全部欠款，只能重新构建
+    """
+
+    # 没有父节点的子节点所属的父节点，结果中的parent或counterparty为null
+    NO_PARENT: Optional[str] = None
+
+    def __init__(self, parent_of: Dict[int, List[str]], amount_key: str = "money"):
+        """
+        :param parent_of: 子节点id -> 全部父节点名称，没有父节点时为空list
+        :param amount_key: HAS_DEBT边上金额属性的名称
+        """
+        self.parent_of: Dict[int, List[str]] = parent_of
+        self.amount_key: str = amount_key
+        # 欠款方父节点 -> s_detail -> 收款方父节点 -> [金额合计, 边数]
+        self.debts: Dict[str, Dict[str, Dict[str, list]]] = {}
+        # 收款方父节点 -> s_detail -> 欠款方父节点 -> [金额合计, 边数]
+        self.receivables: Dict[str, Dict[str, Dict[str, list]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, graph: Graph, amount_key: str = "money") -> "DebtRollup":
+        """
+        # 从neo4j批量构建汇总索引，聚合在neo4j中完成
+        :param graph: neo4j的连接
+        :param amount_key: HAS_DEBT边上金额属性的名称
+        :return: 汇总索引
+        """
+        # 子节点按id区分，同名的子节点不会互相覆盖
+        parent_of: Dict[int, List[str]] = {
+            record["child"]: record["parents"]
+            for record in graph.run("""
+                MATCH (child:Level2)
+                OPTIONAL MATCH (child)-[:HAS_PARENT]->(parent:Level1)
+                RETURN id(child) AS child, collect(parent.name) AS parents
+            """)
+        }
+        rollup = cls(parent_of, amount_key)
+        # OPTIONAL MATCH保留没有父节点的一方(parent为null)，有多个父节点时每个父节点一行
+        cursor = graph.run(f"""
+            MATCH (child1:Level2)-[edge:HAS_DEBT]->(child2:Level2)
+            OPTIONAL MATCH (child1)-[:HAS_PARENT]->(parent1:Level1)
+            OPTIONAL MATCH (child2)-[:HAS_PARENT]->(parent2:Level1)
+            RETURN parent1.name AS debtor, parent2.name AS creditor, edge.s_detail AS detail,
+                   sum(toFloat(edge.{amount_key})) AS total, count(edge) AS num
+        """)
+        for record in cursor:
+            rollup._add(record["debtor"], record["creditor"], record["detail"], record["total"] or 0.0, record["num"])
+        return rollup
+
+    def _parents(self, child: int) -> List[str]:
+        return self.parent_of.get(child) or [self.NO_PARENT]
+
+    def _add(self, debtor: str, creditor: str, detail: str, amount: float, num: int):
+        for index, key, other in ((self.debts, debtor, creditor), (self.receivables, creditor, debtor)):
+            agg = index.setdefault(key, {}).setdefault(detail, {}).setdefault(other, [0.0, 0])
+            agg[0] += amount
+            agg[1] += num
+            if agg[1] <= 0:
+                del index[key][detail][other]
+
+    def apply_debt_change(self, child1: int, child2: int, old: dict = None, new: dict = None):
+        """
+        # 增量更新一条child1->child2的HAS_DEBT边，新增时old为None，删除时new为None，
+        # 与load相同，双方的每一对父节点各更新一次
+        :param child1: 欠款子节点的id
+        :param child2: 收款子节点的id
+        :param old: 变化前边的属性
+        :param new: 变化后边的属性
+        """
+        with self._lock:
+            for debtor in self._parents(child1):
+                for creditor in self._parents(child2):
+                    if old is not None:
+                        self._add(debtor, creditor, old.get("s_detail"), -float(old.get(self.amount_key) or 0), -1)
+                    if new is not None:
+                        self._add(debtor, creditor, new.get("s_detail"), float(new.get(self.amount_key) or 0), 1)
+
+    @staticmethod
+    def _select(index: Dict[str, Dict[str, Dict[str, list]]], parent: str, details: List[str] = None,
+                skip: int = 0, limit: int = -1, **kwargs) -> Tuple[list, str]:
+        by_detail = index.get(parent, {})
+        if details is None:
+            details = list(by_detail)
+        rows: list = [
+            {"parent": parent, "counterparty": other, "s_detail": detail, "money": agg[0], "count": agg[1]}
+            for detail in details
+            for other, agg in by_detail.get(detail, {}).items()
+        ]
+        after = resolve_after(kwargs.get("after"))
+        total, page, next_token = page_offset(rows, after, skip, limit)
+        count: dict = {"total": total}
+        if after is not None:
+            count["next"] = next_token
+        return [count], json.dumps(page, ensure_ascii=False)
+
+    def get_parent_debt(self, parent: str, details: List[str] = None, *args, **kwargs) -> Tuple[list, str]:
+        """
+        # 某个父节点对各个父节点、按s_detail汇总的欠款
+        :param parent: 父节点名称
+        :param details: 债务类别list，None时返回全部类别
+        :return: 总数和[{"parent", "counterparty", "s_detail", "money", "count"}]
+        """
+        with self._lock:
+            return self._select(self.debts, parent, details, *args, **kwargs)
+
+    def get_parent_receivables(self, parent: str, details: List[str] = None, *args, **kwargs) -> Tuple[list, str]:
+        """
+        # 某个父节点来自各个父节点、按s_detail汇总的应收账款
+        :param parent: 父节点名称
+        :param details: 债务类别list，None时返回全部类别
+        :return: 总数和[{"parent", "counterparty", "s_detail", "money", "count"}]
+        """
+        with self._lock:
+            return self._select(self.receivables, parent, details, *args, **kwargs)
@@ -0,0 +1,326 @@
+import time
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+from typing import Any, Callable, Dict, List, Tuple
+from neo4j_metrics import Histogram
+from cancellation import Cancelled, check_cancelled, current_cancel
+from llm_stream import token_sink
+
+
+class LLMBatcher:
+    """
+    LLMBatcher是大模型推理的微批调度器：并发请求的prompt先进入队列，调度线程取出第一个prompt后最多再等待
+    max_wait秒，凑满max_batch_size个或等待结束后以一次batch_fn调用一起推理，再把结果分别交还给等待的请求。
+    CPU上一次推理一批prompt的吞吐量远高于逐个推理。
+    与 :class:`Neo4jPool`相同，通过 :class:`LLMBatcher.install`初始化后，大模型的调用处使用 :func:`generate`
+    """
+
+    _batcher: "LLMBatcher" = None
+
+    SECONDS_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    SIZE_BUCKETS: Tuple[float, ...] = (1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.005,
+                 max_queue: int = 256, workers: int = 1):
+        """
+        :param batch_fn: 批量推理的函数，输入prompt列表，返回同样长度、同样顺序的结果列表
+        :param max_batch_size: 一批最多的prompt数
+        :param max_wait: 取出一批中的第一个prompt后最多等待的时间(秒)
+        :param max_queue: 队列中最多等待的prompt数，队列满时 :class:`LLMBatcher.submit`等待
+        :param workers: 调度线程数，即同时推理的批数，例如模型有多个副本时
+        """
+        self.batch_fn: Callable[[List[Any]], List[Any]] = batch_fn
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait
+        self.max_queue: int = max_queue
+        # (prompt, Future, 入队时间)，None表示停止
+        self._queue: "queue.Queue" = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self.requests: int = 0
+        self.batches: int = 0
+        self.errors: int = 0
+        self.rejected: int = 0
+        # 排队期间请求被取消，没有推理就丢弃的prompt数
+        self.cancelled: int = 0
+        self.queue_depth_max: int = 0
+        self.batch_size = Histogram(self.SIZE_BUCKETS)
+        self.queue_seconds = Histogram(self.SECONDS_BUCKETS)
+        self.batch_seconds = Histogram(self.SECONDS_BUCKETS)
+        self.latency_seconds = Histogram(self.SECONDS_BUCKETS)
+        self._workers: List[threading.Thread] = [
+            threading.Thread(target=self._run, name=f"llm-batcher-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @classmethod
+    def install(cls, batcher: "LLMBatcher"):
+        """
+        # 设置全局的调度器，之后 :func:`generate`通过该调度器推理
+        """
+        cls._batcher = batcher
+
+    @classmethod
+    def get_batcher(cls) -> "LLMBatcher":
+        """
+        # 获取全局的调度器，没有初始化时返回None
+        """
+        return cls._batcher
+
+    def submit(self, prompt: Any, timeout: float = None) -> Any:
+        """
+        # 提交一个prompt并等待推理结果
+        :param prompt: 大模型的输入
+        :param timeout: 队列满时等待入队的最长时间(秒)，超时抛出TimeoutError，None时一直等待
+        :return: batch_fn对该prompt的结果，batch_fn抛出的异常在这里重新抛出
+        """
+        return self.submit_async(prompt, timeout).result()
+
+    def submit_async(self, prompt: Any, timeout: float = None) -> Future:
+        """
+        # 提交一个prompt，不等待推理结果
+        :param prompt: 大模型的输入
+        :param timeout: 详细见 :class:`LLMBatcher.submit`
+        :return: 推理结果的Future
+        """
+        future: Future = Future()
+        try:
+            self._queue.put((prompt, future, time.perf_counter()), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise TimeoutError(f"llm batch queue is full ({self.max_queue})")
+        with self._lock:
+            self.requests += 1
+            self.queue_depth_max = max(self.queue_depth_max, self._queue.qsize())
+        return future
+
+    def _collect(self) -> list:
+        """
+        # 阻塞等待第一个prompt，之后在max_wait内尽量凑满一批
+        """
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remain = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remain) if remain > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 让其它调度线程也能收到停止信号
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                self._queue.put(None)
+                return
+            # 排队期间被取消的prompt不再推理
+            live = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if len(live) < len(batch):
+                with self._lock:
+                    self.cancelled += len(batch) - len(live)
+                batch = live
+                if not batch:
+                    continue
+            start = time.perf_counter()
+            prompts = [prompt for prompt, _, _ in batch]
+            try:
+                results = self.batch_fn(prompts)
+                if len(results) != len(prompts):
+                    raise ValueError(f"batch_fn returned {len(results)} results for {len(prompts)} prompts")
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.batch_size.observe(len(batch))
+                self.batch_seconds.observe(end - start)
+                for _, _, enqueued in batch:
+                    self.queue_seconds.observe(start - enqueued)
+                    self.latency_seconds.observe(end - enqueued)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self):
+        """
+        # 处理完队列中已有的prompt后停止调度线程
+        """
+        self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        # 取出最后留下的停止信号
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def stats(self) -> dict:
+        """
+        # 请求数、批数、排队期间取消的prompt数、平均批大小、当前和最大队列深度，以及排队、推理和端到端的平均耗时
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "batch_size_avg": self.batch_size.sum / self.batch_size.count if self.batch_size.count else 0,
+                "queue_depth": self._queue.qsize(),
+                "queue_depth_max": self.queue_depth_max,
+                "queue_time_avg": self.queue_seconds.sum / self.queue_seconds.count if self.queue_seconds.count else 0,
+                "batch_time_avg": self.batch_seconds.sum / self.batch_seconds.count if self.batch_seconds.count else 0,
+                "latency_avg": self.latency_seconds.sum / self.latency_seconds.count
+                if self.latency_seconds.count else 0,
+            }
+
+    def render_prometheus(self) -> str:
+        """
+        # 输出Prometheus文本格式的统计数据
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name in ("requests", "batches", "errors", "rejected", "cancelled"):
+                lines.append(f"# TYPE llm_batcher_{name}_total counter")
+                lines.append(f"llm_batcher_{name}_total {getattr(self, name)}")
+            lines.append("# TYPE llm_batcher_queue_depth gauge")
+            lines.append(f"llm_batcher_queue_depth {self._queue.qsize()}")
+            for name in ("batch_size", "queue_seconds", "batch_seconds", "latency_seconds"):
+                histogram: Histogram = getattr(self, name)
+                lines.append(f"# TYPE llm_batcher_{name} histogram")
+                for le, num in histogram.cumulative():
+                    lines.append(f'llm_batcher_{name}_bucket{{le="{le}"}} {num}')
+                lines.append(f"llm_batcher_{name}_sum {histogram.sum}")
+                lines.append(f"llm_batcher_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def generate(prompt: Any, fallback: Callable[[Any], Any] = None, timeout: float = None) -> Any:
+    """
+    # 大模型的调用处使用的推理入口，安装了 :class:`LLMBatcher`时与其它请求一起批量推理，否则调用fallback。
+    # 当前请求取消时(详细见 :func:`cancel_scope`)，还在排队的prompt从队列中丢弃，并抛出 :class:`Cancelled`
+    :param prompt: 大模型的输入
+    :param fallback: 没有安装调度器时逐个推理的函数，例如model.generate
+    :param timeout: 详细见 :class:`LLMBatcher.submit`
+    :return: 推理结果
+    """
+    check_cancelled()
+    batcher = LLMBatcher.get_batcher()
+    if batcher is None:
+        if fallback is None:
+            raise RuntimeError("LLMBatcher is not installed")
+        return fallback(prompt)
+    future = batcher.submit_async(prompt, timeout)
+    token = current_cancel.get()
+    remove = token.on_cancel(future.cancel) if token is not None else None
+    try:
+        return future.result()
+    except CancelledError:
+        raise Cancelled(f"request {token.request_id} {token.reason}")
+    finally:
+        if remove is not None:
+            remove()
+
+
+def chat_batch(model: Any, tokenizer: Any, queries: List[str], histories: List[list], **kwargs) -> List[tuple]:
+    """
+    # 一次model.generate生成多个问题的回答，与逐个调用model.chat的结果相同。
+    # 需要tokenizer有build_prompt并且左侧padding(例如ChatGLM2)，否则逐个调用model.chat
+    :param model: ChatGLM这类有chat、generate和process_response方法的模型
+    :param tokenizer: 模型的tokenizer
+    :param queries: 问题列表
+    :param histories: 每个问题的对话历史
+    :param kwargs: chat的生成参数，同一批的参数相同
+    :return: 每个问题的(回答, 新的对话历史)
+    """
+    if len(queries) == 1 or not callable(getattr(tokenizer, "build_prompt", None)) \
+            or getattr(tokenizer, "padding_side", "left") != "left":
+        return [model.chat(tokenizer, query, history=history, **kwargs) for query, history in zip(queries, histories)]
+    prompts = [tokenizer.build_prompt(query, history or []) for query, history in zip(queries, histories)]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    # 与ChatGLM2的chat相同的默认生成参数
+    gen_kwargs = {"max_length": 8192, "do_sample": True, "top_p": 0.8, "temperature": 0.8}
+    gen_kwargs.update(kwargs)
+    outputs = model.generate(**inputs, **gen_kwargs)
+    # 左侧padding后所有prompt的长度相同，之后的部分是生成的回答
+    start = inputs["input_ids"].shape[1]
+    results = []
+    for query, history, output in zip(queries, histories, outputs.tolist()):
+        response = model.process_response(tokenizer.decode(output[start:], skip_special_tokens=True))
+        results.append((response, list(history or []) + [(query, response)]))
+    return results
+
+
+def batch_chat(prompts: List[tuple]) -> List[tuple]:
+    """
+    # :class:`LLMBatcher`的batch_fn，prompt为 :class:`BatchedChat`提交的(模型, tokenizer, 问题, 对话历史, 生成参数)，
+    # 同一模型、同一tokenizer、同样生成参数的prompt通过 :func:`chat_batch`一起生成
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for i, (model, tokenizer, _, _, kwargs) in enumerate(prompts):
+        # 生成参数可能有不可哈希的值(例如logits_processor)，按repr分组
+        key = (id(model), id(tokenizer), repr(sorted(kwargs.items())))
+        groups.setdefault(key, []).append(i)
+    results: List[tuple] = [None] * len(prompts)
+    for indexes in groups.values():
+        model, tokenizer, _, _, kwargs = prompts[indexes[0]]
+        replies = chat_batch(model, tokenizer, [prompts[i][2] for i in indexes], [prompts[i][3] for i in indexes],
+                             **kwargs)
+        for i, reply in zip(indexes, replies):
+            results[i] = reply
+    return results
+
+
+class BatchedChat:
+    """
+    包装ChatGLM这类有chat方法的模型：调用方仍然调用chat，内部通过 :func:`generate`与其它请求的chat一起批量生成，
+    不需要修改调用方(例如DebtLLM)。流式输出时(有 :class:`TokenStream`接收token)和beam search时直接调用原模型。
+    其它属性和方法直接访问原模型
+    """
+
+    def __init__(self, model: Any):
+        """
+        :param model: 有chat(tokenizer, query, history, **kwargs)方法的模型，可以是 :class:`StreamingChat`
+        """
+        self.model: Any = model
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+    def chat(self, tokenizer: Any, query: str, history: list = None, **kwargs) -> tuple:
+        """
+        # 与原模型的chat相同，返回(回答, 新的对话历史)
+        """
+        if token_sink.get() is not None or kwargs.get("num_beams", 1) > 1:
+            return self.model.chat(tokenizer, query, history=history, **kwargs)
+        return generate((self.model, tokenizer, query, history, kwargs),
+                        fallback=lambda prompt: self.model.chat(tokenizer, query, history=history, **kwargs))
+
+
+def batch_chat_models(obj: Any) -> int:
+    """
+    # 把obj的属性中有chat方法的模型替换为 :class:`BatchedChat`，之后安装 :class:`LLMBatcher`(batch_fn为
+    # :func:`batch_chat`)时，并发请求中obj调用的chat一起批量生成
+    :param obj: 调用模型的对象，例如DebtLLM
+    :return: 替换的模型数
+    """
+    wrapped = 0
+    for name, value in list(vars(obj).items()):
+        if isinstance(value, BatchedChat):
+            continue
+        if callable(getattr(value, "chat", None)) and callable(getattr(value, "generate", None)):
+            setattr(obj, name, BatchedChat(value))
+            wrapped += 1
+    return wrapped
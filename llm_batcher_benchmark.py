@@ -0,0 +1,80 @@
+"""
+LLMBatcher的压测，使用本地的替身模型(StubModel)模拟CPU上批量推理的耗时，不需要真实的大模型
+使用方式 python llm_batcher_benchmark.py --clients 32 --requests 20 --batch-sizes 1 4 8 16 --max-wait 0.005
+"""
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from llm_batcher import LLMBatcher
+
+
+class StubModel:
+    """
+    替身模型，一次推理的耗时为 overhead + prompt数 * per_prompt，
+    overhead是与批大小无关的固定开销(读取权重、调度等)，批越大平摊到每个prompt上越少
+    """
+
+    def __init__(self, overhead: float = 0.05, per_prompt: float = 0.005):
+        """
+        :param overhead: 每次推理的固定耗时(秒)
+        :param per_prompt: 每个prompt增加的耗时(秒)
+        """
+        self.overhead: float = overhead
+        self.per_prompt: float = per_prompt
+        self.calls: int = 0
+        # 模型同一时间只能执行一次推理
+        self._lock = threading.Lock()
+
+    def generate_batch(self, prompts: List[str]) -> List[str]:
+        with self._lock:
+            self.calls += 1
+            time.sleep(self.overhead + len(prompts) * self.per_prompt)
+        return [f"answer to {prompt}" for prompt in prompts]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0
+
+
+def run_load(batch_size: int, max_wait: float, clients: int, requests: int, model: StubModel):
+    """
+    # 闭环压测：clients个客户端各自依次发送requests个请求
+    """
+    batcher = LLMBatcher(model.generate_batch, max_batch_size=batch_size, max_wait=max_wait, max_queue=clients * 2)
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def client(i: int):
+        for j in range(requests):
+            start = time.perf_counter()
+            result = batcher.submit(f"q{i}-{j}")
+            assert result == f"answer to q{i}-{j}"
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+    batcher.close()
+    stats = batcher.stats()
+    print(f"batch={batch_size:>3}: rps={len(latencies) / elapsed:7.1f} p50={percentile(latencies, 0.5) * 1000:7.1f}ms "
+          f"p95={percentile(latencies, 0.95) * 1000:7.1f}ms batch_avg={stats['batch_size_avg']:.1f} "
+          f"queue_max={stats['queue_depth_max']} batches={stats['batches']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--max-wait", type=float, default=0.005)
+    parser.add_argument("--overhead", type=float, default=0.05)
+    parser.add_argument("--per-prompt", type=float, default=0.005)
+    args = parser.parse_args()
+    for size in args.batch_sizes:
+        run_load(size, args.max_wait, args.clients, args.requests, StubModel(args.overhead, args.per_prompt))
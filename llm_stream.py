@@ -0,0 +1,150 @@
+import json
+import queue
+import threading
+import contextvars
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, Iterator
+from cancellation import check_cancelled
+
+# 当前上下文中接收大模型token的函数，由 :class:`TokenStream`设置
+token_sink: ContextVar[Callable[[str], None]] = ContextVar("llm_token_sink", default=None)
+
+
+def emit_token(text: str):
+    """
+    # 大模型每生成一段文本调用一次，没有 :class:`TokenStream`接收时什么也不做。
+    # 同时是取消的检查点，请求已经取消时抛出 :class:`Cancelled`，生成随之停止
+    :param text: 新生成的文本
+    """
+    check_cancelled()
+    sink = token_sink.get()
+    if sink is not None and text:
+        sink(text)
+
+
+def stream_tokens(tokens: Iterable[str]) -> str:
+    """
+    # 包装大模型的流式输出(例如TextIteratorStreamer或流式接口的迭代器)，逐段转发给 :func:`emit_token`，
+    # 请求取消时关闭迭代器(生成器或有close方法的流式接口)，不再继续生成
+    :param tokens: 逐段生成的文本
+    :return: 完整的文本，与非流式调用的返回值相同
+    """
+    parts = []
+    try:
+        for text in tokens:
+            emit_token(text)
+            parts.append(text)
+    except BaseException:
+        close = getattr(tokens, "close", None)
+        if close is not None:
+            close()
+        raise
+    return "".join(parts)
+
+
+class StreamingChat:
+    """
+    包装ChatGLM这类同时有chat和stream_chat方法的模型：调用方仍然调用chat，内部改用stream_chat逐段生成，
+    每段新生成的文本转发给 :func:`emit_token`，返回值与chat相同，不需要修改调用方(例如DebtLLM)。
+    其它属性和方法直接访问原模型
+    """
+
+    def __init__(self, model: Any):
+        """
+        :param model: 有chat(tokenizer, query, history, **kwargs)和同样参数的stream_chat的模型
+        """
+        self.model: Any = model
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+    def chat(self, tokenizer: Any, query: str, history: list = None, **kwargs) -> tuple:
+        """
+        # 与原模型的chat相同，返回(回答, 新的对话历史)
+        """
+        if kwargs.get("num_beams", 1) > 1:
+            # stream_chat不支持beam search
+            return self.model.chat(tokenizer, query, history=history, **kwargs)
+        kwargs.pop("num_beams", None)
+        response, new_history = "", history
+        stream = self.model.stream_chat(tokenizer, query, history=history, **kwargs)
+        try:
+            for item in stream:
+                text, new_history = item[0], item[1]
+                # stream_chat每次返回到目前为止的完整回答，只转发新增的部分
+                if text.startswith(response):
+                    emit_token(text[len(response):])
+                response = text
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        return response, new_history
+
+
+def stream_chat_models(obj: Any) -> int:
+    """
+    # 把obj的属性中有chat和stream_chat方法的模型替换为 :class:`StreamingChat`，
+    # 之后obj通过这些模型生成的文本由 :func:`emit_token`逐段发出
+    :param obj: 调用模型的对象，例如DebtLLM
+    :return: 替换的模型数
+    """
+    wrapped = 0
+    for name, value in list(vars(obj).items()):
+        if isinstance(value, StreamingChat):
+            continue
+        if callable(getattr(value, "chat", None)) and callable(getattr(value, "stream_chat", None)):
+            setattr(obj, name, StreamingChat(value))
+            wrapped += 1
+    return wrapped
+
+
+def format_sse(event: str, data: Any) -> str:
+    """
+    # 将一个事件编码为Server-Sent Events的格式，data为json
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class TokenStream:
+    """
+    TokenStream在后台线程中执行fn(例如DebtLLM.process_control)，迭代得到执行过程中 :func:`emit_token`
+    发出的文本，迭代结束后result为fn的返回值，fn抛出的异常在迭代结束时重新抛出。
+    后台线程带上当前的contextvars(例如 :func:`streaming`和 :func:`paging`)
+    """
+
+    _DONE = object()
+
+    def __init__(self, fn: Callable, *args, **kwargs):
+        """
+        :param fn: 要执行的函数
+        :param args: fn的位置参数
+        :param kwargs: fn的关键字参数
+        """
+        self.result: Any = None
+        self.tokens: int = 0
+        self._error: BaseException = None
+        self._queue: "queue.Queue" = queue.Queue()
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run, fn, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, fn: Callable, args: tuple, kwargs: dict):
+        token_sink.set(self._queue.put)
+        try:
+            self.result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._queue.put(self._DONE)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            text = self._queue.get()
+            if text is self._DONE:
+                break
+            self.tokens += 1
+            yield text
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
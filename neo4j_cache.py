@@ -0,0 +1,89 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+
+class QueryCache:
+    """
+    QueryCache是带有LRU淘汰和TTL过期的查询结果缓存，用于缓存 :class:`Neo4jDao`的查询结果，
+    线程安全，债务图重新导入后需要调用 :class:`QueryCache.invalidate`清空缓存
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        """
+        :param max_size: 最多缓存的条数，超出后淘汰最久未使用的条目
+        :param ttl: 缓存的有效时间(秒)，小于等于0时不过期
+        """
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @staticmethod
+    def make_key(kind: str, cql: str, params: dict, skip: int = 0, limit: int = -1) -> Tuple:
+        """
+        # 根据(cql, params, skip, limit)生成缓存的key
+        :param kind: 查询的种类，区分同一条cql的数据查询和数量查询
+        :param cql: 查询语句
+        :param params: 查询参数
+        :param skip: 跳过开头的条数
+        :param limit: 限制页数
+        :return: 可哈希的key
+        """
+        return kind, cql, json.dumps(params, sort_keys=True, ensure_ascii=False, default=str), skip, limit
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        # 查询缓存
+        :param key: 缓存的key
+        :return: (是否命中, 缓存的值)
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expire, value = item
+                if self.ttl <= 0 or expire > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, value: Any):
+        """
+        # 写入缓存，超出容量时淘汰最久未使用的条目
+        :param key: 缓存的key
+        :param value: 缓存的值
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """
+        # 清空全部缓存，债务图重新导入或写入后调用
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        # 缓存的命中、未命中、淘汰次数和当前大小
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+            }
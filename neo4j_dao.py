@@ -1,9 +1,130 @@
-import json
-from py2neo import Graph, Path
-from py2neo.data import Node
+import time
+import threading
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from py2neo import Graph
 from py2neo.cypher import Cursor
-from typing import List, Tuple
+from typing import Callable, Iterable, Iterator, List, Tuple
 from src.utils.connect import Neo4jConnect
+from neo4j_cache import QueryCache
+from neo4j_serializer import dumps, to_jsonable
+from debt_graph import DebtGraph
+from debt_rollup import DebtRollup
+from neo4j_pool import Neo4jPool
+from neo4j_page import decode_token, encode_token, resolve_after, set_next
+from single_flight import SingleFlight
+from cancellation import Cancelled, CancelToken, check_cancelled, current_cancel
+
+# 当前正在执行的查询方法名，由 :func:`query_method`设置，用于按方法开启缓存等
+current_method: ContextVar[str] = ContextVar("neo4j_dao_method", default="")
+# 当前上下文中select是否默认以流的形式返回数据，由 :func:`streaming`设置
+stream_mode: ContextVar[bool] = ContextVar("neo4j_dao_stream", default=False)
+# keyset分页的排序键，只使用neo4j的内部id，不在每一行上计算字符串：
+# 边查询按边的id排序，环查询按路径上各条边的id组成的list排序(list按字典序比较)
+EDGE_KEY: str = "id(edge)"
+PATH_KEY: str = "[r IN relationships(path) | id(r)]"
+# 同一条环可能对应多个child2，再追加child2的id
+RING_PAIR_KEY: str = PATH_KEY + " + id(child2)"
+# 默认的查询统计钩子，没有指定hooks的Neo4jDao共用，详细见 :func:`add_default_hook`
+default_hooks: List[Callable[[dict], None]] = []
+# 债务图变化后需要一起清空的上层缓存，例如答案缓存，详细见 :func:`add_invalidation_hook`
+invalidation_hooks: List[Callable[[], None]] = []
+# 查询参数中标记所属请求的参数名，请求取消时按该参数找到并终止正在执行的查询
+CANCEL_PARAM: str = "cancel_request_id"
+# 找到某个请求正在执行的事务并终止(neo4j 4.4及之后的版本，neo4j 5不再提供dbms.killQuery)
+SHOW_TX_CQL: str = f"""
+    SHOW TRANSACTIONS YIELD transactionId, parameters
+    WHERE parameters.{CANCEL_PARAM} = $request_id
+    RETURN collect(transactionId) AS ids
+"""
+TERMINATE_TX_CQL: str = "TERMINATE TRANSACTIONS $ids"
+# 终止某个请求正在执行的查询(neo4j 3.x/4.x的dbms.listQueries和dbms.killQuery)
+KILL_CQL: str = f"""
+    CALL dbms.listQueries() YIELD queryId, parameters
+    WHERE parameters.{CANCEL_PARAM} = $request_id
+    CALL dbms.killQuery(queryId) YIELD queryId AS killed
+    RETURN count(killed) AS killed
+"""
+
+
+def query_method(func):
+    """
+    # 标记Neo4jDao的查询方法，执行期间在 :data:`current_method`中记录方法名，
+    # 设置了flight时同时到达的相同查询只执行一次，流模式返回的生成器不能共享，不合并。
+    # 当前请求已经取消时不再查询，执行中被取消时终止正在执行的查询并抛出 :class:`Cancelled`
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        check_cancelled()
+        cancel: CancelToken = current_cancel.get()
+
+        def execute(*args, **kwargs):
+            try:
+                return func(self, *args, **kwargs)
+            except Exception as e:
+                if cancel is not None and cancel.cancelled:
+                    raise Cancelled(f"request {cancel.request_id} {cancel.reason}") from e
+                raise
+
+        token = current_method.set(func.__name__)
+        remove = None
+        if cancel is not None and self.kill_on_cancel:
+            remove = cancel.on_cancel(functools.partial(self.kill_queries, cancel.request_id))
+        try:
+            stream = kwargs.get("stream")
+            if stream is None:
+                stream = stream_mode.get()
+            if self.flight is None or stream:
+                return execute(*args, **kwargs)
+            after = resolve_after(kwargs.get("after"))
+            key = self.flight.make_key(id(self), func.__name__, args, kwargs, after)
+            try:
+                result, shared = self.flight.do(key, execute, *args, **kwargs)
+            except Cancelled:
+                if cancel is not None and cancel.cancelled:
+                    raise
+                # 合并到的查询属于已经取消的其它请求，本次请求自己重新执行
+                result, shared = execute(*args, **kwargs), False
+            # 共享结果时本次请求没有执行查询，需要自己记录下一页的token
+            if shared and after is not None and isinstance(result[0], list) and result[0]:
+                set_next(result[0][0].get("next"))
+            return result
+        finally:
+            if remove is not None:
+                remove()
+            current_method.reset(token)
+    return wrapper
+
+
+def add_default_hook(hook: Callable[[dict], None]):
+    """
+    # 注册默认的查询统计钩子，每次查询结束后以事件dict调用，例如 :class:`QueryMetrics`，
+    # 事件包含method、kind、params(参数名 -> 基数)、jump、rows、bytes、db_time、serialize_time、cached
+    """
+    default_hooks.append(hook)
+
+
+def add_invalidation_hook(hook: Callable[[], None]):
+    """
+    # 注册缓存失效的钩子，:class:`Neo4jDao.invalidate_cache`清空查询结果缓存后无参数调用，
+    # 用于清空建立在查询结果之上的缓存，例如 :class:`AnswerCache.invalidate`
+    """
+    invalidation_hooks.append(hook)
+
+
+@contextmanager
+def streaming(enable: bool = True):
+    """
+    # 在上下文中让Neo4jDao的查询方法以NDJSON流的形式返回数据，
+    # 用于上层(例如Neo4jService)无法逐个传递stream参数的场景
+    """
+    token = stream_mode.set(enable)
+    try:
+        yield
+    finally:
+        stream_mode.reset(token)
 
 
 class Neo4jDao:
@@ -12,75 +133,424 @@ class Neo4jDao:
     初始化请参考 :class:`Neo4jConnect`类
     """
 
-    def __init__(self):
+    def __init__(self, one_trip: bool = False, cache: QueryCache = None, cache_methods: Iterable[str] = (),
+                 ring_backend: str = "cypher", pool: Neo4jPool = None, hooks: List[Callable[[dict], None]] = None,
+                 flight: SingleFlight = None, kill_on_cancel: bool = True):
         """
         # 获取neo4j的操作连接，在获取之前必须保证 :class:`Neo4jConnect.__init__`被初始化
+        :param one_trip: select默认是否使用单次往返的分页查询，详细见 :class:`Neo4jDao.select_page`
+        :param cache: 查询结果缓存，为None时不缓存
+        :param cache_methods: 开启缓存的查询方法名，例如["get_parent_debt", "get_parent_ring"]
+        :param ring_backend: 环查询默认使用的后端，"cypher"为neo4j的变长路径查询，"memory"为 :class:`DebtGraph`
+        :param pool: 连接池，为None时使用 :class:`Neo4jPool.install`设置的全局连接池，都没有时使用共享的连接
+        :param hooks: 查询统计钩子，为None时使用 :data:`default_hooks`
+        :param flight: 合并同时到达的相同查询，为None时使用 :class:`SingleFlight.install`设置的全局SingleFlight，
+        都没有时不合并
+        :param kill_on_cancel: 请求取消时是否终止它正在执行的查询，详细见 :class:`Neo4jDao.kill_queries`
         """
         self.connect: Graph = Neo4jConnect.get_connect()
+        self.pool: Neo4jPool = pool if pool is not None else Neo4jPool.get_pool()
+        self.one_trip: bool = one_trip
+        self.cache: QueryCache = cache
+        self.cache_methods: set = set(cache_methods)
+        self.ring_backend: str = ring_backend
+        self.snapshot: DebtGraph = None
+        self.rollup: DebtRollup = None
+        self.hooks: List[Callable[[dict], None]] = hooks if hooks is not None else default_hooks
+        self.flight: SingleFlight = flight if flight is not None else SingleFlight.get_flight()
+        self.kill_on_cancel: bool = kill_on_cancel
+        # 终止查询使用单独的连接和线程，不占用连接池，连接池耗尽时也能终止查询
+        self._admin: Graph = None
+        self._admin_lock = threading.Lock()
+        self._killer: ThreadPoolExecutor = None
+        # 终止查询使用的语法，"transactions"或"procedures"，None时先尝试"transactions"
+        self._kill_dialect: str = None
+
+    def _session(self):
+        """
+        # 获取本次查询使用的连接，有连接池时从池中取出，with语句结束时归还
+        """
+        if self.pool is not None:
+            return self.pool.session()
+        return nullcontext(self.connect)
+
+    def _run_params(self, params: dict, cancel: CancelToken = None) -> dict:
+        """
+        # 执行查询时使用的参数，当前请求有取消令牌时加上 :data:`CANCEL_PARAM`，取消时据此终止查询
+        """
+        if cancel is None:
+            cancel = current_cancel.get()
+        if cancel is None or not self.kill_on_cancel:
+            return params
+        return dict(params, **{CANCEL_PARAM: cancel.request_id})
+
+    def kill_queries(self, request_id: str) -> Future:
+        """
+        # 终止某个请求正在执行的查询，请求取消时自动调用。在单独的线程中通过管理连接执行，不等待结果，
+        # 取消请求的一方(例如CancelToken.cancel)不会被阻塞；失败时只能等待查询结束，之后的查询仍然会被取消
+        :param request_id: 请求id
+        :return: 终止的查询数的Future，失败时为0
+        """
+        with self._admin_lock:
+            if self._killer is None:
+                self._killer = ThreadPoolExecutor(1, thread_name_prefix="neo4j-kill")
+        return self._killer.submit(self._kill_logged, request_id)
+
+    def _kill_logged(self, request_id: str) -> int:
+        try:
+            return self._kill(request_id)
+        except Exception as e:
+            print(f"killing queries of request {request_id} failed: {e}")
+            return 0
+
+    def _admin_graph(self) -> Graph:
+        """
+        # 终止查询使用的连接，第一次使用时按连接池的配置单独创建，没有连接池时使用共享的连接
+        """
+        if self._admin is None:
+            self._admin = self.pool.factory() if self.pool is not None else self.connect
+        return self._admin
+
+    def _kill(self, request_id: str) -> int:
+        """
+        # 按neo4j的版本终止查询：先使用SHOW/TERMINATE TRANSACTIONS，不支持时改用dbms.listQueries/dbms.killQuery，
+        # 之后一直使用可用的语法
+        """
+        graph = self._admin_graph()
+        if self._kill_dialect != "procedures":
+            try:
+                ids: list = graph.run(SHOW_TX_CQL, request_id=request_id).evaluate() or []
+                self._kill_dialect = "transactions"
+                return len(graph.run(TERMINATE_TX_CQL, ids=ids).data()) if ids else 0
+            except Exception:
+                if self._kill_dialect == "transactions":
+                    raise
+                self._kill_dialect = "procedures"
+        return graph.run(KILL_CQL, request_id=request_id).evaluate() or 0
+
+    def load_snapshot(self) -> DebtGraph:
+        """
+        # 从neo4j导入债务图快照，供ring_backend="memory"的环查询使用，债务图重新导入后需要再次调用
+        :return: 债务图快照
+        """
+        with self._session() as graph:
+            self.snapshot = DebtGraph.load(graph)
+        return self.snapshot
+
+    def load_rollup(self) -> DebtRollup:
+        """
+        # 从neo4j构建父节点级别的债务汇总索引。Neo4jDao没有写入债务图的方法，债务图在外部导入或写入后
+        # 需要调用 :class:`Neo4jDao.invalidate_cache`，下次查询时重新构建，HAS_PARENT的变化也会生效
+        :return: 汇总索引
+        """
+        with self._session() as graph:
+            self.rollup = DebtRollup.load(graph)
+        return self.rollup
+
+    def _ring_snapshot(self, backend: str = None) -> DebtGraph:
+        """
+        # 环查询使用内存后端时返回债务图快照(第一次使用时导入)，否则返回None
+        """
+        if (backend or self.ring_backend) != "memory":
+            return None
+        snapshot = self.snapshot
+        # 与invalidate_cache并发时使用本次构建的快照
+        return snapshot if snapshot is not None else self.load_snapshot()
+
+    def enable_cache(self, *methods: str):
+        """
+        # 为某些查询方法开启缓存，需要在初始化时传入cache
+        :param methods: 查询方法名
+        """
+        self.cache_methods.update(methods)
+
+    def invalidate_cache(self):
+        """
+        # 清空查询结果缓存并调用 :data:`invalidation_hooks`，债务图重新导入或写入后调用，
+        # 债务图快照和汇总索引同时作废，下次使用时重新从neo4j构建
+        """
+        self.snapshot = None
+        self.rollup = None
+        if self.cache is not None:
+            self.cache.invalidate()
+        for hook in invalidation_hooks:
+            hook()
+
+    def _cache_key(self, kind: str, cql: str, params: dict, skip: int = 0, limit: int = -1):
+        """
+        # 当前查询方法开启了缓存时返回缓存的key，否则返回None
+        """
+        if self.cache is None or current_method.get() not in self.cache_methods:
+            return None
+        return self.cache.make_key(kind, cql, params, skip, limit)
+
+    def _emit(self, kind: str, params: dict, rows: int = 0, data=0, db_time: float = 0,
+              serialize_time: float = 0, cached: bool = False, method: str = None):
+        """
+        # 将一次查询的统计事件发送给全部钩子
+        :param kind: 查询的种类，data、count、page或stream
+        :param params: 查询参数
+        :param rows: 返回的行数
+        :param data: 序列化得到的json字符串或已经统计好的字节数
+        :param db_time: 数据库耗时(秒)
+        :param serialize_time: 序列化耗时(秒)
+        :param cached: 是否命中缓存
+        :param method: 查询方法名，为None时使用 :data:`current_method`
+        """
+        if not self.hooks:
+            return
+        event: dict = {
+            "method": method or current_method.get() or "select",
+            "kind": kind,
+            "params": {key: len(value) if isinstance(value, (list, tuple, set)) else 1 for key, value in params.items()},
+            "jump": params.get("jump"),
+            "rows": rows,
+            "bytes": len(data.encode("utf-8")) if isinstance(data, str) else data,
+            "db_time": db_time,
+            "serialize_time": serialize_time,
+            "cached": cached,
+        }
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                print(e)
 
     @staticmethod
     def to_dict(ele):
-        if isinstance(ele, list) or isinstance(ele, tuple):
-            _ele = []
-            for i in ele:
-                _ele.append(Neo4jDao.to_dict(i))
-            return _ele
-        elif isinstance(ele, Node):
-            _ele = {}
-            for key in ele:
-                _ele[key] = Neo4jDao.to_dict(ele[key])
-            return {"Node": _ele}
-        elif str(type(ele)) == "<class 'py2neo.data.HAS_DEBT'>":
-            _ele = {}
-            for key in ele:
-                _ele[key] = Neo4jDao.to_dict(ele[key])
-            return {"HAS_DEBT": _ele}
-        elif str(type(ele)) == "<class 'py2neo.data.HAS_PARENT'>":
-            _ele = {}
-            for key in ele:
-                _ele[key] = Neo4jDao.to_dict(ele[key])
-            return {"HAS_PARENT": _ele}
-        elif isinstance(ele, dict):
-            _ele = {}
-            for key in ele:
-                _ele[key] = Neo4jDao.to_dict(ele[key])
-            return _ele
-        elif isinstance(ele, Path):
-            return Neo4jDao.to_dict(ele.__dict__['_Walkable__sequence'])
-        else:
-            return ele
-
-    def _select(self, cql: str, skip: int = 0, limit: int = -1, **kwargs) -> Tuple[Cursor, str]:
+        """
+        # 将py2neo的查询结果转换为可以json序列化的数据，详细见 :class:`Neo4jSerializer`
+        """
+        return to_jsonable(ele)
+
+    def _select(self, cql: str, skip: int = 0, limit: int = -1, group_by: str = None,
+                **kwargs) -> Tuple[Cursor, str]:
         """
         # 执行查询语句
         :param cql: 查询语句的主体
         :param skip: 跳过开头的条数
         :param limit: 限制页数
-        :return: Cursor和查询得到的数据
+        :param group_by: 按该返回项对数据分组，详细见 :class:`Neo4jDao._dumps`
+        :return: Cursor和查询得到的数据，命中缓存时Cursor为None
+        """
+        key = self._cache_key(f"data/{group_by}", cql, kwargs, skip, limit)
+        if key is not None:
+            hit, data = self.cache.get(key)
+            if hit:
+                self._emit("data", kwargs, cached=True)
+                return None, data
+        cql += f" SKIP {skip}"
+        if limit > 0:
+            cql += f" LIMIT {limit}"
+        start = time.perf_counter()
+        with self._session() as graph:
+            cursor = graph.run(cql, **self._run_params(kwargs))
+            _data: list = cursor.data()
+        fetched = time.perf_counter()
+        data: str = self._dumps(_data, group_by)
+        self._emit("data", kwargs, len(_data), data, fetched - start, time.perf_counter() - fetched)
+        if key is not None:
+            self.cache.put(key, data)
+        return cursor, data
+
+    def _dumps(self, _data: list, group_by: str = None) -> str:
+        """
+        # 将查询得到的数据序列化为json字符串
+        :param _data: cursor.data()得到的数据
+        :param group_by: 不为None时按该返回项分组，得到{分组值: [去掉该返回项的数据]}
+        :return: json字符串
+        """
+        if group_by is not None:
+            groups: dict = {}
+            for row in _data:
+                row = dict(row)
+                groups.setdefault(row.pop(group_by), []).append(row)
+            _data = groups
+        return dumps(_data)
+
+    @staticmethod
+    def split_return(cql: str) -> Tuple[str, List[str]]:
+        """
+        # 将查询语句拆分为RETURN之前的主体和RETURN的各个返回项的别名
+        :param cql: 查询语句
+        :return: 主体和别名列表，例如"RETURN child, edge AS e"得到["child", "e"]
+        """
+        body, _, returns = cql.rpartition("RETURN")
+        aliases: List[str] = []
+        for item in returns.split(","):
+            item = item.strip()
+            parts = item.rsplit(" AS ", 1) if " AS " in item else item.rsplit(" as ", 1)
+            aliases.append(parts[-1].strip())
+        return body, aliases
+
+    def select_page(self, cql: str, skip: int = 0, limit: int = -1, group_by: str = None,
+                    **kwargs) -> Tuple[list, str]:
+        """
+        # 单次往返的分页查询，在同一次执行中得到总数和所需的那一页数据
+        # 将"MATCH ... RETURN a, b"改写为"MATCH ... WITH collect({a: a, b: b}) AS rows
+        # RETURN size(rows) AS total, rows[skip..skip+limit] AS page"，图只遍历一次
+        :param cql: 查询语句的主体，RETURN的返回项必须是变量或带AS别名的表达式
+        :param skip: 跳过开头的条数
+        :param limit: 限制页数
+        :param group_by: 按该返回项对数据分组，详细见 :class:`Neo4jDao._dumps`
+        :return: 与 :class:`Neo4jDao.select`相同的总数和数据
+        """
+        key = self._cache_key(f"page/{group_by}", cql, kwargs, skip, limit)
+        if key is not None:
+            hit, result = self.cache.get(key)
+            if hit:
+                self._emit("page", kwargs, cached=True)
+                return result
+        body, aliases = self.split_return(cql)
+        returns: str = ", ".join(f"{alias}: {alias}" for alias in aliases)
+        end: str = f"{skip} + {limit}" if limit > 0 else ""
+        cql = body + f"""
+            WITH collect({{{returns}}}) AS rows
+            RETURN size(rows) AS total, rows[{skip}..{end}] AS page
+        """
+        start = time.perf_counter()
+        with self._session() as graph:
+            record: list = graph.run(cql, **self._run_params(kwargs)).data()
+        fetched = time.perf_counter()
+        page: list = record[0]["page"] if record else []
+        result = [{"total": record[0]["total"] if record else 0}], self._dumps(page, group_by)
+        self._emit("page", kwargs, len(page), result[1], fetched - start, time.perf_counter() - fetched)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def _iter(self, cql: str, skip: int, limit: int, ndjson: bool, params: dict, method: str,
+              cancel: CancelToken = None) -> Iterator:
+        """
+        # :class:`Neo4jDao.iter_select`和 :class:`Neo4jDao.iter_ndjson`的实现，结束时发送统计事件，
+        # 生成器在查询方法返回后才执行，因此方法名和请求的取消令牌由调用方传入，每返回一条记录前检查是否取消
         """
         cql += f" SKIP {skip}"
         if limit > 0:
             cql += f" LIMIT {limit}"
-        cursor = self.connect.run(cql, **kwargs)
-        _data: list = cursor.data()
+        rows, size, serialize_time = 0, 0, 0
+        start = time.perf_counter()
         try:
-            data: str = json.dumps(_data, ensure_ascii=False)
-        except TypeError as e:
-            print(e)
-            data: str = json.dumps(self.to_dict(_data), ensure_ascii=False)
-        return cursor, data
+            with self._session() as graph:
+                for record in graph.run(cql, **self._run_params(params, cancel)):
+                    if cancel is not None:
+                        cancel.check()
+                    begin = time.perf_counter()
+                    item = to_jsonable(record.data())
+                    if ndjson:
+                        item = dumps(item) + "\n"
+                        size += len(item.encode("utf-8"))
+                    serialize_time += time.perf_counter() - begin
+                    rows += 1
+                    yield item
+        finally:
+            elapsed = time.perf_counter() - start
+            self._emit("stream", params, rows, size, elapsed - serialize_time, serialize_time, method=method)
+
+    def iter_select(self, cql: str, skip: int = 0, limit: int = -1, **kwargs) -> Iterator[dict]:
+        """
+        # 以生成器的形式执行查询语句，逐条返回cursor上的记录，不一次性物化全部结果
+        :param cql: 查询语句的主体
+        :param skip: 跳过开头的条数
+        :param limit: 限制页数
+        :return: 可以json序列化的记录
+        """
+        return self._iter(cql, skip, limit, False, kwargs, current_method.get(), current_cancel.get())
 
-    def select(self, cql: str, skip: int = 0, limit: int = -1, **kwargs) -> Tuple[dict, str]:
+    def iter_ndjson(self, cql: str, skip: int = 0, limit: int = -1, **kwargs) -> Iterator[str]:
+        """
+        # 以NDJSON的形式逐条返回查询结果，每一行是一条记录的json
+        :param cql: 查询语句的主体
+        :param skip: 跳过开头的条数
+        :param limit: 限制页数
+        :return: 以换行结尾的json字符串
+        """
+        return self._iter(cql, skip, limit, True, kwargs, current_method.get(), current_cancel.get())
+
+    def select_keyset(self, cql: str, order_key: str, after: str = "", limit: int = -1, group_by: str = None,
+                      **kwargs) -> Tuple[str, str]:
+        """
+        # keyset分页查询，按order_key排序，只返回排序键大于上一页最后一条记录的结果，
+        # 不像SKIP那样扫描并丢弃前面的全部记录，第N页与第1页的代价相同
+        # 将"MATCH ... RETURN a, b"改写为"MATCH ... WITH a, b, order_key AS page_key WHERE page_key > $after_key
+        # RETURN a, b, page_key ORDER BY page_key LIMIT limit"
+        :param cql: 查询语句的主体
+        :param order_key: 唯一且稳定的排序表达式，应当是内部id或有索引的属性，例如 :data:`EDGE_KEY`
+        :param after: 续页token，空字符串表示第一页
+        :param limit: 限制页数
+        :param group_by: 按该返回项对数据分组，详细见 :class:`Neo4jDao._dumps`
+        :return: 查询得到的数据和下一页的token，没有下一页时token为None
+        """
+        after_key = decode_token(after)
+        params: dict = dict(kwargs, after_key=after_key)
+        key = self._cache_key(f"keyset/{group_by}", cql, params, 0, limit)
+        if key is not None:
+            hit, result = self.cache.get(key)
+            if hit:
+                self._emit("keyset", kwargs, cached=True)
+                return result
+        body, returns = cql.rsplit("RETURN", 1)
+        _, aliases = self.split_return(cql)
+        cql = body + f"""
+            WITH {returns.strip()}, {order_key} AS page_key
+            WHERE $after_key IS NULL OR page_key > $after_key
+            RETURN {", ".join(aliases)}, page_key
+            ORDER BY page_key
+        """
+        if limit > 0:
+            cql += f" LIMIT {limit}"
+        start = time.perf_counter()
+        with self._session() as graph:
+            _data: list = graph.run(cql, **self._run_params(params)).data()
+        fetched = time.perf_counter()
+        next_token = encode_token(_data[-1]["page_key"]) if limit > 0 and len(_data) == limit else None
+        for row in _data:
+            del row["page_key"]
+        result = self._dumps(_data, group_by), next_token
+        self._emit("keyset", kwargs, len(_data), result[0], fetched - start, time.perf_counter() - fetched)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def select(self, cql: str, skip: int = 0, limit: int = -1, one_trip: bool = None, stream: bool = None,
+               group_by: str = None, order_key: str = None, after: str = None, with_total: bool = None,
+               **kwargs) -> Tuple[dict, str]:
         """
         # 融合:class:`Neo4jDao._select`，和:class:`Neo4jDao.select_count`
         :param cql:
         :param skip:
         :param limit:
+        :param one_trip: 是否使用 :class:`Neo4jDao.select_page`单次往返查询，None时使用初始化时的设置
+        :param stream: 是否以 :class:`Neo4jDao.iter_ndjson`的流返回数据，None时使用 :func:`streaming`的设置，
+        流模式下不查询总数，返回的总数为None，也不使用缓存
+        :param group_by: 按该返回项对数据分组，详细见 :class:`Neo4jDao._dumps`，流模式下不分组
+        :param order_key: keyset分页的排序键，详细见 :class:`Neo4jDao.select_keyset`
+        :param after: 续页token，不为None时使用keyset分页并忽略skip，空字符串表示第一页，
+        None时使用 :func:`paging`的设置，返回的总数中"next"为下一页的token
+        :param with_total: keyset分页时是否查询总数，None时只在第一页查询，之后的页总数为None
         :param kwargs:
         :return:
         """
+        if order_key is not None:
+            after = resolve_after(after)
+        if order_key is not None and after is not None:
+            data, next_token = self.select_keyset(cql, order_key, after, limit=limit, group_by=group_by, **kwargs)
+            set_next(next_token)
+            total: int = None
+            if with_total or with_total is None and not after:
+                count: list = self.select_count(cql, **kwargs)
+                total = count[0]["total"] if count else 0
+            return [{"total": total, "next": next_token}], data
+        if stream is None:
+            stream = stream_mode.get()
+        if stream:
+            return None, self.iter_ndjson(cql, skip=skip, limit=limit, **kwargs)
+        if one_trip is None:
+            one_trip = self.one_trip
+        if one_trip:
+            return self.select_page(cql, skip=skip, limit=limit, group_by=group_by, **kwargs)
         count: dict = self.select_count(cql, **kwargs)
-        _, data = self._select(cql, skip=skip, limit=limit, **kwargs)
+        _, data = self._select(cql, skip=skip, limit=limit, group_by=group_by, **kwargs)
         return count, data
 
     def select_count(self, cql: str, **kwargs) -> dict:
@@ -89,10 +559,22 @@ class Neo4jDao:
         :param cql: 查询语句
         :return: {'total': num}
         """
+        key = self._cache_key("count", cql, kwargs)
+        if key is not None:
+            hit, count = self.cache.get(key)
+            if hit:
+                self._emit("count", kwargs, cached=True)
+                return count
         cql = cql.split("RETURN")[0] + " RETURN COUNT(*) AS total"
-        cursor = self.connect.run(cql, **kwargs)
-        return cursor.data()
+        start = time.perf_counter()
+        with self._session() as graph:
+            count: list = graph.run(cql, **self._run_params(kwargs)).data()
+        self._emit("count", kwargs, db_time=time.perf_counter() - start)
+        if key is not None:
+            self.cache.put(key, count)
+        return count
 
+    @query_method
     def get_parent_node(self, children: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询某些节点的父节点
@@ -106,9 +588,10 @@ class Neo4jDao:
             WHERE child.name IN $children
             RETURN child, edge, parent
         """
-        count, data = self.select(cql, *args, children=children, **kwargs)
+        count, data = self.select(cql, *args, children=children, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_node(self, parents: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询某些父节点的全部子节点
@@ -122,9 +605,10 @@ class Neo4jDao:
             WHERE parent.name IN $parents
             RETURN child, edge, parent
         """
-        count, data = self.select(cql, *args, parents=parents, **kwargs)
+        count, data = self.select(cql, *args, parents=parents, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_receivables(self, child: str, *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询某个子节点的应收账款
@@ -138,9 +622,10 @@ class Neo4jDao:
             WHERE child.name = $child
             RETURN other, edge, child
         """
-        count, data = self.select(cql, *args, child=child, **kwargs)
+        count, data = self.select(cql, *args, child=child, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_debt(self, child: str, *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询某个子节点的欠款
@@ -154,9 +639,10 @@ class Neo4jDao:
             WHERE child.name = $child
             RETURN child, edge, other
         """
-        count, data = self.select(cql, *args, child=child, **kwargs)
+        count, data = self.select(cql, *args, child=child, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_parent_receivables(self, parent: str, *args, **kwargs) -> Tuple[dict, str]:
         """
         # 获取某个父节点的全部应收账款
@@ -172,9 +658,10 @@ class Neo4jDao:
             MATCH (other:Level2)-[edge:HAS_DEBT]->(child)
             RETURN other, edge, child
         """
-        count, data = self.select(cql, *args, parent=parent, **kwargs)
+        count, data = self.select(cql, *args, parent=parent, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_parent_debt(self, parent: str, *args, **kwargs) -> Tuple[dict, str]:
         """
         # 获取某个父节点的全部债务
@@ -190,9 +677,42 @@ class Neo4jDao:
             MATCH (child)-[edge:HAS_DEBT]->(other:Level2)
             RETURN child, edge, other
         """
-        count, data = self.select(cql, *args, parent=parent, **kwargs)
+        count, data = self.select(cql, *args, parent=parent, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
+    def get_parent_debt_rollup(self, parent: str, details: List[str] = None, *args, **kwargs) -> Tuple[list, str]:
+        """
+        # 从汇总索引查询某个父节点对各个父节点、按s_detail汇总的欠款，明细通过 :class:`Neo4jDao.get_parent_debt`查询
+        :param parent: 父节点名称
+        :param details: 债务类别list，None时返回全部类别
+        :param args: skip和limit，详细见 :class:`Neo4jDao.select`
+        :param kwargs: skip和limit，详细见 :class:`Neo4jDao.select`
+        :return: 总数和[{"parent", "counterparty", "s_detail", "money", "count"}]
+        """
+        rollup = self.rollup
+        if rollup is None:
+            rollup = self.load_rollup()
+        return rollup.get_parent_debt(parent, details, *args, **kwargs)
+
+    @query_method
+    def get_parent_receivables_rollup(self, parent: str, details: List[str] = None, *args,
+                                      **kwargs) -> Tuple[list, str]:
+        """
+        # 从汇总索引查询某个父节点来自各个父节点、按s_detail汇总的应收账款，
+        # 明细通过 :class:`Neo4jDao.get_parent_receivables`查询
+        :param parent: 父节点名称
+        :param details: 债务类别list，None时返回全部类别
+        :param args: skip和limit，详细见 :class:`Neo4jDao.select`
+        :param kwargs: skip和limit，详细见 :class:`Neo4jDao.select`
+        :return: 总数和[{"parent", "counterparty", "s_detail", "money", "count"}]
+        """
+        rollup = self.rollup
+        if rollup is None:
+            rollup = self.load_rollup()
+        return rollup.get_parent_receivables(parent, details, *args, **kwargs)
+
+    @query_method
     def get_parent_debt_by_details(self, parent: str, details: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 根据details查询某个父节点的全部债务
@@ -210,9 +730,10 @@ class Neo4jDao:
             WHERE edge.s_detail in $details
             RETURN child, edge, other
         """
-        count, data = self.select(cql, parent=parent, details=details, *args, **kwargs)
+        count, data = self.select(cql, parent=parent, details=details, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_parent_receivables_by_details(self, parent: str, details: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 根据details查询某个父节点的全部应收账款
@@ -230,9 +751,10 @@ class Neo4jDao:
             WHERE edge.s_detail in $details
             RETURN other, edge, child
         """
-        count, data = self.select(cql, parent=parent, details=details, *args, **kwargs)
+        count, data = self.select(cql, parent=parent, details=details, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_debt_by_details(self, child: str, details: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 根据details查询某个子节点的全部欠款
@@ -247,9 +769,10 @@ class Neo4jDao:
             WHERE child.name = $child AND edge.s_detail in $details
             RETURN child, edge, other
         """
-        count, data = self.select(cql, child=child, details=details, *args, **kwargs)
+        count, data = self.select(cql, child=child, details=details, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_receivables_by_details(self, child: str, details: List[str], *args, **kwargs) -> Tuple[dict, str]:
         """
         # 根据details查询某个子节点的全部应收账款
@@ -264,35 +787,45 @@ class Neo4jDao:
             WHERE child.name = $child AND edge.s_detail in $details
             RETURN other, edge, child
         """
-        count, data = self.select(cql, child=child, details=details, *args, **kwargs)
+        count, data = self.select(cql, child=child, details=details, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
-    def get_child_ring(self, child: str, *args, jump: int = 2, **kwargs) -> Tuple[dict, str]:
+    @query_method
+    def get_child_ring(self, child: str, *args, jump: int = 2, backend: str = None, **kwargs) -> Tuple[dict, str]:
         """
         # 获得某个子节点的存在的环，环有几条边通过jump控制
         :param child: 子节点名称
         :param args: 详细见 :class:`Neo4jDao.select`
         :param jump: 环的边的数目
+        :param backend: "cypher"或"memory"，None时使用初始化时的ring_backend
         :param kwargs: 详细见 :class:`Neo4jDao.select`
         :return: 返回环的信息
         """
+        snapshot = self._ring_snapshot(backend)
+        if snapshot is not None:
+            return snapshot.get_child_ring(child, jump, *args, **kwargs)
         cql: str = f"""
             MATCH path=(child:Level2)-[*{jump}]->(child:Level2)
             WHERE child.name = $child AND SIZE(apoc.coll.toSet(nodes(path))) = $jump
             RETURN path
         """
-        count, data = self.select(cql, child=child, jump=jump, *args, **kwargs)
+        count, data = self.select(cql, child=child, jump=jump, *args, order_key=PATH_KEY, **kwargs)
         return count, data
 
-    def get_parent_ring(self, parent: str, *args, jump: int = 2, **kwargs) -> Tuple[dict, str]:
+    @query_method
+    def get_parent_ring(self, parent: str, *args, jump: int = 2, backend: str = None, **kwargs) -> Tuple[dict, str]:
         """
         # 查询某个父节点的全部子节点所存在的jump个边环的信息
         :param parent: 父节点名称
         :param args: 详细见 :class:`Neo4jDao.select`
         :param jump: 环的边的数目
+        :param backend: "cypher"或"memory"，None时使用初始化时的ring_backend
         :param kwargs: 详细见 :class:`Neo4jDao.select`
         :return: 返回环的信息
         """
+        snapshot = self._ring_snapshot(backend)
+        if snapshot is not None:
+            return snapshot.get_parent_ring(parent, jump, *args, **kwargs)
         cql: str = f"""
             MATCH (child:Level2)-[edge:HAS_PARENT]->(parent:Level1)
             WHERE parent.name = $parent
@@ -301,37 +834,49 @@ class Neo4jDao:
             WHERE SIZE(apoc.coll.toSet(nodes(path))) = $jump
             RETURN path, child, edge, parent
         """
-        count, data = self.select(cql, parent=parent, jump=jump, *args, **kwargs)
+        count, data = self.select(cql, parent=parent, jump=jump, *args, order_key=PATH_KEY, **kwargs)
         return count, data
 
-    def get_child_with_child_ring(self, child1: str, child2: str, jump: int = 2, *args, **kwargs) -> Tuple[dict, str]:
+    @query_method
+    def get_child_with_child_ring(self, child1: str, child2: str, jump: int = 2, *args, backend: str = None,
+                                  **kwargs) -> Tuple[dict, str]:
         """
         # 查询child1->...child2->...child1存在的jump边的环
         :param child1: 子节点1的名称
         :param child2: 子节点2的名称
         :param args: 详细见 :class:`Neo4jDao.select`
         :param jump: 环的边的数目
+        :param backend: "cypher"或"memory"，None时使用初始化时的ring_backend
         :param kwargs: 详细见 :class:`Neo4jDao.select`
         :return: 返回环的信息
         """
+        snapshot = self._ring_snapshot(backend)
+        if snapshot is not None:
+            return snapshot.get_child_with_child_ring(child1, child2, jump, *args, **kwargs)
         cql: str = f"""
             MATCH path=(child:Level2)-[*{jump}]->(child:Level2)
             WHERE child.name = $child1 AND SIZE(apoc.coll.toSet(nodes(path))) = $jump AND ANY(n IN nodes(path) WHERE n.name=$child2)
             RETURN path
         """
-        count, data = self.select(cql, child1=child1, child2=child2, jump=jump, *args, **kwargs)
+        count, data = self.select(cql, child1=child1, child2=child2, jump=jump, *args, order_key=PATH_KEY, **kwargs)
         return count, data
 
-    def get_parent_with_parent_ring(self, parent1: str, parent2: str, jump: int = 2, *args, **kwargs) -> Tuple[dict, str]:
+    @query_method
+    def get_parent_with_parent_ring(self, parent1: str, parent2: str, jump: int = 2, *args, backend: str = None,
+                                    **kwargs) -> Tuple[dict, str]:
         """
         # 查询两个父节点之间子节点存在的jump个边的环信息
         :param parent1: 父节点1的名称
         :param parent2: 父节点2的名称
         :param args: 详细见 :class:`Neo4jDao.select`
         :param jump: 环的边的数目
+        :param backend: "cypher"或"memory"，None时使用初始化时的ring_backend
         :param kwargs: 详细见 :class:`Neo4jDao.select`
         :return: 返回环的信息
         """
+        snapshot = self._ring_snapshot(backend)
+        if snapshot is not None:
+            return snapshot.get_parent_with_parent_ring(parent1, parent2, jump, *args, **kwargs)
         cql: str = f"""
             MATCH (child1:Level2)-[]->(parent1:Level1)
             WHERE parent1.name = $parent1
@@ -342,9 +887,10 @@ class Neo4jDao:
             WHERE SIZE(apoc.coll.toSet(nodes(path))) = $jump AND ANY(n IN nodes(path) WHERE n=child2)
             RETURN path,child1, child2,parent1,parent2
         """
-        count, data = self.select(cql, parent1=parent1, parent2=parent2, jump=jump, *args, **kwargs)
+        count, data = self.select(cql, parent1=parent1, parent2=parent2, jump=jump, *args, order_key=RING_PAIR_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_to_child_debt(self, child1: str, child2: str, *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询从child1到child2的欠债
@@ -359,9 +905,10 @@ class Neo4jDao:
             WHERE child1.name = $child1 AND child2.name = $child2
             RETURN child1, edge, child2
         """
-        count, data = self.select(cql, child1=child1, child2=child2, *args, **kwargs)
+        count, data = self.select(cql, child1=child1, child2=child2, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_parent_to_parent_debt(self, parent1: str, parent2: str,  *args, **kwargs) -> Tuple[dict, str]:
         """
         # 查询父节点1到父节点2的欠债
@@ -380,16 +927,72 @@ class Neo4jDao:
             MATCH (child1:Level2)-[edge:HAS_DEBT]->(child2:Level2)
             RETURN parent1, child1, edge, parent2, child2
         """
-        count, data = self.select(cql, parent1=parent1, parent2=parent2, *args, **kwargs)
+        count, data = self.select(cql, parent1=parent1, parent2=parent2, *args, order_key=EDGE_KEY, **kwargs)
         return count, data
 
+    @query_method
     def get_child_to_child_debt_by_details(self, child1: str, child2: str, details: List[str], *args, **kwargs):
         cql: str = """
             MATCH (child1:Level2)-[edge:HAS_DEBT]->(child2:Level2)
             WHERE child1.name = $child1 AND child2.name = $child2 AND edge.s_detail in $details
             RETURN child1, edge, child2
         """
-        count, data = self.select(cql, child1=child1, child2=child2, details=details, *args, **kwargs)
+        count, data = self.select(cql, child1=child1, child2=child2, details=details, *args, order_key=EDGE_KEY, **kwargs)
+        return count, data
+
+    @query_method
+    def get_child_debt_batch(self, children: List[str], *args, **kwargs) -> Tuple[dict, str]:
+        """
+        # 一次查询多个子节点的欠款，结果按子节点名称分组
+        :param children: 子节点名称列表
+        :param args: 详细见 :class:`Neo4jDao.select`
+        :param kwargs: 详细见 :class:`Neo4jDao.select`
+        :return: 总数和{子节点名称: 欠款}，分页作用于全部子节点的结果
+        """
+        cql: str = """
+            UNWIND $children AS name
+            MATCH (child:Level2)-[edge:HAS_DEBT]->(other:Level2)
+            WHERE child.name = name
+            RETURN name, child, edge, other
+        """
+        count, data = self.select(cql, *args, children=children, group_by="name", order_key=EDGE_KEY, **kwargs)
+        return count, data
+
+    @query_method
+    def get_child_receivables_batch(self, children: List[str], *args, **kwargs) -> Tuple[dict, str]:
+        """
+        # 一次查询多个子节点的应收账款，结果按子节点名称分组
+        :param children: 子节点名称列表
+        :param args: 详细见 :class:`Neo4jDao.select`
+        :param kwargs: 详细见 :class:`Neo4jDao.select`
+        :return: 总数和{子节点名称: 应收账款}，分页作用于全部子节点的结果
+        """
+        cql: str = """
+            UNWIND $children AS name
+            MATCH (other:Level2)-[edge:HAS_DEBT]->(child:Level2)
+            WHERE child.name = name
+            RETURN name, other, edge, child
+        """
+        count, data = self.select(cql, *args, children=children, group_by="name", order_key=EDGE_KEY, **kwargs)
+        return count, data
+
+    @query_method
+    def get_child_to_child_debt_batch(self, pairs: List[Tuple[str, str]], *args, **kwargs) -> Tuple[dict, str]:
+        """
+        # 一次查询多对子节点之间的欠债，结果按"child1->child2"分组
+        :param pairs: (子节点1名称, 子节点2名称)的列表
+        :param args: 详细见 :class:`Neo4jDao.select`
+        :param kwargs: 详细见 :class:`Neo4jDao.select`
+        :return: 总数和{"child1->child2": 欠债}，分页作用于全部节点对的结果
+        """
+        cql: str = """
+            UNWIND $pairs AS pair
+            MATCH (child1:Level2)-[edge:HAS_DEBT]->(child2:Level2)
+            WHERE child1.name = pair[0] AND child2.name = pair[1]
+            RETURN pair[0] + "->" + pair[1] AS name, child1, edge, child2
+        """
+        pairs = [list(pair) for pair in pairs]
+        count, data = self.select(cql, *args, pairs=pairs, group_by="name", order_key=EDGE_KEY, **kwargs)
         return count, data
 
 
@@ -0,0 +1,372 @@
+"""
+Neo4jDao的基准测试，使用本地的替身图(StandInGraph)模拟neo4j的往返延迟和遍历耗时，
+不需要真实的neo4j服务
+使用方式 python neo4j_dao_benchmark.py page --rows 20000 --repeat 20
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from unittest import mock
+
+import neo4j_dao
+from neo4j_dao import Neo4jDao
+from neo4j_cache import QueryCache
+from neo4j_serializer import dumps
+from debt_graph import DebtGraph
+from neo4j_pool import Neo4jPool
+from single_flight import SingleFlight
+from py2neo import Path
+from py2neo.data import Node, Relationship
+
+
+class StandInCursor:
+    """
+    模拟py2neo的Cursor，只实现Neo4jDao用到的接口
+    """
+
+    def __init__(self, records: List[dict]):
+        self.records: List[dict] = records
+
+    def data(self) -> List[dict]:
+        return self.records
+
+    def __iter__(self):
+        return (StandInRecord(record) for record in self.records)
+
+
+class StandInRecord(dict):
+    """
+    模拟py2neo的Record
+    """
+
+    def data(self) -> dict:
+        return dict(self)
+
+
+class StandInGraph:
+    """
+    本地替身图，每次run计为一次往返，耗时为 latency + 遍历行数 * row_cost，
+    同一个连接上的查询互斥执行，模拟共用一个连接时的排队
+    """
+
+    def __init__(self, rows: List[dict], latency: float = 0.002, row_cost: float = 1e-6):
+        """
+        :param rows: 查询主体匹配到的全部行
+        :param latency: 每次往返的网络延迟(秒)
+        :param row_cost: 服务端每遍历一行的耗时(秒)
+        """
+        self.rows: List[dict] = rows
+        self.latency: float = latency
+        self.row_cost: float = row_cost
+        self.round_trips: int = 0
+        self._lock = threading.Lock()
+
+    def run(self, cql: str, **kwargs) -> StandInCursor:
+        with self._lock:
+            self.round_trips += 1
+            time.sleep(self.latency + len(self.rows) * self.row_cost)
+        total: int = len(self.rows)
+        if "COUNT(*) AS total" in cql:
+            return StandInCursor([{"total": total}])
+        if "page_key" in cql:
+            after_key = kwargs.get("after_key")
+            start = 0 if after_key is None else after_key + 1
+            limit = re.search(r"LIMIT (\d+)", cql)
+            end = start + int(limit.group(1)) if limit else total
+            return StandInCursor([dict(row, page_key=i) for i, row in enumerate(self.rows[start:end], start)])
+        page = re.search(r"rows\[(\d+)\.\.(?:(\d+) \+ (\d+))?\]", cql)
+        if page:
+            start: int = int(page.group(1))
+            end: int = int(page.group(2)) + int(page.group(3)) if page.group(2) else total
+            return StandInCursor([{"total": total, "page": self.rows[start:end]}])
+        skip = re.search(r"SKIP (\d+)", cql)
+        limit = re.search(r"LIMIT (\d+)", cql)
+        start = int(skip.group(1)) if skip else 0
+        end = start + int(limit.group(1)) if limit else total
+        return StandInCursor(self.rows[start:end])
+
+
+def make_rows(num: int) -> List[dict]:
+    """
+    # 生成 child-edge-other 形式的替身数据
+    """
+    return [
+        {
+            "child": {"name": f"child{i % 100}"},
+            "edge": {"money": float(i), "s_detail": "通用"},
+            "other": {"name": f"other{i}"},
+        }
+        for i in range(num)
+    ]
+
+
+def make_dao(graph: StandInGraph, **kwargs) -> Neo4jDao:
+    """
+    # 使用替身图构造Neo4jDao
+    """
+    with mock.patch.object(neo4j_dao.Neo4jConnect, "get_connect", return_value=graph):
+        return Neo4jDao(**kwargs)
+
+
+def bench_page(rows: int, repeat: int, limit: int):
+    """
+    # 比较两次查询(COUNT + SKIP/LIMIT)和单次往返分页查询的往返次数与耗时
+    """
+    graph = StandInGraph(make_rows(rows))
+    for one_trip in (False, True):
+        dao = make_dao(graph)
+        graph.round_trips = 0
+        start = time.perf_counter()
+        for i in range(repeat):
+            dao.get_parent_debt("parent", skip=i * limit, limit=limit, one_trip=one_trip)
+        elapsed = time.perf_counter() - start
+        mode = "one_trip" if one_trip else "two_query"
+        print(f"{mode:>10}: round_trips={graph.round_trips} wall={elapsed * 1000:.1f}ms "
+              f"per_call={elapsed / repeat * 1000:.2f}ms")
+
+
+def bench_cache(rows: int, repeat: int, limit: int):
+    """
+    # 比较开启缓存前后重复查询同一热点实体的耗时
+    """
+    graph = StandInGraph(make_rows(rows))
+    for cached in (False, True):
+        dao = make_dao(graph, cache=QueryCache(), cache_methods=["get_parent_debt"] if cached else [])
+        graph.round_trips = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            dao.get_parent_debt("parent", limit=limit)
+        elapsed = time.perf_counter() - start
+        mode = "cached" if cached else "uncached"
+        print(f"{mode:>10}: round_trips={graph.round_trips} per_call={elapsed / repeat * 1e6:.1f}us "
+              f"stats={dao.cache.stats()}")
+
+
+def legacy_to_dict(ele):
+    """
+    # 替换前的递归to_dict，仅用于对比
+    """
+    if isinstance(ele, list) or isinstance(ele, tuple):
+        return [legacy_to_dict(i) for i in ele]
+    elif isinstance(ele, Node):
+        return {"Node": {key: legacy_to_dict(ele[key]) for key in ele}}
+    elif str(type(ele)) == "<class 'py2neo.data.HAS_DEBT'>":
+        return {"HAS_DEBT": {key: legacy_to_dict(ele[key]) for key in ele}}
+    elif str(type(ele)) == "<class 'py2neo.data.HAS_PARENT'>":
+        return {"HAS_PARENT": {key: legacy_to_dict(ele[key]) for key in ele}}
+    elif isinstance(ele, dict):
+        return {key: legacy_to_dict(ele[key]) for key in ele}
+    elif isinstance(ele, Path):
+        return legacy_to_dict(ele.__dict__['_Walkable__sequence'])
+    else:
+        return ele
+
+
+def legacy_dumps(_data: list) -> str:
+    try:
+        return json.dumps(_data, ensure_ascii=False)
+    except TypeError:
+        return json.dumps(legacy_to_dict(_data), ensure_ascii=False)
+
+
+def make_ring_rows(num: int, jump: int) -> List[dict]:
+    """
+    # 生成环查询形式的py2neo数据，每条路径的首尾为同一个节点
+    """
+    has_debt = Relationship.type("HAS_DEBT")
+    nodes = [Node("Level2", name=f"公司{i}", number=str(i), label="子公司") for i in range(num + jump)]
+    rows = []
+    for i in range(num):
+        ring = nodes[i:i + jump] + [nodes[i]]
+        entities = [ring[0]]
+        for a, b in zip(ring, ring[1:]):
+            entities += [has_debt(a, b, money=1.0, s_detail="通用", p_name="项目"), b]
+        rows.append({"path": Path(*entities)})
+    return rows
+
+
+def bench_serialize(rows: int, repeat: int, jump: int):
+    """
+    # 比较替换前的两次序列化和单次分派序列化的耗时
+    """
+    data = make_ring_rows(rows, jump)
+    assert json.loads(legacy_dumps(data)) == json.loads(dumps(data))
+    for name, func in (("legacy", legacy_dumps), ("typed", dumps)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(data)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: per_call={elapsed / repeat * 1000:.2f}ms")
+
+
+def bench_stream(rows: int):
+    """
+    # 比较一次性物化(select)和流式(iter_ndjson)的峰值内存与首条数据的时间
+    """
+    graph = StandInGraph(make_rows(rows), row_cost=0)
+    dao = make_dao(graph)
+    for stream in (False, True):
+        tracemalloc.start()
+        start = time.perf_counter()
+        first = None
+        if stream:
+            for _ in dao.get_parent_debt("parent", stream=True)[1]:
+                if first is None:
+                    first = time.perf_counter() - start
+        else:
+            dao.get_parent_debt("parent")
+            first = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        mode = "stream" if stream else "select"
+        print(f"{mode:>10}: peak={peak / 1024 / 1024:.1f}MB first_byte={first * 1000:.1f}ms")
+
+
+def bench_batch(rows: int):
+    """
+    # 比较N个子节点逐个查询和一次批量查询的往返次数与耗时
+    """
+    graph = StandInGraph([dict(row, name=row["child"]["name"]) for row in make_rows(rows)])
+    dao = make_dao(graph)
+    for n in (1, 10, 100):
+        children = [f"child{i}" for i in range(n)]
+        graph.round_trips = 0
+        start = time.perf_counter()
+        for child in children:
+            dao.get_child_debt(child, limit=100)
+        single = time.perf_counter() - start
+        single_trips = graph.round_trips
+        graph.round_trips = 0
+        start = time.perf_counter()
+        dao.get_child_debt_batch(children, limit=100)
+        batch = time.perf_counter() - start
+        print(f"N={n:>3}: single round_trips={single_trips} wall={single * 1000:.1f}ms | "
+              f"batch round_trips={graph.round_trips} wall={batch * 1000:.1f}ms")
+
+
+def make_debt_graph(edges: int, degree: int, seed: int = 0) -> DebtGraph:
+    """
+    # 生成随机债务图，平均出度为degree，每10个子节点属于一个父节点
+    """
+    rng = random.Random(seed)
+    num = max(edges // degree, 2)
+    children = [{"name": f"child{i}"} for i in range(num)]
+    parents = [{"name": f"parent{i}"} for i in range(num // 10 + 1)]
+    debts = [(rng.randrange(num), rng.randrange(num), {"money": 1.0}) for _ in range(edges)]
+    memberships = [(i, i // 10, {}) for i in range(num)]
+    return DebtGraph(children, parents, debts, memberships)
+
+
+def walk_rings(graph: DebtGraph, start: int, jump: int) -> int:
+    """
+    # 模拟Cypher的[*jump]展开：枚举全部边不重复的长度为jump的路径，再按首尾相同且节点数为jump过滤
+    """
+    found = 0
+    stack = [(start, [start], [])]
+    while stack:
+        u, nodes, edges = stack.pop()
+        if len(edges) == jump:
+            if u == start and len(set(nodes)) == jump:
+                found += 1
+            continue
+        for k in range(graph.indptr[u], graph.indptr[u + 1]):
+            if graph.edge_ids[k] not in edges:
+                stack.append((graph.indices[k], nodes + [graph.indices[k]], edges + [graph.edge_ids[k]]))
+    return found
+
+
+def bench_ring(jump: int, degree: int, starts: int):
+    """
+    # 比较Cypher式的变长路径展开和DebtGraph剪枝DFS在不同规模随机图上的环查询耗时
+    """
+    for edges in (10_000, 100_000, 1_000_000):
+        start = time.perf_counter()
+        graph = make_debt_graph(edges, degree)
+        build = time.perf_counter() - start
+        rng = random.Random(1)
+        sample = [rng.randrange(len(graph.children)) for _ in range(starts)]
+        start = time.perf_counter()
+        expected = sum(walk_rings(graph, i, jump) for i in sample)
+        walk = time.perf_counter() - start
+        start = time.perf_counter()
+        found = sum(1 for i in sample for _ in graph.cycles(i, jump))
+        memory = time.perf_counter() - start
+        assert found == expected, (found, expected)
+        print(f"edges={edges:>8}: build={build:.2f}s rings={found} "
+              f"cypher_expand={walk * 1000:.1f}ms memory={memory * 1000:.1f}ms")
+
+
+def bench_pool(rows: int, repeat: int, threads: int):
+    """
+    # 多线程压测：比较共用一个连接和不同大小连接池下的吞吐量与取连接等待时间
+    """
+    data = make_rows(rows)
+    for size in (0, 1, 4, 16):
+        pool = Neo4jPool(lambda: StandInGraph(data), size=size, timeout=60) if size else None
+        dao = make_dao(StandInGraph(data), pool=pool)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(lambda i: dao.get_parent_debt("parent", limit=10), range(repeat)))
+        elapsed = time.perf_counter() - start
+        mode = f"pool={size}" if size else "shared"
+        stats = pool.stats() if pool else {}
+        print(f"{mode:>10}: qps={repeat / elapsed:.1f} wall={elapsed:.2f}s "
+              f"wait_avg={stats.get('wait_time_avg', 0) * 1000:.1f}ms wait_max={stats.get('wait_time_max', 0) * 1000:.1f}ms")
+
+
+def bench_flight(rows: int, repeat: int, threads: int, distinct: int = 4):
+    """
+    # 回放突发请求：repeat个请求只涉及distinct个不同的查询，同时发出，比较合并相同查询前后的往返次数和耗时
+    """
+    data = make_rows(rows)
+    burst = [f"parent{i % distinct}" for i in range(repeat)]
+    random.Random(0).shuffle(burst)
+    for flight in (None, SingleFlight()):
+        graphs: List[StandInGraph] = []
+
+        def factory():
+            graphs.append(StandInGraph(data))
+            return graphs[-1]
+
+        dao = make_dao(StandInGraph(data), pool=Neo4jPool(factory, size=16, timeout=60), flight=flight)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(lambda parent: dao.get_parent_debt(parent, limit=10), burst))
+        elapsed = time.perf_counter() - start
+        mode = "flight" if flight else "plain"
+        print(f"{mode:>6}: requests={repeat} round_trips={sum(g.round_trips for g in graphs)} wall={elapsed:.2f}s "
+              f"{flight.stats() if flight else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bench", choices=["page", "cache", "serialize", "stream", "batch", "ring", "pool", "flight"])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--jump", type=int, default=3)
+    parser.add_argument("--degree", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+    if args.bench == "page":
+        bench_page(args.rows, args.repeat, args.limit)
+    elif args.bench == "cache":
+        bench_cache(args.rows, args.repeat, args.limit)
+    elif args.bench == "serialize":
+        bench_serialize(args.rows, args.repeat, args.jump)
+    elif args.bench == "stream":
+        bench_stream(args.rows)
+    elif args.bench == "batch":
+        bench_batch(args.rows)
+    elif args.bench == "ring":
+        bench_ring(args.jump, args.degree, args.repeat)
+    elif args.bench == "pool":
+        bench_pool(args.rows, args.repeat, args.threads)
+    elif args.bench == "flight":
+        bench_flight(args.rows, args.repeat, args.threads)
@@ -0,0 +1,122 @@
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+
+class Histogram:
+    """
+    Prometheus风格的累积直方图
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        result: List[Tuple[str, int]] = []
+        total = 0
+        for le, num in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            total += num
+            result.append((le, total))
+        return result
+
+
+class QueryMetrics:
+    """
+    QueryMetrics是 :class:`Neo4jDao`的查询统计钩子，按(查询方法, jump)统计查询次数、返回行数、序列化字节数、
+    缓存命中次数，以及数据库耗时、序列化耗时、返回行数和参数基数的直方图。
+    通过 :func:`neo4j_dao.add_default_hook`注册，:class:`QueryMetrics.render_prometheus`输出Prometheus文本格式
+    """
+
+    SECONDS_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS: Tuple[float, ...] = (1, 10, 100, 1000, 10000, 100000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (method, jump) -> 统计数据
+        self._series: Dict[Tuple[str, str], dict] = {}
+
+    def _get(self, method: str, jump: str) -> dict:
+        series = self._series.get((method, jump))
+        if series is None:
+            series = {
+                "queries": 0,
+                "cache_hits": 0,
+                "rows": 0,
+                "bytes": 0,
+                "db_seconds": Histogram(self.SECONDS_BUCKETS),
+                "serialize_seconds": Histogram(self.SECONDS_BUCKETS),
+                "rows_per_query": Histogram(self.SIZE_BUCKETS),
+                "param_cardinality": Histogram(self.SIZE_BUCKETS),
+            }
+            self._series[(method, jump)] = series
+        return series
+
+    def __call__(self, event: dict):
+        """
+        # 接收 :class:`Neo4jDao`的查询事件
+        :param event: 包含method、kind、params(参数名 -> 基数)、jump、rows、bytes、db_time、serialize_time、cached
+        """
+        jump = "" if event.get("jump") is None else str(event["jump"])
+        with self._lock:
+            series = self._get(event["method"], jump)
+            series["queries"] += 1
+            if event.get("cached"):
+                series["cache_hits"] += 1
+                return
+            series["db_seconds"].observe(event["db_time"])
+            if event["kind"] == "count":
+                return
+            series["rows"] += event["rows"]
+            series["bytes"] += event["bytes"]
+            series["serialize_seconds"].observe(event["serialize_time"])
+            series["rows_per_query"].observe(event["rows"])
+            series["param_cardinality"].observe(max(event["params"].values(), default=0))
+
+    def stats(self) -> dict:
+        """
+        # 内存中的统计数据，{方法名[jump]: {...}}
+        """
+        result: dict = {}
+        with self._lock:
+            for (method, jump), series in self._series.items():
+                db, ser = series["db_seconds"], series["serialize_seconds"]
+                result[f"{method}[{jump}]" if jump else method] = {
+                    "queries": series["queries"],
+                    "cache_hits": series["cache_hits"],
+                    "rows": series["rows"],
+                    "bytes": series["bytes"],
+                    "db_time_avg": db.sum / db.count if db.count else 0,
+                    "serialize_time_avg": ser.sum / ser.count if ser.count else 0,
+                }
+        return result
+
+    def render_prometheus(self) -> str:
+        """
+        # 输出Prometheus文本格式的统计数据
+        """
+        counters = ("queries", "cache_hits", "rows", "bytes")
+        histograms = ("db_seconds", "serialize_seconds", "rows_per_query", "param_cardinality")
+        lines: List[str] = []
+        with self._lock:
+            for name in counters:
+                lines.append(f"# TYPE neo4j_dao_{name}_total counter")
+                for (method, jump), series in self._series.items():
+                    lines.append(f'neo4j_dao_{name}_total{{method="{method}",jump="{jump}"}} {series[name]}')
+            for name in histograms:
+                lines.append(f"# TYPE neo4j_dao_{name} histogram")
+                for (method, jump), series in self._series.items():
+                    labels = f'method="{method}",jump="{jump}"'
+                    histogram: Histogram = series[name]
+                    for le, num in histogram.cumulative():
+                        lines.append(f'neo4j_dao_{name}_bucket{{{labels},le="{le}"}} {num}')
+                    lines.append(f"neo4j_dao_{name}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"neo4j_dao_{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
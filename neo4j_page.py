@@ -0,0 +1,91 @@
+import json
+import base64
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 当前上下文的keyset分页状态{"after": 请求的续页token, "next": 最近一次查询返回的续页token}，由 :func:`paging`设置
+page_state: ContextVar[dict] = ContextVar("neo4j_page_state", default=None)
+
+
+def encode_token(key) -> str:
+    """
+    # 将排序键编码为不透明的续页token
+    :param key: 上一页最后一条记录的排序键
+    :return: token
+    """
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+
+def decode_token(token: str):
+    """
+    # 解码续页token，空字符串表示第一页
+    :param token: :func:`encode_token`得到的token
+    :return: 排序键，第一页为None
+    """
+    if not token:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except ValueError as e:
+        raise ValueError(f"invalid page token: {token}") from e
+
+
+@contextmanager
+def paging(after: str = None):
+    """
+    # 在上下文中让查询方法使用keyset分页，用于上层(例如Neo4jService)无法逐个传递after参数的场景
+    :param after: 续页token，空字符串表示第一页，None表示不使用keyset分页
+    :return: 分页状态，查询结束后state["next"]为下一页的token，没有下一页时为None
+    """
+    state: dict = {"after": after, "next": None}
+    token = page_state.set(state)
+    try:
+        yield state
+    finally:
+        page_state.reset(token)
+
+
+def resolve_after(after: str = None) -> str:
+    """
+    # 查询方法没有传入after时使用 :func:`paging`设置的after
+    """
+    if after is None:
+        state = page_state.get()
+        if state is not None:
+            return state["after"]
+    return after
+
+
+def set_next(next_token: str):
+    """
+    # 记录最近一次查询返回的续页token
+    """
+    state = page_state.get()
+    if state is not None:
+        state["next"] = next_token
+
+
+def page_offset(rows, after: str = None, skip: int = 0, limit: int = -1):
+    """
+    # 进程内的数据(例如 :class:`DebtGraph`)按位置分页，after为空时使用skip，token中保存已经返回的条数
+    :param rows: 全部结果的可迭代对象
+    :param after: 续页token
+    :param skip: 跳过开头的条数
+    :param limit: 限制页数
+    :return: (全部结果的数量, 这一页的结果, 下一页的token)，没有使用keyset分页时token为None
+    """
+    after = resolve_after(after)
+    if after is not None:
+        skip = decode_token(after) or 0
+    total: int = 0
+    page: list = []
+    for row in rows:
+        if total >= skip and (limit <= 0 or total < skip + limit):
+            page.append(row)
+        total += 1
+    next_token = None
+    if after is not None and limit > 0 and skip + limit < total:
+        next_token = encode_token(skip + limit)
+    if after is not None:
+        set_next(next_token)
+    return total, page, next_token
@@ -0,0 +1,158 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from py2neo import Graph
+
+
+class Neo4jPool:
+    """
+    Neo4jPool是neo4j连接池，多线程的Flask服务中每个请求从池中取出一个Graph使用，用完归还，
+    避免所有请求共用 :class:`Neo4jConnect.get_connect`的同一个连接。
+    与Neo4jConnect相同，通过 :class:`Neo4jPool.install`初始化后，:class:`Neo4jDao`会默认使用该连接池
+    """
+
+    _pool: "Neo4jPool" = None
+
+    def __init__(self, factory: Callable[[], Graph], size: int = 8, timeout: float = 10,
+                 health_check_interval: float = 30):
+        """
+        :param factory: 创建新连接的函数
+        :param size: 连接池的最大连接数
+        :param timeout: 取连接的最长等待时间(秒)，超时抛出TimeoutError
+        :param health_check_interval: 连接空闲超过该时间(秒)后，取出时先执行"RETURN 1"检查是否可用
+        """
+        self.factory: Callable[[], Graph] = factory
+        self.size: int = size
+        self.timeout: float = timeout
+        self.health_check_interval: float = health_check_interval
+        # 空闲连接(连接, 归还时间)，后进先出，尽量复用刚用过的连接
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created: int = 0
+        self.in_use: int = 0
+        self.acquires: int = 0
+        self.timeouts: int = 0
+        self.health_failures: int = 0
+        self.wait_time: float = 0
+        self.wait_time_max: float = 0
+        self.query_time: float = 0
+
+    @classmethod
+    def from_graph(cls, graph: Graph, *args, **kwargs) -> "Neo4jPool":
+        """
+        # 使用与graph相同的连接配置创建连接池
+        :param graph: 已经建立的连接，例如 :class:`Neo4jConnect.get_connect`
+        :param args: 详细见 :class:`Neo4jPool.__init__`
+        :param kwargs: 详细见 :class:`Neo4jPool.__init__`
+        :return: 连接池
+        """
+        profile = graph.service.profile
+        return cls(lambda: Graph(profile, name=graph.name), *args, **kwargs)
+
+    @classmethod
+    def install(cls, pool: "Neo4jPool"):
+        """
+        # 设置全局的连接池，之后创建的 :class:`Neo4jDao`默认使用该连接池
+        """
+        cls._pool = pool
+
+    @classmethod
+    def get_pool(cls) -> "Neo4jPool":
+        """
+        # 获取全局的连接池，没有初始化时返回None
+        """
+        return cls._pool
+
+    def _healthy(self, graph: Graph) -> bool:
+        try:
+            graph.run("RETURN 1").evaluate()
+            return True
+        except Exception as e:
+            print(e)
+            self.health_failures += 1
+            return False
+
+    def acquire(self) -> Graph:
+        """
+        # 从连接池取出一个连接，没有空闲连接且已达到最大连接数时等待
+        :return: 连接
+        """
+        start = time.perf_counter()
+        while True:
+            try:
+                graph, released = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    create = self._created < self.size
+                    if create:
+                        self._created += 1
+                if create:
+                    try:
+                        graph = self.factory()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                    break
+                remain = self.timeout - (time.perf_counter() - start)
+                try:
+                    graph, released = self._idle.get(timeout=max(remain, 0))
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise TimeoutError(f"no neo4j connection available in {self.timeout}s")
+            if time.monotonic() - released < self.health_check_interval or self._healthy(graph):
+                break
+            with self._lock:
+                self._created -= 1
+        wait = time.perf_counter() - start
+        with self._lock:
+            self.in_use += 1
+            self.acquires += 1
+            self.wait_time += wait
+            self.wait_time_max = max(self.wait_time_max, wait)
+        return graph
+
+    def release(self, graph: Graph):
+        """
+        # 归还连接
+        :param graph: :class:`Neo4jPool.acquire`取出的连接
+        """
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put((graph, time.monotonic()))
+
+    @contextmanager
+    def session(self) -> Iterator[Graph]:
+        """
+        # 在with语句中取出一个连接，结束时归还，并统计连接的占用时间
+        """
+        graph = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield graph
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.query_time += elapsed
+            self.release(graph)
+
+    def stats(self) -> dict:
+        """
+        # 连接池的使用情况，wait为取连接的等待时间，query为连接的占用时间，单位为秒
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "in_use": self.in_use,
+                "acquires": self.acquires,
+                "timeouts": self.timeouts,
+                "health_failures": self.health_failures,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.wait_time_max,
+                "wait_time_avg": self.wait_time / self.acquires if self.acquires else 0,
+                "query_time_total": self.query_time,
+            }
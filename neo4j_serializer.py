@@ -0,0 +1,109 @@
+import json
+from typing import Any, Callable, Dict
+from py2neo import Path
+from py2neo.data import Node, Relationship
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Neo4jSerializer:
+    """
+    Neo4jSerializer将py2neo的查询结果一次遍历转换为可以json序列化的数据，按类型分派：
+    Node转为{"Node": 属性}，任意类型的关系转为{关系类型: 属性}，Path转为节点和关系交替的列表，
+    list/tuple/dict递归转换，其余类型原样返回。同一次转换中重复出现的节点按id只转换一次
+    """
+
+    def __init__(self):
+        # 节点id -> 转换后的节点，环路径的首尾节点等重复节点直接复用
+        self._nodes: Dict[Any, dict] = {}
+
+    def convert(self, ele):
+        handler = _HANDLERS.get(type(ele))
+        if handler is None:
+            handler = _resolve(type(ele))
+        return handler(self, ele)
+
+    def _node(self, ele: Node) -> dict:
+        key = ("identity", ele.identity) if ele.identity is not None else ("object", id(ele))
+        _ele = self._nodes.get(key)
+        if _ele is None:
+            _ele = {"Node": {k: self.convert(v) for k, v in dict.items(ele)}}
+            self._nodes[key] = _ele
+        return _ele
+
+    def _relationship(self, ele: Relationship) -> dict:
+        return {type(ele).__name__: {k: self.convert(v) for k, v in dict.items(ele)}}
+
+    def _path(self, ele: Path) -> list:
+        return [self.convert(i) for i in ele.__dict__['_Walkable__sequence']]
+
+    def _dict(self, ele: dict) -> dict:
+        return {k: self.convert(v) for k, v in ele.items()}
+
+    def _list(self, ele) -> list:
+        return [self.convert(i) for i in ele]
+
+    def _scalar(self, ele):
+        return ele
+
+
+# 类型 -> 转换方法，关系的类型是py2neo按关系名动态生成的子类，第一次遇到时由 :func:`_resolve`注册
+_HANDLERS: Dict[type, Callable] = {
+    str: Neo4jSerializer._scalar,
+    int: Neo4jSerializer._scalar,
+    float: Neo4jSerializer._scalar,
+    bool: Neo4jSerializer._scalar,
+    type(None): Neo4jSerializer._scalar,
+    dict: Neo4jSerializer._dict,
+    list: Neo4jSerializer._list,
+    tuple: Neo4jSerializer._list,
+}
+
+
+def _resolve(cls: type) -> Callable:
+    if issubclass(cls, Node):
+        handler = Neo4jSerializer._node
+    elif issubclass(cls, Relationship):
+        handler = Neo4jSerializer._relationship
+    elif issubclass(cls, Path):
+        handler = Neo4jSerializer._path
+    elif issubclass(cls, dict):
+        handler = Neo4jSerializer._dict
+    elif issubclass(cls, (list, tuple)):
+        handler = Neo4jSerializer._list
+    else:
+        handler = Neo4jSerializer._scalar
+    _HANDLERS[cls] = handler
+    return handler
+
+
+def to_jsonable(data):
+    """
+    # 将查询结果转换为可以json序列化的数据
+    :param data: cursor.data()得到的数据
+    :return: 只包含dict、list和基本类型的数据
+    """
+    return Neo4jSerializer().convert(data)
+
+
+def dumps(data) -> str:
+    """
+    # 将查询结果序列化为json字符串
+    :param data: cursor.data()得到的数据
+    :return: json字符串
+    """
+    return json.dumps(to_jsonable(data), ensure_ascii=False)
+
+
+def dumps_bytes(data) -> bytes:
+    """
+    # 将查询结果序列化为utf-8编码的json，安装了orjson时使用orjson
+    :param data: cursor.data()得到的数据
+    :return: json bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(to_jsonable(data))
+    return json.dumps(to_jsonable(data), ensure_ascii=False).encode("utf-8")
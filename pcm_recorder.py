@@ -0,0 +1,114 @@
+import io
+import os
+import time
+import wave
+import threading
+from typing import Callable, List
+
+# 录音参数设置，与语音识别模型一致
+CHANNELS = 1
+RATE = 16000
+CHUNK = 1024
+SAMPLE_WIDTH = 2
+
+
+def pcm_to_wav(pcm, rate: int = RATE) -> bytes:
+    """
+    # 给16位单声道PCM加上wav文件头
+    :param pcm: PCM数据，bytes或支持buffer协议的对象(例如int16的numpy数组)
+    :param rate: 采样率
+    :return: wav文件的内容
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(CHANNELS)
+        f.setsampwidth(SAMPLE_WIDTH)
+        f.setframerate(rate)
+        f.writeframes(memoryview(pcm).cast("B"))
+    return buffer.getvalue()
+
+
+class PCMRecorder:
+    """
+    PCMRecorder以回调的方式从麦克风录音，PCM数据只保存在内存中，用于代替写入固定文件名output.wav的录音，
+    每个会话使用自己的PCMRecorder，并发的用户不会互相覆盖录音。
+    设置debug_dir时，每次stop同时把录音保存为wav文件，便于排查识别问题
+    """
+
+    def __init__(self, rate: int = RATE, chunk: int = CHUNK, debug_dir: str = None,
+                 on_frames: Callable[[bytes], None] = None):
+        """
+        :param rate: 采样率
+        :param chunk: 每次回调的帧数
+        :param debug_dir: 保存调试用wav文件的目录，为None时不保存
+        :param on_frames: 每收到一块录音时的回调，例如 :class:`StreamingASR.feed`
+        """
+        self.rate: int = rate
+        self.chunk: int = chunk
+        self.debug_dir: str = debug_dir
+        self.on_frames: Callable[[bytes], None] = on_frames
+        self._frames: List[bytes] = []
+        self._lock = threading.Lock()
+        self._audio = None
+        self._stream = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        import pyaudio
+        with self._lock:
+            self._frames.append(in_data)
+        if self.on_frames is not None:
+            self.on_frames(in_data)
+        return None, pyaudio.paContinue
+
+    def start(self):
+        """
+        # 清空之前的录音并开始录音
+        """
+        import pyaudio
+        self.stop()
+        self.refresh()
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(format=pyaudio.paInt16, channels=CHANNELS, rate=self.rate, input=True,
+                                        frames_per_buffer=self.chunk, stream_callback=self._callback)
+        self._stream.start_stream()
+
+    def stop(self) -> bytes:
+        """
+        # 停止录音
+        :return: 全部录音的PCM数据
+        """
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._audio.terminate()
+            self._stream, self._audio = None, None
+        pcm = self.pcm()
+        if self.debug_dir is not None and pcm:
+            os.makedirs(self.debug_dir, exist_ok=True)
+            path = os.path.join(self.debug_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{id(self):x}.wav")
+            with open(path, "wb") as f:
+                f.write(pcm_to_wav(pcm, self.rate))
+        return pcm
+
+    def pcm(self) -> bytes:
+        """
+        # 目前为止的录音，合并为一块PCM数据
+        """
+        with self._lock:
+            if len(self._frames) > 1:
+                self._frames = [b"".join(self._frames)]
+            return self._frames[0] if self._frames else b""
+
+    def duration(self) -> float:
+        """
+        # 目前为止的录音时长(秒)
+        """
+        with self._lock:
+            return sum(len(frame) for frame in self._frames) / (SAMPLE_WIDTH * CHANNELS * self.rate)
+
+    def refresh(self):
+        """
+        # 丢弃录音
+        """
+        with self._lock:
+            self._frames = []
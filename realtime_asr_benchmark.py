@@ -0,0 +1,119 @@
+"""
+百度语音识别.py实时识别协议(START -> 音频帧 -> FINISH)的延迟测试，连接本地的websocket替身服务，
+回放pcm文件代替麦克风，结果可复现。需要安装websocket-client和websockets库
+使用方式 python realtime_asr_benchmark.py 16k-0.pcm --speed 1
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import importlib
+import threading
+
+import websocket
+
+realtime_asr = importlib.import_module("百度语音识别")
+
+
+def serve_stand_in(host: str, port: int, ready: threading.Event):
+    """
+    # 本地替身服务：收到音频帧后立即返回MID_TEXT，收到FINISH后返回FIN_TEXT并关闭连接
+    """
+    import websockets
+
+    async def handler(ws, path=None):
+        received = 0
+        async for message in ws:
+            if isinstance(message, bytes):
+                received += len(message)
+                await ws.send(json.dumps({"type": "MID_TEXT", "err_no": 0, "result": f"{received} bytes"}))
+                continue
+            req = json.loads(message)
+            if req["type"] in ("FINISH", "CANCEL"):
+                await ws.send(json.dumps({"type": "FIN_TEXT", "err_no": 0, "result": f"{received} bytes"}))
+                await ws.close()
+                return
+
+    async def main():
+        async with websockets.serve(handler, host, port):
+            ready.set()
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+
+def legacy_send_audio(ws, pcm_file: str, speed: float, stats: dict):
+    """
+    # 原来的发送方式：阻塞读取一帧(相当于等待一帧的录音时长)后再sleep一帧的时长，
+    # 麦克风按实时速度录音，第i帧在start + (i+1)帧时长时录完，发送得越来越晚
+    """
+    chunk_s = realtime_asr.CHUNK_MS / 1000.0 / speed if speed > 0 else 0
+    frames, lag_sum, lag_max = 0, 0.0, 0.0
+    start = time.perf_counter()
+    with open(pcm_file, "rb") as f:
+        while True:
+            # stream.read(chunk_len)，录音缓冲区中已经有积压时立即返回
+            time.sleep(max(0.0, start + (frames + 1) * chunk_s - time.perf_counter()))
+            pcm = f.read(realtime_asr.CHUNK_LEN)
+            if not pcm:
+                break
+            captured = start + (frames + 1) * chunk_s
+            ws.send(pcm, websocket.ABNF.OPCODE_BINARY)
+            lag = time.perf_counter() - captured
+            frames, lag_sum, lag_max = frames + 1, lag_sum + lag, max(lag_max, lag)
+            time.sleep(chunk_s)
+    stats.update(frames=frames, send_lag_avg=lag_sum / frames if frames else 0, send_lag_max=lag_max)
+
+
+def run_once(uri: str, pcm_file: str, speed: float, legacy: bool) -> dict:
+    stats: dict = {}
+    first_result: list = []
+
+    def on_message(ws, message):
+        data = json.loads(message)
+        now = time.perf_counter()
+        if not first_result:
+            first_result.append(now)
+        if data["type"] == "FIN_TEXT":
+            stats["fin_time"] = now
+
+    start = time.perf_counter()
+    if legacy:
+        def on_open(ws):
+            def run():
+                realtime_asr.send_start_params(ws)
+                legacy_send_audio(ws, pcm_file, speed, stats)
+                realtime_asr.send_finish(ws)
+                stats["finish_time"] = time.perf_counter()
+            threading.Thread(target=run).start()
+
+        websocket.WebSocketApp(uri, on_open=on_open, on_message=on_message).run_forever()
+    else:
+        source = realtime_asr.FileReplay(realtime_asr.RingBuffer(), pcm_file, speed)
+        realtime_asr.run(uri, source, on_message=on_message, stats=stats)
+    stats["wall"] = time.perf_counter() - start
+    stats["first_result"] = first_result[0] - start if first_result else None
+    stats["fin_latency"] = stats.get("fin_time", 0) - stats.get("finish_time", 0)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pcm_file")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    ready = threading.Event()
+    threading.Thread(target=serve_stand_in, args=("127.0.0.1", args.port, ready), daemon=True).start()
+    ready.wait()
+    with open(args.pcm_file, "rb") as f:
+        audio_seconds = len(f.read()) / (realtime_asr.RATE * 2)
+    for legacy in (True, False):
+        uri = f"ws://127.0.0.1:{args.port}/realtime_asr?sn={uuid.uuid1()}"
+        stats = run_once(uri, args.pcm_file, args.speed, legacy)
+        print(f"{'legacy' if legacy else 'ring':>6}: audio={audio_seconds:.2f}s wall={stats['wall']:.2f}s "
+              f"frames={stats['frames']} first_result={stats['first_result'] * 1000:.0f}ms "
+              f"send_lag_avg={stats['send_lag_avg'] * 1000:.1f}ms send_lag_max={stats['send_lag_max'] * 1000:.1f}ms "
+              f"fin_latency={stats['fin_latency'] * 1000:.1f}ms")
@@ -0,0 +1,160 @@
+"""
+自建的多路实时语音识别websocket服务，协议与百度实时语音识别相同(START -> 二进制音频帧 -> FINISH或CANCEL)，
+百度语音识别.py只需要把--uri改为本服务的地址。需要安装websockets库
+使用方式 python realtime_asr_server.py --port 8765
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
+from typing import Any, Callable, List, Tuple
+from urllib.parse import urlparse, parse_qs
+from llm_batcher import LLMBatcher
+from neo4j_metrics import Histogram
+from streaming_asr import StreamingASR
+
+
+class RealtimeASRServer:
+    """
+    RealtimeASRServer为每个websocket连接创建一个 :class:`StreamingASR`会话做VAD切段，
+    所有会话的语音段通过同一个 :class:`LLMBatcher`提交，并发的会话在同一次模型调用中一起识别，
+    一个模型实例即可服务多路识别。识别结果以MID_TEXT/FIN_TEXT事件的result字段返回给客户端
+    """
+
+    SECONDS_BUCKETS: Tuple[float, ...] = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+    def __init__(self, recognize_batch: Callable[[List[Tuple[bytes, int]]], List[str]] = None,
+                 max_batch_size: int = 16, max_wait: float = 0.01, max_queue: int = 1024, workers: int = 1,
+                 **session_options: Any):
+        """
+        :param recognize_batch: 批量识别的函数，输入(PCM数据, 采样率)的列表，返回同样顺序的文本列表，
+                                默认为 :func:`音频保存文件.asr_pcm_batch`
+        :param max_batch_size: 一次模型调用最多识别的语音段数
+        :param max_wait: 详细见 :class:`LLMBatcher`
+        :param max_queue: 详细见 :class:`LLMBatcher`
+        :param workers: 同时推理的批数，模型有多个副本时大于1
+        :param session_options: 传给 :class:`StreamingASR`的VAD参数，例如silence_ms、partial_interval
+        """
+        if recognize_batch is None:
+            from 音频保存文件 import asr_pcm_batch
+            recognize_batch = asr_pcm_batch
+        self.batcher = LLMBatcher(recognize_batch, max_batch_size=max_batch_size, max_wait=max_wait,
+                                  max_queue=max_queue, workers=workers)
+        self.session_options: dict = session_options
+        self._lock = threading.Lock()
+        self.active: int = 0
+        self.active_max: int = 0
+        self.streams: int = 0
+        self.frames: int = 0
+        # 事件循环中处理一帧音频(VAD)的耗时，过大时所有连接都会被拖慢
+        self.frame_seconds = Histogram(self.SECONDS_BUCKETS)
+
+    def recognize(self, pcm: bytes, rate: int) -> str:
+        return self.batcher.submit((pcm, rate))
+
+    async def handler(self, ws, path: str = None):
+        """
+        # 一个websocket连接的处理函数，兼容websockets新旧两种handler签名
+        """
+        if path is None:
+            request = getattr(ws, "request", None)
+            path = request.path if request is not None else getattr(ws, "path", "")
+        sn = parse_qs(urlparse(path).query).get("sn", [str(uuid.uuid1())])[0]
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        session: StreamingASR = None
+        sender: asyncio.Task = None
+        with self._lock:
+            self.streams += 1
+            self.active += 1
+            self.active_max = max(self.active_max, self.active)
+        try:
+            async for message in ws:
+                if session is None:
+                    if isinstance(message, (bytes, bytearray)) or json.loads(message).get("type") != "START":
+                        await ws.send(json.dumps({"type": "FIN_TEXT", "err_no": -1, "err_msg": "START frame expected",
+                                                  "result": "", "sn": sn}))
+                        return
+                    session = StreamingASR(self.recognize, sn=sn,
+                                           on_event=lambda event: loop.call_soon_threadsafe(events.put_nowait, event),
+                                           **self.session_options)
+                    session.handle(message)
+                    sender = asyncio.ensure_future(self._send_events(ws, events))
+                    continue
+                start = time.perf_counter()
+                session.handle(message)
+                if isinstance(message, (bytes, bytearray)):
+                    with self._lock:
+                        self.frames += 1
+                        self.frame_seconds.observe(time.perf_counter() - start)
+                    continue
+                req_type = json.loads(message).get("type")
+                if req_type == "FINISH":
+                    await sender
+                    return
+                if req_type == "CANCEL":
+                    return
+        finally:
+            if session is not None and not session.done.is_set():
+                session.cancel()
+            if sender is not None and not sender.done():
+                sender.cancel()
+            with self._lock:
+                self.active -= 1
+
+    @staticmethod
+    async def _send_events(ws, events: asyncio.Queue):
+        while True:
+            event: dict = await events.get()
+            await ws.send(json.dumps(event, ensure_ascii=False))
+            if event["type"] == "FIN_TEXT":
+                return
+
+    def stats(self) -> dict:
+        """
+        # 当前和最大并发连接数、累计连接数和音频帧数、每帧的平均处理耗时，以及批量识别的统计，
+        # 详细见 :class:`LLMBatcher.stats`
+        """
+        with self._lock:
+            stats = {
+                "active": self.active,
+                "active_max": self.active_max,
+                "streams": self.streams,
+                "frames": self.frames,
+                "frame_time_avg": self.frame_seconds.sum / self.frame_seconds.count if self.frame_seconds.count else 0,
+            }
+        stats["recognize"] = self.batcher.stats()
+        return stats
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 8765, ready: threading.Event = None):
+        """
+        # 启动服务并一直运行
+        :param ready: 开始监听后set，用于在其它线程中等待服务启动
+        """
+        import websockets
+        async with websockets.serve(self.handler, host, port, max_size=None):
+            if ready is not None:
+                ready.set()
+            await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--device", default=None, help="推理设备，默认有GPU时用GPU")
+    parser.add_argument("--batch-size", type=int, default=16, help="一次模型调用最多识别的语音段数")
+    parser.add_argument("--max-wait", type=float, default=0.01, help="凑批的最长等待时间(秒)")
+    parser.add_argument("--no-warmup", action="store_true", help="不预热模型")
+    args = parser.parse_args()
+
+    import 音频保存文件
+    if args.no_warmup:
+        音频保存文件.get_pipeline(args.device)
+    else:
+        print(f"warmup {音频保存文件.warmup(args.device):.2f}s")
+    server = RealtimeASRServer(max_batch_size=args.batch_size, max_wait=args.max_wait)
+    print(f"realtime asr listening on ws://{args.host}:{args.port}/realtime_asr")
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,145 @@
+"""
+realtime_asr_server.py的并发容量测试：同时打开N路websocket连接，每路按实时速度发送一段音频，
+统计每帧的处理耗时、发送延迟、FINISH到FIN_TEXT的延迟和识别的批大小，找出满足延迟目标的最大并发路数。
+默认使用耗时模拟的识别函数(每次调用的固定开销 + 每段的耗时)，--model时加载paraformer模型。需要安装websockets库
+使用方式 python realtime_asr_server_benchmark.py --streams 1 8 32 64 --seconds 4
+"""
+import json
+import math
+import time
+import uuid
+import array
+import asyncio
+import argparse
+import threading
+from typing import List, Tuple
+from realtime_asr_server import RealtimeASRServer
+
+RATE = 16000
+CHUNK_MS = 160
+CHUNK_LEN = RATE * 2 * CHUNK_MS // 1000
+
+
+class StubRecognizer:
+    """
+    模拟批量识别的耗时：每次调用的固定开销overhead加上每段per_segment，与批量推理的特点相同
+    """
+
+    def __init__(self, overhead: float = 0.05, per_segment: float = 0.01):
+        self.overhead: float = overhead
+        self.per_segment: float = per_segment
+
+    def __call__(self, items: List[Tuple[bytes, int]]) -> List[str]:
+        time.sleep(self.overhead + self.per_segment * len(items))
+        return [f"{len(pcm) / 2 / rate:.2f}s" for pcm, rate in items]
+
+
+def speech_like(seconds: float, talk: float = 0.9, pause: float = 0.5) -> bytes:
+    """
+    # 生成talk秒正弦波、pause秒静音交替的16位PCM，VAD会把每段正弦波切成一个语音段
+    """
+    samples = array.array("h")
+    period = int((talk + pause) * RATE)
+    for i in range(int(seconds * RATE)):
+        voiced = i % period < talk * RATE
+        samples.append(int(8000 * math.sin(2 * math.pi * 440 * i / RATE)) if voiced else 0)
+    return samples.tobytes()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def client(uri: str, pcm: bytes, stats: dict):
+    """
+    # 一路识别：START、按绝对时间安排的音频帧、FINISH，记录每帧的发送延迟和FIN_TEXT的延迟
+    """
+    import websockets
+    async with websockets.connect(uri, max_size=None) as ws:
+        await ws.send(json.dumps({"type": "START", "data": {"sample": RATE, "format": "pcm"}}))
+        results: list = []
+
+        async def receive():
+            async for message in ws:
+                results.append((time.perf_counter(), json.loads(message)))
+                if results[-1][1]["type"] == "FIN_TEXT":
+                    return
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.perf_counter()
+        for i in range(0, len(pcm), CHUNK_LEN):
+            delay = start + i / (RATE * 2) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats["send_lag"].append(max(0.0, -delay))
+            await ws.send(pcm[i:i + CHUNK_LEN])
+        finish = time.perf_counter()
+        await ws.send(json.dumps({"type": "FINISH"}))
+        await receiver
+    fin_time, fin = results[-1]
+    stats["fin_latency"].append(fin_time - finish)
+    stats["mid_texts"] += len(results) - 1
+    stats["errors"] += fin["err_no"] != 0
+
+
+async def run_load(uri: str, streams: int, pcm: bytes) -> dict:
+    stats: dict = {"send_lag": [], "fin_latency": [], "mid_texts": 0, "errors": 0}
+    await asyncio.gather(*(client(f"{uri}?sn={uuid.uuid1()}", pcm, stats) for _ in range(streams)))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--seconds", type=float, default=4.0, help="每路的音频时长")
+    parser.add_argument("--pcm-file", default=None, help="使用16k 16位单声道pcm文件代替合成的音频")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-wait", type=float, default=0.01)
+    parser.add_argument("--overhead", type=float, default=0.05, help="模拟识别每次调用的固定开销(秒)")
+    parser.add_argument("--per-segment", type=float, default=0.01, help="模拟识别每段的耗时(秒)")
+    parser.add_argument("--model", action="store_true", help="加载paraformer模型，不使用模拟的识别函数")
+    parser.add_argument("--slo", type=float, default=0.5, help="FIN_TEXT延迟p95的目标(秒)")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    if args.pcm_file:
+        with open(args.pcm_file, "rb") as f:
+            pcm = f.read()
+    else:
+        pcm = speech_like(args.seconds)
+    uri = f"ws://127.0.0.1:{args.port}/realtime_asr"
+    capacity = 0
+    for streams in args.streams:
+        if args.model:
+            import 音频保存文件
+            音频保存文件.warmup()
+            server = RealtimeASRServer(max_batch_size=args.batch_size, max_wait=args.max_wait)
+        else:
+            server = RealtimeASRServer(StubRecognizer(args.overhead, args.per_segment),
+                                       max_batch_size=args.batch_size, max_wait=args.max_wait)
+        ready = threading.Event()
+        threading.Thread(target=asyncio.run, args=(server.serve("127.0.0.1", args.port, ready),),
+                         daemon=True).start()
+        ready.wait()
+        stats = asyncio.run(run_load(uri, streams, pcm))
+        server_stats = server.stats()
+        recognize = server_stats["recognize"]
+        fin_p95 = percentile(stats["fin_latency"], 0.95)
+        lag_p95 = percentile(stats["send_lag"], 0.95)
+        ok = fin_p95 <= args.slo and lag_p95 < CHUNK_MS / 1000 and not stats["errors"]
+        capacity = streams if ok else capacity
+        print(f"streams={streams:>4} frames={server_stats['frames']} "
+              f"frame_time_avg={server_stats['frame_time_avg'] * 1e6:.0f}us "
+              f"send_lag_p95={lag_p95 * 1000:.1f}ms "
+              f"fin_p50={percentile(stats['fin_latency'], 0.5) * 1000:.0f}ms fin_p95={fin_p95 * 1000:.0f}ms "
+              f"mid_texts={stats['mid_texts']} segments={recognize['requests']} batches={recognize['batches']} "
+              f"batch_size_avg={recognize['batch_size_avg']:.1f} "
+              f"recognize_latency_avg={recognize['latency_avg'] * 1000:.0f}ms errors={stats['errors']} "
+              f"{'ok' if ok else 'over'}")
+        server.batcher.close()
+        args.port += 1
+        uri = f"ws://127.0.0.1:{args.port}/realtime_asr"
+    print(f"capacity: {capacity} concurrent streams with fin_p95 <= {args.slo * 1000:.0f}ms")
@@ -0,0 +1,197 @@
+import os
+import copy
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+# 可以作为对话状态的属性类型，模型、分词器、数据库服务这类对象不属于对话状态
+_STATE_TYPES: Tuple[type, ...] = (str, int, float, bool, type(None), list, tuple, dict, set)
+
+
+class _Session:
+    """
+    一个会话的对话状态、会话锁和最后访问时间
+    """
+    __slots__ = ("state", "lock", "last_access")
+
+    def __init__(self, state: Any):
+        self.state: Any = state
+        self.lock = threading.Lock()
+        self.last_access: float = time.monotonic()
+
+
+class SessionStore:
+    """
+    SessionStore按session_id保存每个用户的对话状态(例如 :class:`SharedModel`的对话属性)，代替全局共用的一个实例，
+    同一个会话的请求串行执行，不同会话之间互不阻塞。
+    内存中最多保存max_sessions个会话，超出时淘汰最久未使用的会话，空闲超过idle_ttl的会话被清除；
+    设置spill_dir时，被淘汰的会话pickle到本地磁盘，再次访问时读回
+    """
+
+    def __init__(self, factory: Callable[[], Any], max_sessions: int = 1000, idle_ttl: float = 1800,
+                 spill_dir: str = None):
+        """
+        :param factory: 创建新会话状态的函数
+        :param max_sessions: 内存中最多保存的会话数
+        :param idle_ttl: 会话空闲超过该时间(秒)后清除，磁盘上的会话同样适用
+        :param spill_dir: 被淘汰的会话保存到的目录，为None时直接丢弃
+        """
+        self.factory: Callable[[], Any] = factory
+        self.max_sessions: int = max_sessions
+        self.idle_ttl: float = idle_ttl
+        self.spill_dir: str = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created: int = 0
+        self.evicted: int = 0
+        self.expired: int = 0
+        self.spilled: int = 0
+        self.restored: int = 0
+
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".pkl")
+
+    def _spill(self, session_id: str, session: _Session):
+        if self.spill_dir is None:
+            return
+        try:
+            with open(self._spill_path(session_id), "wb") as f:
+                pickle.dump(session.state, f)
+            self.spilled += 1
+        except (pickle.PicklingError, TypeError, AttributeError, OSError) as e:
+            print(e)
+
+    def _restore(self, session_id: str) -> Any:
+        if self.spill_dir is None:
+            return None
+        path = self._spill_path(session_id)
+        try:
+            expired = time.time() - os.path.getmtime(path) > self.idle_ttl
+            if not expired:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, OSError) as e:
+            print(e)
+            return None
+        if expired:
+            return None
+        self.restored += 1
+        return state
+
+    def _evict(self):
+        """
+        # 清除空闲超时的会话，超出容量时淘汰最久未使用的会话，正在处理请求的会话不淘汰
+        """
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            over = len(self._sessions) > self.max_sessions
+            idle = now - session.last_access > self.idle_ttl
+            if not over and not idle:
+                break
+            if session.lock.locked():
+                continue
+            del self._sessions[session_id]
+            if idle:
+                self.expired += 1
+            else:
+                self.evicted += 1
+                self._spill(session_id, session)
+
+    def _get(self, session_id: str) -> _Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                state = self._restore(session_id)
+                if state is None:
+                    state = self.factory()
+                    self.created += 1
+                session = _Session(state)
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session.last_access = time.monotonic()
+            self._evict()
+            return session
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[Any]:
+        """
+        # 在with语句中独占使用某个会话的状态，同一会话的并发请求依次执行
+        :param session_id: 会话id
+        :return: 会话状态
+        """
+        session = self._get(session_id)
+        with session.lock:
+            yield session.state
+            session.last_access = time.monotonic()
+
+    def drop(self, session_id: str):
+        """
+        # 删除某个会话，包括磁盘上的状态
+        :param session_id: 会话id
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self.spill_dir is not None and os.path.exists(self._spill_path(session_id)):
+                os.remove(self._spill_path(session_id))
+
+    def stats(self) -> dict:
+        """
+        # 会话数量和创建、淘汰、过期、写入磁盘、从磁盘读回的次数
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "created": self.created,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "spilled": self.spilled,
+                "restored": self.restored,
+            }
+
+
+class SharedModel:
+    """
+    SharedModel让全部会话共用一个模型实例(例如 :class:`DebtLLM`)，会话中只保存对话相关的属性(历史、上下文等)。
+    模型、分词器等占内存的属性只有一份，:class:`SessionStore`淘汰会话时也只pickle对话属性。
+    每次请求通过bind得到共享实例的浅拷贝，属性引用同一个模型，对话属性替换为本会话的状态
+    """
+
+    def __init__(self, model: Any, state_attrs: Tuple[str, ...] = None):
+        """
+        :param model: 共享的模型实例
+        :param state_attrs: 对话状态的属性名，为None时取值为str、数字、list、dict等普通数据的属性
+        """
+        self.model: Any = model
+        if state_attrs is None:
+            state_attrs = tuple(name for name, value in vars(model).items() if isinstance(value, _STATE_TYPES))
+        self.state_attrs: Tuple[str, ...] = state_attrs
+        self._initial: Dict[str, Any] = {name: copy.deepcopy(getattr(model, name)) for name in state_attrs}
+
+    def new_state(self) -> Dict[str, Any]:
+        """
+        # 新会话的对话状态，作为 :class:`SessionStore`的factory
+        """
+        return copy.deepcopy(self._initial)
+
+    @contextmanager
+    def bind(self, state: Dict[str, Any]) -> Iterator[Any]:
+        """
+        # 在with语句中以某个会话的对话状态使用共享的模型，结束时把修改后的对话属性写回state
+        :param state: 会话的对话状态，来自 :class:`SessionStore.session`
+        :return: 与模型共用其它属性的实例
+        """
+        view = copy.copy(self.model)
+        vars(view).update(state)
+        try:
+            yield view
+        finally:
+            state.update({name: getattr(view, name) for name in self.state_attrs})
@@ -0,0 +1,106 @@
+import json
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    """
+    一次正在执行的计算，等待者在done上等待结果
+    """
+    __slots__ = ("done", "value", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: BaseException = None
+        self.waiters: int = 0
+
+
+class SingleFlight:
+    """
+    SingleFlight合并同时到达的相同请求：同一个key同一时间只执行一次计算，执行期间到达的相同请求等待
+    这次计算并得到同一个结果(或同一个异常)，计算结束后key立即释放，不缓存结果。
+    与 :class:`Neo4jPool`相同，通过 :class:`SingleFlight.install`初始化后，:class:`Neo4jDao`会默认使用
+    """
+
+    _flight: "SingleFlight" = None
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.calls: int = 0
+        self.executions: int = 0
+        self.shared: int = 0
+        self.errors: int = 0
+
+    @classmethod
+    def install(cls, flight: "SingleFlight"):
+        """
+        # 设置全局的SingleFlight，之后创建的 :class:`Neo4jDao`默认合并相同的查询
+        """
+        cls._flight = flight
+
+    @classmethod
+    def get_flight(cls) -> "SingleFlight":
+        """
+        # 获取全局的SingleFlight，没有初始化时返回None
+        """
+        return cls._flight
+
+    @staticmethod
+    def make_key(*parts) -> Tuple:
+        """
+        # 将任意可以json序列化的参数转换为可哈希的key
+        """
+        return tuple(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str) for part in parts)
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        # 执行fn，已经有相同key的计算正在执行时等待它的结果
+        :param key: 请求的key，相同key的请求得到相同的结果
+        :param fn: 要执行的函数
+        :param args: fn的位置参数
+        :param kwargs: fn的关键字参数
+        :return: (fn的返回值, 是否共享了其它请求的计算)
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def stats(self) -> dict:
+        """
+        # 请求数、实际执行数、共享结果的请求数、失败数、正在执行的key数和被合并掉的比例
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "shared": self.shared,
+                "errors": self.errors,
+                "in_flight": len(self._calls),
+                "dedup_rate": self.shared / self.calls if self.calls else 0,
+            }
@@ -0,0 +1,229 @@
+import json
+import time
+import queue
+import array
+import threading
+from collections import deque
+from typing import Callable, Iterator, List
+try:
+    # audioop在Python 3.13中被移除，没有时使用纯Python的实现
+    import audioop
+except ImportError:
+    audioop = None
+
+# 与语音识别模型一致的16k 16位单声道PCM
+RATE = 16000
+SAMPLE_WIDTH = 2
+
+
+def frame_energy(frame: bytes) -> float:
+    """
+    # 一帧16位PCM的均方根能量
+    """
+    frame = frame[:len(frame) - len(frame) % SAMPLE_WIDTH]
+    if audioop is not None:
+        return audioop.rms(frame, SAMPLE_WIDTH)
+    samples = array.array("h", frame)
+    if not samples:
+        return 0
+    return (sum(x * x for x in samples) / len(samples)) ** 0.5
+
+
+class StreamingASR:
+    """
+    StreamingASR是一次录音的增量识别会话，录音过程中不断feed音频，按能量VAD切分出语音段，
+    每段说完(静音超过silence_ms或长度超过max_segment)就在后台线程中识别，说话过程中每隔partial_interval
+    识别一次当前语音段得到临时结果，因此finish时只需要识别最后一段，最终结果在几百毫秒内返回。
+    事件的格式与百度实时语音识别相同：{"type": "MID_TEXT"或"FIN_TEXT", "err_no", "err_msg", "result", "sn"}，
+    协议也相同，详细见 :class:`StreamingASR.handle`
+    """
+
+    def __init__(self, recognize: Callable[[bytes, int], str] = None, sn: str = "", rate: int = RATE,
+                 frame_ms: int = 30, energy_threshold: float = 500, silence_ms: int = 400, pre_roll_ms: int = 200,
+                 max_segment: float = 10, partial_interval: float = 0.8, on_event: Callable[[dict], None] = None):
+        """
+        :param recognize: 识别一段PCM的函数(pcm, 采样率) -> 文本，默认为 :func:`音频保存文件.asr_pcm`
+        :param sn: 会话id，原样放在事件中
+        :param rate: 采样率，可以由START帧的sample覆盖
+        :param frame_ms: VAD每帧的时长(毫秒)
+        :param energy_threshold: 均方根能量不低于该值的帧视为语音
+        :param silence_ms: 语音之后静音超过该时长(毫秒)时结束一段
+        :param pre_roll_ms: 语音开始前保留的静音(毫秒)，避免切掉第一个字的开头
+        :param max_segment: 一段的最长时长(秒)，超过时强制结束
+        :param partial_interval: 说话过程中识别临时结果的间隔(秒)
+        :param on_event: 收到识别事件时的回调，事件同时可以通过 :class:`StreamingASR.events`读取
+        """
+        if recognize is None:
+            from 音频保存文件 import asr_pcm
+            recognize = asr_pcm
+        self.recognize: Callable[[bytes, int], str] = recognize
+        self.sn: str = sn
+        self.frame_ms: int = frame_ms
+        self.energy_threshold: float = energy_threshold
+        self.silence_ms: int = silence_ms
+        self.pre_roll_ms: int = pre_roll_ms
+        self.max_segment: float = max_segment
+        self.partial_interval: float = partial_interval
+        self.on_event: Callable[[dict], None] = on_event
+        self.rate: int = rate
+        self._pending = bytearray()
+        self._pre_roll: deque = deque()
+        self._segment = bytearray()
+        self._in_speech: bool = False
+        self._silence: int = 0
+        self._since_partial: float = 0
+        self._segments: int = 0
+        self._partial_queued: bool = False
+        self._texts: List[str] = []
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._events: "queue.Queue" = queue.Queue()
+        self._finish_time: float = None
+        self._cancelled: bool = False
+        self.final: str = None
+        self.done = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def _frame_bytes(self) -> int:
+        return self.rate * SAMPLE_WIDTH * self.frame_ms // 1000
+
+    def handle(self, message):
+        """
+        # 按百度实时语音识别的协议处理一帧：文本帧为{"type": "START", "data": {"sample": 16000}}、
+        # {"type": "FINISH"}或{"type": "CANCEL"}，二进制帧为音频
+        """
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            self.feed(message)
+            return
+        req: dict = json.loads(message)
+        if req["type"] == "START":
+            self.rate = int(req.get("data", {}).get("sample", self.rate))
+        elif req["type"] == "FINISH":
+            self.finish(wait=False)
+        elif req["type"] == "CANCEL":
+            self.cancel()
+
+    def feed(self, pcm):
+        """
+        # 送入一块录音，可以是任意长度
+        """
+        self._pending += pcm
+        size = self._frame_bytes
+        while len(self._pending) >= size:
+            frame = bytes(self._pending[:size])
+            del self._pending[:size]
+            self._vad(frame)
+
+    def _vad(self, frame: bytes):
+        voiced = frame_energy(frame) >= self.energy_threshold
+        if not self._in_speech:
+            if not voiced:
+                self._pre_roll.append(frame)
+                while len(self._pre_roll) * self.frame_ms > self.pre_roll_ms:
+                    self._pre_roll.popleft()
+                return
+            self._in_speech = True
+            self._segment = bytearray(b"".join(self._pre_roll))
+            self._pre_roll.clear()
+            self._since_partial = 0
+        self._segment += frame
+        self._silence = 0 if voiced else self._silence + self.frame_ms
+        self._since_partial += self.frame_ms / 1000
+        if self._silence >= self.silence_ms or len(self._segment) >= self.max_segment * self.rate * SAMPLE_WIDTH:
+            self._close_segment()
+        elif self._since_partial >= self.partial_interval and not self._partial_queued:
+            # 后台还没有处理完上一次临时识别时跳过，不积压
+            self._since_partial = 0
+            self._partial_queued = True
+            self._jobs.put(("partial", self._segments, bytes(self._segment)))
+
+    def _close_segment(self):
+        if self._in_speech:
+            self._jobs.put(("final", self._segments, bytes(self._segment)))
+            self._segments += 1
+        self._in_speech = False
+        self._segment = bytearray()
+        self._silence = 0
+
+    def finish(self, wait: bool = True, timeout: float = None) -> str:
+        """
+        # 录音结束，识别最后一段并发送FIN_TEXT
+        :param wait: 是否等待最终结果
+        :param timeout: 等待的最长时间(秒)
+        :return: 最终结果，不等待时为None
+        """
+        if self._finish_time is None:
+            self._finish_time = time.perf_counter()
+            if self._pending and self._in_speech:
+                self._segment += self._pending
+            self._pending = bytearray()
+            self._close_segment()
+            self._jobs.put(("finish", self._segments, None))
+        if wait:
+            self.done.wait(timeout)
+        return self.final
+
+    def cancel(self):
+        """
+        # 放弃本次识别，不再发送事件，已经排队的语音段也不再识别
+        """
+        self._cancelled = True
+        self._jobs.put(("cancel", self._segments, None))
+
+    def _emit(self, event_type: str, result: str, err: Exception = None, **extra):
+        if self._cancelled:
+            return
+        event: dict = {"type": event_type, "err_no": 0 if err is None else -1,
+                       "err_msg": "OK" if err is None else repr(err), "result": result, "sn": self.sn}
+        event.update(extra)
+        self._events.put(event)
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _run(self):
+        error = None
+        while True:
+            kind, segment, pcm = self._jobs.get()
+            if kind == "cancel":
+                self.done.set()
+                self._events.put(None)
+                return
+            if kind == "finish":
+                self.final = "".join(self._texts)
+                self._emit("FIN_TEXT", self.final, error, segments=segment,
+                           finish_latency=time.perf_counter() - self._finish_time)
+                self.done.set()
+                self._events.put(None)
+                return
+            if kind == "partial":
+                self._partial_queued = False
+                # 这一段已经结束并排队等待最终识别时，临时结果已经过时
+                if segment < self._segments:
+                    continue
+            if self._cancelled:
+                continue
+            try:
+                text = self.recognize(pcm, self.rate)
+            except Exception as e:
+                error = e
+                continue
+            if kind == "final":
+                self._texts.append(text)
+                self._emit("MID_TEXT", "".join(self._texts), segments=segment + 1)
+            else:
+                self._emit("MID_TEXT", "".join(self._texts) + text, segments=segment)
+
+    def events(self, timeout: float = None) -> Iterator[dict]:
+        """
+        # 依次读取识别事件，FIN_TEXT之后结束
+        :param timeout: 等待下一个事件的最长时间(秒)，超时结束
+        """
+        while True:
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if event is None:
+                return
+            yield event
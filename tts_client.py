@@ -0,0 +1,38 @@
+import os
+import requests
+
+# 阿里云智能语音交互的语音合成RESTful接口，音色与client_tts相同(例如"zhigui")
+NLS_TTS_URL = os.environ.get("ALIYUN_NLS_TTS_URL", "https://nls-gateway-cn-shanghai.aliyuncs.com/stream/v1/tts")
+NLS_APPKEY = os.environ.get("ALIYUN_NLS_APPKEY")
+NLS_TOKEN = os.environ.get("ALIYUN_NLS_TOKEN")
+
+
+def configured() -> bool:
+    """
+    # 是否设置了ALIYUN_NLS_APPKEY和ALIYUN_NLS_TOKEN
+    """
+    return bool(NLS_APPKEY and NLS_TOKEN)
+
+
+def synthesize(text: str, voice: str = "zhigui", sample_rate: int = 16000, timeout: float = 10) -> bytes:
+    """
+    # 只合成不播放，返回wav音频，播放由调用方负责，用于 :class:`TTSPipeline`提前合成和缓存分句。
+    # client_tts.client_tts合成后直接播放，拿不到音频
+    :param text: 要合成的文本
+    :param voice: 音色
+    :param sample_rate: 采样率
+    :param timeout: 超时时间(秒)
+    :return: wav音频
+    """
+    response = requests.post(NLS_TTS_URL, timeout=timeout, json={
+        "appkey": NLS_APPKEY,
+        "token": NLS_TOKEN,
+        "text": text,
+        "voice": voice,
+        "format": "wav",
+        "sample_rate": sample_rate,
+    })
+    # 成功时返回音频，失败时返回json格式的错误信息
+    if response.status_code != 200 or not response.headers.get("Content-Type", "").startswith("audio/"):
+        raise RuntimeError(f"tts failed ({response.status_code}): {response.text[:200]}")
+    return response.content
@@ -0,0 +1,348 @@
+import io
+import os
+import time
+import wave
+import queue
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+
+class PhraseCache:
+    """
+    PhraseCache是按(文本, 音色)寻址的语音合成结果缓存：内存中按LRU淘汰，总字节数不超过max_bytes；
+    设置disk_dir时同时写入磁盘，内存中淘汰或重启之后仍然可以从磁盘读取。
+    "查询结果如下"、公司名称这类反复出现的分句不再重复合成
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: str = None):
+        """
+        :param max_bytes: 内存中缓存的音频最多的字节数
+        :param disk_dir: 磁盘缓存的目录，为None时只缓存在内存中
+        """
+        self.max_bytes: int = max_bytes
+        self.disk_dir: str = disk_dir
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes: int = 0
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def key(text: str, voice: str) -> str:
+        return hashlib.sha1(f"{voice}\n{text.strip()}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".wav")
+
+    def get(self, text: str, voice: str) -> Optional[bytes]:
+        """
+        # 读取缓存的音频，磁盘中命中时放回内存
+        :return: 音频，没有缓存时为None
+        """
+        key = self.key(text, voice)
+        with self._lock:
+            audio = self._items.get(key)
+            if audio is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return audio
+        if self.disk_dir is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio = f.read()
+            except OSError:
+                audio = None
+            if audio is not None:
+                self._remember(key, audio)
+                with self._lock:
+                    self.disk_hits += 1
+                return audio
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text: str, voice: str, audio: bytes):
+        """
+        # 缓存一个分句的音频
+        """
+        key = self.key(text, voice)
+        self._remember(key, audio)
+        if self.disk_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，并发写入或中途退出时不会留下不完整的音频
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(audio)
+            os.replace(tmp, path)
+
+    def _remember(self, key: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = audio
+            self._bytes += len(audio)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        """
+        # 内存中的条数和字节数，内存命中、磁盘命中和未命中的次数
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"items": len(self._items), "bytes": self._bytes, "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0}
+
+
+class WavPlayer:
+    """
+    用同一个PyAudio播放wav音频，按格式复用输出流，每次写入一小块，stop时在一小块之内停止
+    """
+
+    def __init__(self, chunk: int = 1024):
+        self.chunk: int = chunk
+        self._audio = None
+        self._streams: Dict[Tuple[int, int, int], object] = {}
+
+    def __call__(self, audio: bytes, stopped: threading.Event):
+        import pyaudio
+        if self._audio is None:
+            self._audio = pyaudio.PyAudio()
+        with wave.open(io.BytesIO(audio), "rb") as f:
+            fmt = (f.getsampwidth(), f.getnchannels(), f.getframerate())
+            stream = self._streams.get(fmt)
+            if stream is None:
+                stream = self._audio.open(format=self._audio.get_format_from_width(fmt[0]), channels=fmt[1],
+                                          rate=fmt[2], output=True)
+                self._streams[fmt] = stream
+            data = f.readframes(self.chunk)
+            while data and not stopped.is_set():
+                stream.write(data)
+                data = f.readframes(self.chunk)
+
+
+class Speech:
+    """
+    一次回答的语音，通过 :class:`TTSPipeline.start`得到。
+    add的分句立即开始合成，最多提前合成prefetch句，播放线程按顺序播放
+    """
+
+    def __init__(self, pipeline: "TTSPipeline"):
+        self._pipeline = pipeline
+        self._texts: deque = deque()
+        self._audios: deque = deque()
+        self._closed: bool = False
+        self._cond = threading.Condition()
+        self.stopped = threading.Event()
+
+    def add(self, text: str):
+        """
+        # 追加一个分句
+        """
+        text = text.strip()
+        if not text or self.stopped.is_set():
+            return
+        with self._cond:
+            self._texts.append(text)
+            self._pump()
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        # 回答结束，播放完已有的分句后结束
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+        # 停止播放并放弃还没有播放的分句
+        """
+        self.stopped.set()
+        with self._cond:
+            dropped = len(self._texts)
+            self._texts.clear()
+            # 还没有开始的合成直接取消，已经开始或完成的合成结果不再播放
+            skipped = sum(future.cancel() for future in self._audios)
+            discarded = len(self._audios) - skipped
+            self._audios.clear()
+            self._cond.notify_all()
+        self._pipeline._count_stopped(dropped + skipped, discarded)
+
+    def _pump(self):
+        while self._texts and len(self._audios) < self._pipeline.prefetch:
+            self._audios.append(self._pipeline.synthesize_async(self._texts.popleft()))
+
+    def _next(self) -> Optional[Future]:
+        """
+        # 播放线程取下一句的音频，没有更多的分句时返回None
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._audios or self._closed and not self._texts or self.stopped.is_set())
+            if self.stopped.is_set() or not self._audios:
+                return None
+            future = self._audios.popleft()
+            self._pump()
+            return future
+
+
+class TTSPipeline:
+    """
+    TTSPipeline是整个服务共用的语音合成和播放流水线：固定数量的合成线程和一个播放线程，
+    播放当前分句的同时合成后面的分句，每个请求不再创建自己的Player和线程。
+    合成结果缓存在 :class:`PhraseCache`中，重复的分句不经过合成直接播放。
+    不提供synthesize时不单独合成，play收到的是分句文本，由play自己合成并播放(例如client_tts.client_tts)
+    """
+
+    def __init__(self, synthesize: Optional[Callable[[str, str], bytes]],
+                 play: Callable[[bytes, threading.Event], None] = None,
+                 voice: str = "zhigui", workers: int = 2, prefetch: int = 3, cache: PhraseCache = None,
+                 executor: ThreadPoolExecutor = None):
+        """
+        :param synthesize: 合成一个分句的函数(文本, 音色) -> wav音频，为None时把分句文本直接交给play
+        :param play: 播放一段音频的函数(音频, 停止信号)，停止信号set时应尽快返回，默认为 :class:`WavPlayer`；
+                     synthesize为None时为(分句文本, 停止信号)
+        :param voice: 音色
+        :param workers: 合成线程数
+        :param prefetch: 每次回答最多提前合成的分句数
+        :param cache: 分句的音频缓存，为None时不缓存
+        :param executor: 合成使用的线程池，多个TTSPipeline(例如每个会话一个)可以共用，为None时新建workers个线程
+        """
+        self.synthesize: Optional[Callable[[str, str], bytes]] = synthesize
+        self.play: Callable[[bytes, threading.Event], None] = play if play is not None else WavPlayer()
+        self.voice: str = voice
+        self.prefetch: int = prefetch
+        self.cache: PhraseCache = cache
+        self._owns_executor: bool = executor is None
+        self._executor = executor if executor is not None else ThreadPoolExecutor(workers, thread_name_prefix="tts-synth")
+        self._speeches: "queue.Queue" = queue.Queue()
+        self._current: Speech = None
+        self._lock = threading.Lock()
+        self.clauses: int = 0
+        self.synthesized: int = 0
+        self.errors: int = 0
+        # 停止时还没有合成就放弃的分句数，以及已经合成(或正在合成)但没有播放的分句数
+        self.skipped: int = 0
+        self.discarded: int = 0
+        self.synth_seconds: float = 0
+        # 播放线程等待合成的时间，即分句之间听得到的停顿
+        self.wait_seconds: float = 0
+        self._player = threading.Thread(target=self._run, name="tts-player", daemon=True)
+        self._player.start()
+
+    def start(self) -> Speech:
+        """
+        # 开始一次回答的语音，打断正在播放的上一次回答
+        """
+        speech = Speech(self)
+        with self._lock:
+            previous, self._current = self._current, speech
+        if previous is not None:
+            previous.stop()
+        self._speeches.put(speech)
+        return speech
+
+    def stop(self):
+        """
+        # 停止正在播放的回答，例如开始录音时
+        """
+        with self._lock:
+            speech = self._current
+        if speech is not None:
+            speech.stop()
+
+    def _count_stopped(self, skipped: int, discarded: int):
+        with self._lock:
+            self.skipped += skipped
+            self.discarded += discarded
+
+    def synthesize_async(self, text: str) -> Future:
+        """
+        # 合成一个分句，缓存中有时直接返回；没有synthesize时直接返回分句文本
+        """
+        if self.synthesize is None:
+            future: Future = Future()
+            future.set_result(text)
+            return future
+        audio = self.cache.get(text, self.voice) if self.cache is not None else None
+        if audio is not None:
+            future: Future = Future()
+            future.set_result(audio)
+            return future
+        return self._executor.submit(self._synthesize, text)
+
+    def _synthesize(self, text: str) -> bytes:
+        start = time.perf_counter()
+        audio = self.synthesize(text, self.voice)
+        with self._lock:
+            self.synthesized += 1
+            self.synth_seconds += time.perf_counter() - start
+        if self.cache is not None:
+            self.cache.put(text, self.voice, audio)
+        return audio
+
+    def _run(self):
+        while True:
+            speech: Speech = self._speeches.get()
+            if speech is None:
+                return
+            while True:
+                future = speech._next()
+                if future is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    audio = future.result()
+                except CancelledError:
+                    break
+                except Exception as e:
+                    print(e)
+                    with self._lock:
+                        self.errors += 1
+                    continue
+                with self._lock:
+                    self.clauses += 1
+                    self.wait_seconds += time.perf_counter() - start
+                if speech.stopped.is_set():
+                    break
+                self.play(audio, speech.stopped)
+
+    def close(self):
+        """
+        # 停止播放，结束播放线程，合成线程池是自己创建的时一起关闭
+        """
+        self.stop()
+        self._speeches.put(None)
+        self._player.join()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        """
+        # 播放的分句数、实际合成的次数、停止时放弃和白白合成的分句数、合成的平均耗时、分句之间平均等待合成的时间，
+        # 以及缓存的统计
+        """
+        with self._lock:
+            stats = {
+                "clauses": self.clauses,
+                "synthesized": self.synthesized,
+                "errors": self.errors,
+                "skipped": self.skipped,
+                "discarded": self.discarded,
+                "synth_time_avg": self.synth_seconds / self.synthesized if self.synthesized else 0,
+                "wait_time_avg": self.wait_seconds / self.clauses if self.clauses else 0,
+            }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,84 @@
+"""
+tts_pipeline.py的测试：用耗时模拟的合成和播放函数连续回答多个问题，统计第一句开始播放的延迟、
+分句之间等待合成的停顿、实际合成的次数和第一个回答之后线程数的增长，对比不缓存(每个分句都合成)与缓存常见分句
+使用方式 python tts_pipeline_benchmark.py --answers 20 --synth 0.3 --char-seconds 0.01
+"""
+import time
+import random
+import argparse
+import threading
+from typing import List
+from tts_pipeline import PhraseCache, TTSPipeline
+
+COMMON = ["查询结果如下，", "山东高速集团有限公司", "欠款金额为", "亿元。", "担保方为", "以上是全部结果。"]
+
+
+def make_answers(num: int, seed: int = 0) -> List[List[str]]:
+    """
+    # 每个回答由常见的模板分句和各不相同的分句组成
+    """
+    rng = random.Random(seed)
+    answers: List[List[str]] = []
+    for i in range(num):
+        clauses = [COMMON[0]]
+        for j in range(rng.randint(3, 6)):
+            clauses.append(rng.choice(COMMON[1:5]) if rng.random() < 0.5 else f"第{i}个回答的第{j}句，")
+        clauses.append(COMMON[5])
+        answers.append(clauses)
+    return answers
+
+
+def run(answers: List[List[str]], synth: float, char_seconds: float, cache: PhraseCache, prefetch: int) -> dict:
+    first_audio: List[float] = []
+    done = threading.Event()
+    started = [0.0]
+
+    def synthesize(text: str, voice: str) -> bytes:
+        time.sleep(synth)
+        return text.encode("utf-8")
+
+    def play(audio: bytes, stopped: threading.Event):
+        if len(first_audio) < answer_index[0] + 1:
+            first_audio.append(time.perf_counter() - started[0])
+        time.sleep(len(audio.decode("utf-8")) * char_seconds)
+        if audio.decode("utf-8") == COMMON[5]:
+            done.set()
+
+    answer_index = [0]
+    pipeline = TTSPipeline(synthesize, play, workers=2, prefetch=prefetch, cache=cache)
+    start = time.perf_counter()
+    for i, clauses in enumerate(answers):
+        answer_index[0] = i
+        done.clear()
+        started[0] = time.perf_counter()
+        speech = pipeline.start()
+        for clause in clauses:
+            speech.add(clause)
+        speech.close()
+        done.wait()
+        if i == 0:
+            threads_after_first = threading.active_count()
+    wall = time.perf_counter() - start
+    stats = pipeline.stats()
+    stats.update(wall=wall, thread_growth=threading.active_count() - threads_after_first,
+                 first_audio_avg=sum(first_audio) / len(first_audio))
+    pipeline.close()
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--answers", type=int, default=20)
+    parser.add_argument("--synth", type=float, default=0.3, help="模拟合成一个分句的耗时(秒)")
+    parser.add_argument("--char-seconds", type=float, default=0.01, help="模拟播放每个字的耗时(秒)")
+    parser.add_argument("--prefetch", type=int, default=3)
+    args = parser.parse_args()
+
+    answers = make_answers(args.answers)
+    for name, cache, prefetch in (("no prefetch, no cache", None, 1), ("prefetch, no cache", None, args.prefetch),
+                                  ("prefetch + cache", PhraseCache(), args.prefetch)):
+        stats = run(answers, args.synth, args.char_seconds, cache, prefetch)
+        print(f"{name:>22}: wall={stats['wall']:.2f}s clauses={stats['clauses']} "
+              f"synthesized={stats['synthesized']} first_audio_avg={stats['first_audio_avg'] * 1000:.0f}ms "
+              f"wait_time_avg={stats['wait_time_avg'] * 1000:.0f}ms thread_growth={stats['thread_growth']}"
+              + (f" hit_rate={stats['cache']['hit_rate']:.2f}" if "cache" in stats else ""))
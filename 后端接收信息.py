@@ -3,18 +3,238 @@ sys.path.append("/home/yuankun/debt/")
 from src.utils import Neo4jConnect
 # 初始化Neo4j的连接
 Neo4jConnect(config_path="./utils/config.yml")
+from neo4j_pool import Neo4jPool
+# 初始化Neo4j的连接池，多线程处理请求时每次查询从池中取出连接，Neo4jDao默认使用该连接池
+Neo4jPool.install(Neo4jPool.from_graph(Neo4jConnect.get_connect(), size=16, timeout=10))
+from single_flight import SingleFlight
+# 同时到达的相同图查询只执行一次，Neo4jDao默认使用
+SingleFlight.install(SingleFlight())
 from src.service import Neo4jService
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, stream_with_context
 from blueprint import neo4j_blueprint
 from src.债券关系大模型问答.debt_llm import DebtLLM
+from neo4j_dao import streaming, add_default_hook, add_invalidation_hook
+from neo4j_page import paging
+from neo4j_metrics import QueryMetrics
+from session_store import SessionStore, SharedModel
+from answer_cache import AnswerCache
+from llm_stream import TokenStream, format_sse, stream_chat_models
+from llm_batcher import LLMBatcher, batch_chat, batch_chat_models
+from cancellation import Cancelled, CancelRegistry, CancelToken, cancel_scope, current_cancel
+from werkzeug.serving import WSGIRequestHandler
+import json
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
 app: Flask = Flask(__name__)
 
 # 注册子路由
 app.register_blueprint(neo4j_blueprint)
 
+# 统计每个DAO查询方法的耗时、行数和字节数，通过/metrics查看
+metrics = QueryMetrics()
+add_default_hook(metrics)
+
 ns = Neo4jService()
-dllm = DebtLLM()
+# 全部会话共用一个DebtLLM，每个session_id只保存对话状态，最多1000个会话，空闲30分钟清除，被淘汰的会话保存到磁盘
+llm = SharedModel(DebtLLM())
+# DebtLLM调用模型的chat时改用stream_chat，逐段生成的文本通过emit_token由stream=sse的响应发出
+stream_chat_models(llm.model)
+# 非流式的请求中DebtLLM调用的chat进入微批队列，并发请求最多8个一起生成，批大小和排队情况通过/metrics和/api/llm/查看
+LLMBatcher.install(LLMBatcher(batch_chat, max_batch_size=8, max_wait=0.01))
+batch_chat_models(llm.model)
+sessions = SessionStore(llm.new_state, max_sessions=1000, idle_ttl=1800, spill_dir="./session_spill")
+
+
+@contextmanager
+def conversation(session_id: str):
+    """
+    # 在with语句中独占使用某个会话，得到带有该会话对话状态的DebtLLM
+    :param session_id: 会话id
+    """
+    with sessions.session(session_id) as state, llm.bind(state) as dllm:
+        yield dllm
+
+
+def load_entities() -> list:
+    """
+    # 从neo4j读取全部公司名称，作为答案缓存识别实体的词表
+    """
+    with Neo4jPool.get_pool().session() as graph:
+        return [record["name"] for record in graph.run("MATCH (n) WHERE n:Level1 OR n:Level2 RETURN DISTINCT n.name AS name")]
+
+
+# 同一个问题的不同说法直接返回缓存的答案，不经过大模型和图查询，缓存10分钟，公司名称在第一次使用时读取，
+# Neo4jDao.invalidate_cache时一起清空
+answers = AnswerCache(max_size=2000, ttl=600, loader=load_entities)
+add_invalidation_hook(answers.invalidate)
+# 同时到达的相同问题只调用一次process_control
+flights = SingleFlight()
+# 每个会话正在执行的请求，新请求或/api/cancel/request取消时停止大模型生成和图查询
+cancels = CancelRegistry()
+CancelRegistry.install(cancels)
+
+
+def run_query(session_id: str, user_query: str):
+    """
+    # 在会话中执行一次问答
+    :return: (执行问答的会话id, process_control的输出)
+    """
+    with conversation(session_id) as dllm:
+        return session_id, dllm.process_control(ns, user_query)
+
+
+def coalesced_query(session_id: str, user_query: str):
+    """
+    # 合并同时到达的相同问题：识别出实体的问题与对话上下文无关，不同会话共享同一次计算；
+    # 其它问题(例如追问)只合并同一个会话的重复请求(例如前端重试)
+    :param session_id: 会话id
+    :param user_query: 用户的问题
+    :return: process_control的输出
+    """
+    question = answers.question_key(user_query)
+    key = ("question", question) if question is not None else ("session", session_id, user_query)
+    try:
+        (leader, output), shared = flights.do(key, run_query, session_id, user_query)
+    except Cancelled:
+        token = current_cancel.get()
+        if token is not None and token.cancelled:
+            raise
+        # 合并到的计算属于已经取消的其它请求，本次请求自己执行
+        return run_query(session_id, user_query)[1]
+    if not shared or leader == session_id:
+        return output
+    if type(output) is str:
+        # 字符串多为追问或提示，会改变执行问答的会话的对话状态，本会话需要自己执行
+        return run_query(session_id, user_query)[1]
+    # 与process_control一致，查询成功后初始化对话状态
+    with conversation(session_id) as dllm:
+        dllm.refresh()
+    return output
+
+
+def is_neo4j_stream(data) -> bool:
+    """
+    # stream=1时output["data"]["data"]是否需要以NDJSON分块返回：Neo4jDao流模式的生成器，
+    # 以及不支持流模式的查询(例如内存后端、汇总索引)返回的([count], json字符串)。
+    # 只能在stream=1时调用，其它请求(例如cursor分页返回的([{"total", "next"}], json字符串))形式相同但不是流
+    """
+    return isinstance(data, Iterator) or isinstance(data, tuple) and len(data) == 2 and isinstance(data[1], str)
+
+
+def ndjson_lines(rows) -> Iterator[str]:
+    """
+    # 把 :func:`is_neo4j_stream`的数据统一为NDJSON行，([count], json字符串)拆成逐条记录，
+    # 生成器中的dict序列化为一行，其它类型的数据抛出TypeError
+    """
+    if isinstance(rows, tuple):
+        records = json.loads(rows[1])
+        for record in records if isinstance(records, list) else [records]:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    for chunk in rows:
+        if isinstance(chunk, dict):
+            chunk = json.dumps(chunk, ensure_ascii=False) + "\n"
+        elif not isinstance(chunk, str):
+            raise TypeError(f"unexpected neo4j stream item: {type(chunk).__name__}")
+        yield chunk
+
+
+def stream_neo4j_data(output: dict, token: CancelToken):
+    """
+    # 以NDJSON分块返回neo4j数据，第一行是不含数据的响应头，之后每一行是一条记录。
+    # 数据在Flask发送响应时才从neo4j读取，全部发送完、取消或网关断开连接后才结束请求。
+    # 读取中出错时最后一行是output_type为error的错误事件，不会中断chunked响应
+    :param output: process_control返回的neo4j数据，output["data"]["data"]满足 :func:`is_neo4j_stream`
+    :param token: 请求的取消令牌，结束时由本函数调用 :class:`CancelRegistry.finish`
+    """
+    rows = output["data"]["data"]
+    try:
+        head = dict(output)
+        head["data"] = {key: value for key, value in output["data"].items() if key != "data"}
+        if isinstance(rows, tuple):
+            head["data"].setdefault("count", rows[0])
+        yield json.dumps({'output': head, 'output_type': "neo4j_data"}, ensure_ascii=False) + "\n"
+        for chunk in ndjson_lines(rows):
+            yield chunk
+    except GeneratorExit:
+        token.cancel("client disconnected")
+        raise
+    except Cancelled:
+        yield json.dumps(cancelled_output(token), ensure_ascii=False) + "\n"
+    except Exception as e:
+        print(e)
+        yield json.dumps({'output': str(e), 'output_type': "error"}, ensure_ascii=False) + "\n"
+    finally:
+        # 关闭DAO的生成器，归还它占用的连接
+        close = getattr(rows, "close", None)
+        if close is not None:
+            close()
+        cancels.finish(token)
+
+
+def cancelled_output(token: CancelToken) -> dict:
+    """
+    # 请求被取消时的响应
+    """
+    return {'output': "", 'output_type': "cancelled", 'request_id': token.request_id, 'reason': token.reason}
+
+
+def stream_answer(session_id: str, user_query: str, cacheable: bool, token: CancelToken):
+    """
+    # 以SSE返回大模型生成的文本，每段文本一个token事件，最后一个final事件是与非流式响应相同的结构化结果，
+    # 并带上首个token和全部完成的耗时(秒)。大模型没有逐段输出时，字符串结果作为一个token事件发送。
+    # 请求被取消或网关断开连接时，大模型在下一个检查点停止，final事件的output_type为cancelled
+    :param session_id: 会话id
+    :param user_query: 用户的问题
+    :param cacheable: 是否写入答案缓存
+    :param token: 请求的取消令牌，结束时由本函数调用 :class:`CancelRegistry.finish`
+    """
+    start = time.perf_counter()
+    first_token = None
+    try:
+        with conversation(session_id) as dllm:
+            with cancel_scope(token):
+                tokens = TokenStream(dllm.process_control, ns, user_query)
+            try:
+                for text in tokens:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    # 取消后不再发送，继续等待后台线程在检查点停止，之后才能释放会话
+                    if not token.cancelled:
+                        yield format_sse("token", {'text': text})
+            except GeneratorExit:
+                token.cancel("client disconnected")
+                try:
+                    for _ in tokens:
+                        pass
+                except Exception:
+                    pass
+                raise
+        if token.cancelled:
+            raise Cancelled(token.reason)
+    except Cancelled:
+        yield format_sse("final", cancelled_output(token))
+        return
+    finally:
+        cancels.finish(token)
+    output = tokens.result
+    if type(output) is str:
+        output_type = "string"
+        if tokens.tokens == 0 and output:
+            first_token = time.perf_counter() - start
+            yield format_sse("token", {'text': output})
+    else:
+        output = dict(output)
+        output_type = "neo4j_data"
+        if cacheable:
+            answers.put(user_query, output, output_type)
+    yield format_sse("final", {
+        'output': output,
+        'output_type': output_type,
+        'timing': {'first_token': first_token, 'total': time.perf_counter() - start}
+    })
 
 
 @app.route("/api/v1/", methods=["GET", "POST"])
@@ -25,28 +245,148 @@ def get_result():
         params = request.args
         print("-----------post",params)
         user_query = params.get('text')
-        output = dllm.process_control(ns, user_query)
+        session_id = params.get('session_id', 'default')
+        # stream=sse时以Server-Sent Events逐段返回大模型生成的文本，最后返回结构化结果，用于尽早开始语音合成
+        sse = params.get('stream') == 'sse'
+        # 流式和分页的响应依赖本次查询的状态，不使用答案缓存
+        cacheable = params.get('stream') != '1' and params.get('cursor') is None
+        # 同一个会话的新请求取消上一个还在执行的请求(用户打断)，request_id用于/api/cancel/request取消本次请求
+        token = cancels.begin(session_id, params.get('request_id'))
+        finish = True
+        try:
+            with cancel_scope(token):
+                if cacheable:
+                    hit, output, output_type = answers.get(user_query)
+                    if hit:
+                        # 与process_control一致，查询成功后初始化对话状态
+                        with conversation(session_id) as dllm:
+                            dllm.refresh()
+                        if sse:
+                            return Response(format_sse("final", {'output': output, 'output_type': output_type}),
+                                            content_type="text/event-stream; charset=utf-8")
+                        return jsonify({'output': output, 'output_type': output_type})
+                if sse:
+                    finish = False
+                    return Response(stream_with_context(stream_answer(session_id, user_query, cacheable, token)),
+                                    content_type="text/event-stream; charset=utf-8",
+                                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+                if cacheable:
+                    output = coalesced_query(session_id, user_query)
+                    page = {'after': None}
+                else:
+                    # stream=1时Neo4jDao以NDJSON的流返回数据，这里以chunked响应逐块发送
+                    # cursor为keyset分页的续页token，空字符串表示第一页，响应中的next_cursor用于请求下一页
+                    with streaming(params.get('stream') == '1'), paging(params.get('cursor')) as page, \
+                            conversation(session_id) as dllm:
+                        output = dllm.process_control(ns, user_query)
+                if token.cancelled:
+                    raise Cancelled(token.reason)
+                if type(output) is not str:
+                    output = dict(output)
+                    data = output.get("data")
+                    if params.get('stream') == '1' and isinstance(data, dict) and is_neo4j_stream(data.get("data")):
+                        # stream=1时数据在发送响应的过程中读取，请求在stream_neo4j_data结束时才结束
+                        finish = False
+                        return Response(stream_with_context(stream_neo4j_data(output, token)),
+                                        content_type="application/x-ndjson; charset=utf-8")
+        except Cancelled:
+            return jsonify(cancelled_output(token))
+        finally:
+            if finish:
+                cancels.finish(token)
         if type(output) is str:
             output_type = "string"
         else:
-            output = dict(output)
             output_type = "neo4j_data"
+            # 只缓存查询到的neo4j数据，字符串多为追问或提示，依赖对话上下文
+            if cacheable:
+                answers.put(user_query, output, output_type)
 
         response_data = {
             'output': output,
             'output_type': output_type
         }
+        if page['after'] is not None:
+            response_data['next_cursor'] = page['next']
         return jsonify(response_data)
 
 
+# Prometheus文本格式的查询统计，format=json时返回内存中的统计数据
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.stats())
+    text = metrics.render_prometheus() + LLMBatcher.get_batcher().render_prometheus()
+    return Response(text, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# 连接池的等待时间和查询时间
+@app.route("/api/pool/", methods=["GET"])
+def pool_stats():
+    return jsonify(Neo4jPool.get_pool().stats())
+
+
 # 用户如果要放弃本次查询，需要设置初始化按钮并执行该方法
 @app.route("/api/v2/", methods=["POST"])
 def refresh_chat():
-    dllm.refresh()
+    session_id = request.args.get('session_id', 'default')
+    with conversation(session_id) as dllm:
+        dllm.refresh()
+    return jsonify({'session_id': session_id})
+
+
+# 会话数量和淘汰情况
+@app.route("/api/sessions/", methods=["GET"])
+def session_stats():
+    return jsonify(sessions.stats())
+
+
+# 大模型微批调度的批大小、队列深度和耗时
+@app.route("/api/llm/", methods=["GET"])
+def llm_stats():
+    return jsonify(LLMBatcher.get_batcher().stats())
+
+
+# 合并相同问题和相同图查询的次数
+@app.route("/api/flight/", methods=["GET"])
+def flight_stats():
+    dao_flight = SingleFlight.get_flight()
+    return jsonify({'questions': flights.stats(), 'queries': dao_flight.stats() if dao_flight else None})
+
+
+# 答案缓存的命中率和大小
+@app.route("/api/cache/", methods=["GET"])
+def cache_stats():
+    return jsonify(answers.stats())
+
+
+# 取消会话中正在执行的请求，request_id为空时取消该会话的全部请求
+@app.route("/api/cancel/request", methods=["POST"])
+def cancel_request():
+    session_id = request.args.get('session_id', 'default')
+    cancelled = cancels.cancel(session_id, request.args.get('request_id'), reason="cancelled by user")
+    return jsonify({'session_id': session_id, 'cancelled': cancelled})
+
+
+# 取消的请求数、被取消的请求浪费的耗时和取消后继续执行的耗时
+@app.route("/api/cancel/", methods=["GET"])
+def cancel_stats():
+    return jsonify(cancels.stats())
+
+
+# 债务图变化后清空答案缓存，reload=1时同时重新读取公司名称
+@app.route("/api/cache/invalidate", methods=["POST"])
+def invalidate_cache():
+    answers.invalidate()
+    if request.args.get('reload') == '1':
+        answers.set_entities(load_entities())
+    return jsonify(answers.stats())
 
 if __name__ == "__main__":
 
-    app.run(host="10.200.90.59", port=8887)
+    # HTTP/1.1时流式响应使用chunked编码，网关收到一段就能处理一段
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(host="10.200.90.59", port=8887, threaded=True)
 
 # 收到语音转为文本后，只需调用这一个方法即可，str代表返回字符串, data代表返回neo4j数据，查询成功后自动初始化
 # @app.route("/api/v1/", methods=["POST","GET"])
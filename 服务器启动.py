@@ -2,18 +2,112 @@ from flask import Flask, Response, request, jsonify, stream_with_context, render
 import requests
 import os
 import uuid
-from recorder import Recoder
-import client_asr
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pcm_recorder import PCMRecorder
+from 音频保存文件 import asr_pcm
+from streaming_asr import StreamingASR
+from llm_stream import format_sse
+from clause_segmenter import ClauseSegmenter
+from tts_pipeline import PhraseCache, TTSPipeline
 import client_tts
-import re
-from play_audio import Player
-
-recoder=Recoder()
-player_last=Player()
+import tts_client
+import json
+
+# 每个会话一个录音，PCM只保存在内存中，设置ASR_DEBUG_WAV_DIR时同时保存wav文件用于调试
+recorders = {}
+# 每个会话正在进行的增量识别，录音过程中识别已经说完的语音段，松开按钮后只需识别最后一段
+transcripts = {}
+debug_wav_dir = os.environ.get("ASR_DEBUG_WAV_DIR")
+
+
+
+
+def speak(text, stopped):
+    """
+    # 没有配置tts_client时的退路：client_tts.client_tts合成并播放一个分句，不能提前合成和缓存
+    """
+    if not stopped.is_set():
+        client_tts.client_tts(text, "zhigui")
+
+
+# 全部会话共用的合成线程和分句音频缓存，反复出现的分句从缓存直接播放，设置TTS_CACHE_DIR时同时缓存在磁盘
+tts_executor = ThreadPoolExecutor(4, thread_name_prefix="tts-synth")
+tts_cache = PhraseCache(disk_dir=os.environ.get("TTS_CACHE_DIR"))
+if not tts_client.configured():
+    print("没有设置ALIYUN_NLS_APPKEY和ALIYUN_NLS_TOKEN，使用client_tts逐句合成并播放")
+# 每个会话一个播放线程，新的回答或开始录音只放弃本会话还没有播放的分句，不影响其它会话
+speakers = {}
+speakers_lock = threading.Lock()
+
+
+def get_tts(session_id):
+    """
+    # 获取会话的语音合成和播放流水线，第一次使用时创建
+    """
+    with speakers_lock:
+        tts = speakers.get(session_id)
+        if tts is None:
+            if tts_client.configured():
+                tts = TTSPipeline(tts_client.synthesize, voice="zhigui", prefetch=3, cache=tts_cache,
+                                  executor=tts_executor)
+            else:
+                tts = TTSPipeline(None, speak, voice="zhigui", prefetch=1, executor=tts_executor)
+            speakers[session_id] = tts
+        return tts
 
 app = Flask(__name__)
 app.secret_key = "123456"
 app.config['SESSION_TYPE'] = 'filesystem'
+def read_events(response):
+    """
+    # 解析后端stream=sse返回的Server-Sent Events
+    :param response: requests以stream=True得到的响应
+    :return: (事件名, json数据)的生成器
+    """
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+    if data:
+        yield event, json.loads("\n".join(data))
+
+
+def cancel_answer(session_id):
+    """
+    # 用户打断或取消：停止播放和还没有开始的语音合成，并让后端停止该会话正在执行的大模型生成和图查询
+    """
+    with speakers_lock:
+        tts = speakers.get(session_id)
+    if tts is not None:
+        tts.stop()
+    try:
+        requests.post(url='http://10.200.90.59:8887/api/cancel/request', params={'session_id': session_id}, timeout=2)
+    except requests.RequestException as e:
+        print(e)
+
+
+def get_session_id():
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    return session['session_id']
+
+
+def get_recorder():
+    session_id = get_session_id()
+    if session_id not in recorders:
+        recorders[session_id] = PCMRecorder(debug_dir=debug_wav_dir)
+    return recorders[session_id]
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -23,57 +117,39 @@ def stream():
 
     print('收到前端SEND指令')
 
-    global player_last
-
-    if player_last:
-        try:
-            player_last.refresh_sound()
-            print("调用成功")
-            player_last.stop()
-            del player_last
-        except Exception as e:
-            print("except")
-            print(e)
-            pass
-
-
-    if 'session_id' not in session:
-        session_id = str(uuid.uuid4())
-        session['session_id'] = session_id
-    session_id = session['session_id']
+    session_id = get_session_id()
     text = request.args.get('text')
-    params = {'text':text,'session_id': session_id}
+    # stream=sse时后端边生成边返回文本，收到一句就开始语音合成，不用等待完整的回答
+    # 同一个会话的新请求在后端会取消上一个还在执行的请求
+    params = {'text':text,'session_id': session_id, 'stream': 'sse', 'request_id': str(uuid.uuid4())}
     print(text, session_id)
     response = requests.post(url='http://10.200.90.59:8887/api/v1/', params=params, stream=True)
     # response = requests.post(url='http://10.200.90.59:8887/api/v1/', json={'text': text})
     # response = get_result(params)
-    player_current = Player()
-    player_current.t1.start()
-    player_current.t2.start()
+    # 打断上一次回答的播放
+    speech = get_tts(session_id).start()
 
 
     def generator_result():
-        read_sentence=""
-        pattern = r"[，。！？?!,]"
-        for chunk in response.iter_content(chunk_size=20, decode_unicode=True):
-            if chunk:
-                yield chunk
-                read_sentence += chunk.strip()
-
-                if len(re.findall(pattern,read_sentence))>=1:
-                    remain_sentence = re.split(pattern, read_sentence)[-1]
-                    read_sentence = read_sentence.replace(remain_sentence, "")
-                    player_current.add(read_sentence)
-                    read_sentence=remain_sentence
-
-            else:
-                client_tts.client_tts(read_sentence,"zhigui")
-
-
+        # token事件的文本按句交给语音合成，final事件是结构化结果，原样返回给前端
+        # 分句器只扫描新收到的文本，过短的分句合并后再合成。token原样交给分句器，英文单词、数字之间的空格
+        # 和换行不会丢失，只在交给语音合成时去掉分句两端的空白
+        segmenter = ClauseSegmenter(min_len=4, max_len=60)
+        try:
+            for event, data in read_events(response):
+                if event == "token":
+                    for clause in segmenter.feed(data['text']):
+                        speech.add(clause.strip())
 
-    player_last = player_current
+                elif event == "final":
+                    remain_sentence = segmenter.flush().strip()
+                    if remain_sentence:
+                        speech.add(remain_sentence)
+                    yield json.dumps(data, ensure_ascii=False)
+        finally:
+            speech.close()
 
-    return Response(stream_with_context(generator_result()), content_type=response.headers["Content-Type"])
+    return Response(stream_with_context(generator_result()), content_type="application/json; charset=utf-8")
 
 
 # def get_result(params):
@@ -86,7 +162,7 @@ def stream():
 @app.route('/cancel', methods=['GET', 'POST'])
 def cancel():
     print('收到前端CANCEL指令')
-    # 执行的逻辑
+    cancel_answer(get_session_id())
     return '200'
 
 @app.route('/recordStart', methods=['POST','GET'])
@@ -94,36 +170,68 @@ def recordStart():
 
     print('收到前端recordStart指令')
 
-    global player_last
-    if player_last:
-        try:
-            player_last.stop()
-        except Exception as e:
-            print("except")
-            print(e)
-            pass
-    print("没有毛病")
-    recoder.start()
+    # 开始说话即打断正在进行的回答
+    cancel_answer(get_session_id())
+    recorder = get_recorder()
+    transcript = StreamingASR(asr_pcm, sn=get_session_id())
+    old = transcripts.pop(get_session_id(), None)
+    if old is not None:
+        old.cancel()
+    transcripts[get_session_id()] = transcript
+    recorder.on_frames = transcript.feed
+    recorder.start()
     # 执行的逻辑
     return '200'
 
 @app.route('/recordStop', methods=['POST','GET'])
 def recordStop():
     print('收到前端recordStop指令')
-    recoder.stop()
-    file_list=os.listdir()
-    if "output.wav" in file_list:
-        record_content=client_asr.client_asr("./output.wav")
+    # 录音直接以内存中的PCM交给语音识别，不再经过output.wav
+    recorder = get_recorder()
+    pcm = recorder.stop()
+    recorder.on_frames = None
+    transcript = transcripts.pop(get_session_id(), None)
+    if transcript is not None:
+        record_content = transcript.finish(timeout=30)
+        if record_content:
+            return record_content
+    if pcm:
+        record_content=asr_pcm(pcm)
         return record_content
     else:
         return "未识别，请重新录音"
     # 执行的逻辑
 
 
+# 录音过程中以Server-Sent Events返回临时识别结果(MID_TEXT)，松开按钮后返回最终结果(FIN_TEXT)并结束
+@app.route('/recordPartial', methods=['GET'])
+def recordPartial():
+    transcript = transcripts.get(get_session_id())
+
+    def generator_events():
+        if transcript is None:
+            return
+        for event in transcript.events(timeout=60):
+            yield format_sse(event["type"], event)
+
+    return Response(stream_with_context(generator_events()), content_type="text/event-stream; charset=utf-8",
+                    headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/recordLeave', methods=['POST','GET'])
 def recordLeave():
     print('收到前端recordLeave指令')
-    recoder.refresh()
+    transcript = transcripts.pop(get_session_id(), None)
+    if transcript is not None:
+        transcript.cancel()
+    recorder = recorders.pop(get_session_id(), None)
+    if recorder is not None:
+        recorder.stop()
+        recorder.refresh()
+    with speakers_lock:
+        tts = speakers.pop(get_session_id(), None)
+    if tts is not None:
+        tts.close()
     # 执行的逻辑
     return '200'
 
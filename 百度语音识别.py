@@ -1,12 +1,11 @@
-import pyaudio
 # -*- coding: utf-8 -*-
 """
 实时流式识别
 需要安装websocket-client库
-使用方式 python realtime_asr.py 16k-0.pcm
+使用方式 python realtime_asr.py 16k-0.pcm --speed 1        回放pcm文件，speed为回放倍速，0表示不限速
+        python realtime_asr.py --mic                      使用麦克风
 """
 import websocket
-import pyaudio
 
 import threading
 import time
@@ -16,11 +15,9 @@ import logging
 import string
 import sys
 import re
-
-if len(sys.argv) < 2:
-    pcm_file = "16k-0.pcm"
-else:
-    pcm_file = sys.argv[1]
+import signal
+import argparse
+from collections import deque
 
 logger = logging.getLogger()
 
@@ -29,7 +26,7 @@ logger = logging.getLogger()
 1. 连接 ws_app.run_forever()
 2. 连接成功后发送数据 on_open()
 2.1 发送开始参数帧 send_start_params()
-2.2 发送音频数据帧 send_audio()
+2.2 发送音频数据帧 send_audio()，音频由录音线程或文件回放线程写入环形缓冲区，发送线程只负责从缓冲区取出并发送
 2.3 库接收识别结果 on_message()
 2.4 发送结束帧 send_finish()
 3. 关闭连接 on_close()
@@ -37,6 +34,181 @@ logger = logging.getLogger()
 库的报错 on_error()
 """
 
+RATE = 16000
+CHUNK_MS = 160  # 每帧160ms的录音
+CHUNK_LEN = int(RATE * 2 / 1000 * CHUNK_MS)
+
+
+class RingBuffer:
+    """
+    录音和发送之间的环形缓冲区，写入方(麦克风回调或文件回放)与发送方解耦。
+    缓冲区满时：block=False(实时录音)丢弃最旧的数据，保证延迟有上限；block=True(文件回放)等待发送方取走，不丢数据，
+    每次写入空闲的部分，大于缓冲区的数据也能写完
+    """
+
+    def __init__(self, capacity: int = CHUNK_LEN * 25):
+        """
+        :param capacity: 缓冲区的字节数，默认4秒的录音
+        """
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        # (写入的累计字节数, 写入时间)，用于统计每帧从录到发送的延迟
+        self._marks = deque()
+        self._written = 0
+        self._read = 0
+        self.dropped = 0
+        self.blocked_time = 0.0
+        self.high_watermark = 0
+
+    def write(self, data: bytes, block: bool = False):
+        now = time.perf_counter()
+        with self._cond:
+            if not block:
+                self._append(data, now)
+                return
+            # 每次写入当前空闲的部分，缓冲区满时等发送方取走再写剩下的，
+            # 不等待整块数据的空间，数据大于缓冲区或发送方在等待整帧时也不会互相等待
+            while data:
+                start = time.perf_counter()
+                self._cond.wait_for(lambda: self._closed or self._size < self.capacity)
+                self.blocked_time += time.perf_counter() - start
+                free = len(data) if self._closed else self.capacity - self._size
+                self._append(data[:free], now)
+                data = data[free:]
+
+    def _append(self, data: bytes, now: float):
+        """
+        # 在持有锁时写入数据，超出缓冲区的部分丢弃最旧的数据
+        """
+        overflow = self._size + len(data) - self.capacity
+        if overflow > 0:
+            # 丢弃最旧的数据
+            drop = min(overflow, self._size)
+            self._start = (self._start + drop) % self.capacity
+            self._size -= drop
+            self._read += drop
+            self.dropped += drop
+            # 比缓冲区还大的数据只保留最新的部分
+            self.dropped += max(len(data) - self.capacity, 0)
+            data = data[-self.capacity:]
+        end = (self._start + self._size) % self.capacity
+        first = min(len(data), self.capacity - end)
+        self._buf[end:end + first] = data[:first]
+        self._buf[:len(data) - first] = data[first:]
+        self._size += len(data)
+        self._written += len(data)
+        self._marks.append((self._written, now))
+        self.high_watermark = max(self.high_watermark, self._size)
+        self._cond.notify_all()
+
+    def read(self, size: int, timeout: float = None):
+        """
+        # 取出size字节，不足时等待，关闭后返回剩余的数据
+        :return: (数据, 其中最后一个字节的写入时间)，没有数据且已关闭时数据为b""
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._size >= size or self._closed, timeout)
+            size = min(size, self._size)
+            first = min(size, self.capacity - self._start)
+            data = bytes(self._buf[self._start:self._start + first]) + bytes(self._buf[:size - first])
+            self._start = (self._start + size) % self.capacity
+            self._size -= size
+            self._read += size
+            captured = None
+            while self._marks and self._marks[0][0] <= self._read:
+                captured = self._marks.popleft()[1]
+            if captured is None and self._marks and size:
+                captured = self._marks[0][1]
+            self._cond.notify_all()
+            return data, captured
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class MicCapture:
+    """
+    以回调的方式从麦克风录音写入环形缓冲区，录音不阻塞发送
+    """
+
+    def __init__(self, ring: RingBuffer):
+        self.ring = ring
+        self._stop = threading.Event()
+
+    def run(self):
+        import pyaudio
+        pa = pyaudio.PyAudio()
+
+        def callback(in_data, frame_count, time_info, status):
+            self.ring.write(in_data, block=False)
+            return None, pyaudio.paContinue
+
+        # 设置音频输入参数
+        stream = pa.open(format=pyaudio.paInt16,
+                         channels=1,
+                         rate=RATE,
+                         input=True,
+                         frames_per_buffer=CHUNK_LEN // 2,
+                         stream_callback=callback)
+        try:
+            stream.start_stream()
+            self._stop.wait()
+        finally:
+            # 关闭音频输入流
+            stream.stop_stream()
+            stream.close()
+            pa.terminate()
+            self.ring.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+class FileReplay:
+    """
+    按实时或加速的速度回放16k 16位单声道pcm文件，不需要麦克风，用于可复现的延迟测试
+    """
+
+    def __init__(self, ring: RingBuffer, pcm_file: str, speed: float = 1.0):
+        """
+        :param ring: 环形缓冲区
+        :param pcm_file: pcm文件
+        :param speed: 回放倍速，1为实时，0为不限速
+        """
+        self.ring = ring
+        self.pcm_file = pcm_file
+        self.speed = speed
+        self._stop = threading.Event()
+
+    def run(self):
+        start = time.perf_counter()
+        sent_ms = 0
+        try:
+            with open(self.pcm_file, "rb") as f:
+                while not self._stop.is_set():
+                    pcm = f.read(CHUNK_LEN)
+                    if not pcm:
+                        break
+                    if self.speed > 0:
+                        # 按绝对时间安排每一帧，不累积sleep的误差
+                        delay = start + sent_ms / 1000.0 / self.speed - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self.ring.write(pcm, block=True)
+                    sent_ms += len(pcm) / (RATE * 2 / 1000)
+        finally:
+            self.ring.close()
+
+    def stop(self):
+        self._stop.set()
+        self.ring.close()
+
 
 def send_start_params(ws):
     """
@@ -59,38 +231,26 @@ def send_start_params(ws):
     ws.send(body, websocket.ABNF.OPCODE_TEXT)
     logger.info("send START frame with params:" + body)
 
-def send_audio(ws):
+def send_audio(ws, ring, stats=None):
     """
-    实时获取麦克风音频数据并发送
+    从环形缓冲区取出音频数据并发送，节奏由写入方决定，这里不再sleep
     :param  websocket.WebSocket ws:
+    :param RingBuffer ring: 录音或文件回放写入的缓冲区
+    :param dict stats: 不为None时写入frames、bytes和每帧从录到发送的延迟send_lag_avg、send_lag_max(秒)
     :return:
     """
-    chunk_ms = 160  # 160ms的录音
-    chunk_len = int(16000 * 2 / 1000 * chunk_ms)
-
-    # 设置音频输入参数
-    pa = pyaudio.PyAudio()
-    stream = pa.open(format=pyaudio.paInt16,
-                     channels=1,
-                     rate=16000,
-                     input=True,
-                     frames_per_buffer=chunk_len)
-
-    try:
-        while True:
-            # 实时读取麦克风音频数据
-            pcm = stream.read(chunk_len)
-            # 发送音频数据
-            ws.send(pcm, websocket.ABNF.OPCODE_BINARY)
-            time.sleep(chunk_ms / 1000.0)  # ws.send 也有点耗时，这里没有计算
-    except KeyboardInterrupt:
-        # 捕获 Ctrl+C 信号，停止读取音频并发送结束帧
-        send_finish(ws)
-    finally:
-        # 关闭音频输入流
-        stream.stop_stream()
-        stream.close()
-        pa.terminate()
+    frames, size, lag_sum, lag_max = 0, 0, 0.0, 0.0
+    while True:
+        pcm, captured = ring.read(CHUNK_LEN)
+        if not pcm:
+            break
+        # 发送音频数据
+        ws.send(pcm, websocket.ABNF.OPCODE_BINARY)
+        lag = time.perf_counter() - captured if captured is not None else 0.0
+        frames, size, lag_sum, lag_max = frames + 1, size + len(pcm), lag_sum + lag, max(lag_max, lag)
+    if stats is not None:
+        stats.update(frames=frames, bytes=size, send_lag_avg=lag_sum / frames if frames else 0, send_lag_max=lag_max,
+                     dropped=ring.dropped, blocked_time=ring.blocked_time, high_watermark=ring.high_watermark)
 
 
 def send_finish(ws):
@@ -121,25 +281,33 @@ def send_cancel(ws):
     logger.info("send Cancel frame")
 
 
-def on_open(ws):
+def make_on_open(source, stats=None):
     """
-    连接后发送数据帧
-    :param  websocket.WebSocket ws:
-    :return:
+    连接后在发送线程中发送数据帧，录音或回放在另一个线程中进行
+    :param source: MicCapture或FileReplay
+    :param dict stats: 详细见send_audio，另外写入finish_time(发送结束帧的时间)
+    :return: on_open回调
     """
 
-    def run(*args):
-        """
-        发送数据帧
-        :param args:
-        :return:
-        """
-        send_start_params(ws)
-        send_audio(ws)
-        send_finish(ws)
-        logger.debug("thread terminating")
+    def on_open(ws):
+
+        def run(*args):
+            """
+            发送数据帧
+            :param args:
+            :return:
+            """
+            send_start_params(ws)
+            send_audio(ws, source.ring, stats)
+            send_finish(ws)
+            if stats is not None:
+                stats["finish_time"] = time.perf_counter()
+            logger.debug("thread terminating")
 
-    threading.Thread(target=run).start()
+        threading.Thread(target=source.run, daemon=True).start()
+        threading.Thread(target=run).start()
+
+    return on_open
 
 
 def on_message(ws, message):
@@ -167,7 +335,7 @@ def on_error(ws, error):
     logger.error("error: " + str(error))
 
 
-def on_close(ws):
+def on_close(ws, *args):
     """
     Websocket关闭
     :param websocket.WebSocket ws:
@@ -177,16 +345,56 @@ def on_close(ws):
     # ws.close()
 
 
+def run(uri, source, on_message=on_message, stats=None):
+    """
+    连接并发送一次识别的全部帧，直到连接关闭
+    :param uri: 识别服务的地址
+    :param source: MicCapture或FileReplay
+    :param on_message: 接收识别结果的回调
+    :param dict stats: 详细见make_on_open
+    :return:
+    """
+    ws_app = websocket.WebSocketApp(uri,
+                                    on_open=make_on_open(source, stats),  # 连接建立后的回调
+                                    on_message=on_message,  # 接收消息的回调
+                                    on_error=on_error,  # 库遇见错误的回调
+                                    on_close=on_close)  # 关闭后的回调
+
+    def on_interrupt(signum, frame):
+        # run_forever会吞掉KeyboardInterrupt并直接关闭连接，所以在信号处理函数中处理Ctrl+C：
+        # 停止录音，发送线程取完缓冲区后发送结束帧，服务端返回最后的结果并关闭连接后run_forever返回。
+        # 再次Ctrl+C时不再等待，直接关闭连接
+        logger.info("stopping, press Ctrl+C again to close the connection")
+        source.stop()
+        signal.signal(signal.SIGINT, lambda *_: ws_app.close())
+
+    # 只有主线程能设置信号处理函数
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.signal(signal.SIGINT, on_interrupt)
+    try:
+        ws_app.run_forever()
+    finally:
+        # 连接因为出错或服务端关闭而结束时同样停止录音
+        source.stop()
+        if previous is not None:
+            signal.signal(signal.SIGINT, previous)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pcm_file", nargs="?", default="16k-0.pcm")
+    parser.add_argument("--mic", action="store_true", help="使用麦克风，不回放pcm文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0为不限速")
+    parser.add_argument("--uri", default="ws://vop.baidu.com/realtime_asr")
+    args = parser.parse_args()
+
     logging.basicConfig(format='[%(asctime)-15s] [%(funcName)s()][%(levelname)s] %(message)s')
     logger.setLevel(logging.INFO)  # 调整为logging.INFO，日志会少一点
     logger.info("begin")
     # websocket.enableTrace(True)
-    uri = "ws://vop.baidu.com/realtime_asr" + "?sn=" + str(uuid.uuid1())
+    uri = args.uri + "?sn=" + str(uuid.uuid1())
     logger.info("uri is "+ uri)
-    ws_app = websocket.WebSocketApp(uri,
-                                    on_open=on_open,  # 连接建立后的回调
-                                    on_message=on_message,  # 接收消息的回调
-                                    on_error=on_error,  # 库遇见错误的回调
-                                    on_close=on_close)  # 关闭后的回调
-    ws_app.run_forever()
\ No newline at end of file
+    ring = RingBuffer()
+    source = MicCapture(ring) if args.mic else FileReplay(ring, args.pcm_file, args.speed)
+    run(uri, source)
@@ -1,53 +1,429 @@
+import io
+import sys
 import wave
+import json
+import math
+import struct
 import threading
 import http.client
+import subprocess
 import os
 import time
-from modelscope.pipelines import pipeline
-from modelscope.utils.constant import Tasks
-import torch
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator, List, Tuple, Union
 # 录音参数设置
 CHANNELS = 1
 RATE = 16000
 CHUNK = 1024
 
-if torch.cuda.is_available():
-    device_id = "cuda:0"
-else:
-    device_id = "cpu"
+# 设置为"host:port"时，asr()把音频交给共享的本地识别服务(python 音频保存文件.py --serve)，本进程不加载模型
+ASR_SERVICE = os.environ.get("ASR_SERVICE")
 
+# 音频可以是wav文件路径，也可以是内存中wav文件的内容
+Audio = Union[str, bytes, bytearray, memoryview]
 
-# 第一次运行时需要连接一下网络
-inference_pipeline = pipeline(
-    task=Tasks.auto_speech_recognition,
-    model='damo/speech_paraformer-large-vad-punc_asr_nat-zh-cn-16k-common-vocab8404-pytorch',
-    model_revision="v1.2.4",
-    device=device_id
-)
+# 第一次调用asr()时才导入torch和modelscope并加载模型，导入本模块不再有多秒的启动耗时和模型内存
+inference_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def default_device() -> str:
+    import torch
+    if torch.cuda.is_available():
+        return "cuda:0"
+    return "cpu"
+
+
+def build_pipeline(device: str = None):
+    """
+    # 创建paraformer语音识别模型，第一次运行时需要连接一下网络
+    :param device: 运行的设备，例如"cpu"或"cuda:0"，None时有GPU则使用GPU
+    """
+    from modelscope.pipelines import pipeline
+    from modelscope.utils.constant import Tasks
+    return pipeline(
+        task=Tasks.auto_speech_recognition,
+        model='damo/speech_paraformer-large-vad-punc_asr_nat-zh-cn-16k-common-vocab8404-pytorch',
+        model_revision="v1.2.4",
+        device=device or default_device()
+    )
+
+
+def get_pipeline(device: str = None):
+    """
+    # 获取本进程的模型，第一次调用时加载，多线程同时调用时只加载一次
+    :param device: 第一次加载时使用的设备
+    """
+    global inference_pipeline
+    if inference_pipeline is None:
+        with _pipeline_lock:
+            if inference_pipeline is None:
+                inference_pipeline = build_pipeline(device)
+    return inference_pipeline
+
+
+def _read_audio(audio: Audio) -> Tuple[dict, float]:
+    """
+    # 得到模型的输入参数和音频时长(秒)，内存中的wav取出PCM数据并带上采样率
+    """
+    if isinstance(audio, str):
+        with wave.open(audio, "rb") as f:
+            return {"audio_in": audio}, f.getnframes() / f.getframerate()
+    with wave.open(io.BytesIO(bytes(audio)), "rb") as f:
+        return ({"audio_in": f.readframes(f.getnframes()), "audio_fs": f.getframerate()},
+                f.getnframes() / f.getframerate())
+
+
+def asr_remote(audio: Audio, service: str = None, timeout: float = 60, rate: int = None) -> str:
+    """
+    # 通过共享的本地识别服务识别音频，详细见 :func:`serve`
+    :param audio: wav文件路径或内存中wav文件的内容，设置rate时为16位单声道PCM
+    :param service: "host:port"，None时使用ASR_SERVICE
+    :param timeout: 超时时间(秒)
+    :param rate: PCM的采样率，为None时audio为wav
+    :return: 识别结果
+    """
+    host, port = (service or ASR_SERVICE).rsplit(":", 1)
+    conn = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    try:
+        if isinstance(audio, str):
+            # 服务在同一台机器上，只传文件路径
+            body, content_type = json.dumps({"path": os.path.abspath(audio)}).encode("utf-8"), "application/json"
+        elif rate is not None:
+            # 原始PCM直接发送缓冲区，不复制
+            body, content_type = memoryview(audio).cast("B"), f"audio/L16; rate={rate}"
+        else:
+            body, content_type = audio, "audio/wav"
+        conn.request("POST", "/asr", body=body, headers={"Content-Type": content_type})
+        response = conn.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(result.get("error"))
+        return result["text"]
+    finally:
+        conn.close()
 
 
 def asr(audioFile_path) :
-    # 读取音频文件
-    rec_result = inference_pipeline(audio_in=audioFile_path)
+    # 配置了共享的识别服务时交给服务识别
+    if ASR_SERVICE:
+        return asr_remote(audioFile_path)
+    # 读取音频文件，也可以是内存中wav文件的内容
+    inputs = {"audio_in": audioFile_path} if isinstance(audioFile_path, str) else _read_audio(audioFile_path)[0]
+    rec_result = get_pipeline()(**inputs)
     rec_return = rec_result["text"]
 
     return rec_return
 
+
+def asr_pcm(pcm, rate: int = RATE) -> str:
+    """
+    # 识别内存中的16位单声道PCM，例如 :class:`PCMRecorder.stop`的返回值，不经过wav文件
+    :param pcm: PCM数据，bytes或支持buffer协议的对象(例如int16的numpy数组)
+    :param rate: 采样率
+    :return: 识别结果
+    """
+    if ASR_SERVICE:
+        return asr_remote(pcm, rate=rate)
+    audio_in = pcm if isinstance(pcm, bytes) else memoryview(pcm).tobytes()
+    return get_pipeline()(audio_in=audio_in, audio_fs=rate)["text"]
+
+
+# 模型是否支持一次输入多段音频(audio_in为list)，逐段识别确认不支持后不再尝试，详细见 :func:`_recognize_many`
+_list_input = True
+_list_input_lock = threading.Lock()
+
+
+def _recognize_many(audio_ins: list, audio_fs: int = None) -> List[Union[str, Exception]]:
+    """
+    # 一次模型调用识别多段音频(wav文件路径，或采样率相同的PCM)，列表输入失败时逐段识别。
+    # 逐段识别全部成功说明模型不支持列表输入，之后直接逐段识别；只是个别音频无法识别时仍然保留批量识别
+    :param audio_ins: 模型的audio_in
+    :param audio_fs: PCM的采样率，wav文件路径时为None
+    :return: 与audio_ins顺序相同的识别结果，识别失败的音频为异常
+    """
+    global _list_input
+    pipeline_ = get_pipeline()
+    kwargs: dict = {} if audio_fs is None else {"audio_fs": audio_fs}
+    batch_failed = False
+    if len(audio_ins) > 1 and _list_input:
+        try:
+            results = pipeline_(audio_in=list(audio_ins), **kwargs)
+            if isinstance(results, list) and len(results) == len(audio_ins):
+                return [result.get("text", "") for result in results]
+        except Exception as e:
+            print(e)
+        batch_failed = True
+    outputs: List[Union[str, Exception]] = []
+    for audio_in in audio_ins:
+        try:
+            outputs.append(pipeline_(audio_in=audio_in, **kwargs).get("text", ""))
+        except Exception as e:
+            outputs.append(e)
+    if batch_failed and not any(isinstance(output, Exception) for output in outputs):
+        with _list_input_lock:
+            _list_input = False
+    return outputs
+
+
+def asr_pcm_batch(items: List[Tuple[bytes, int]]) -> List[str]:
+    """
+    # 一次模型调用识别多段16位单声道PCM，用于多路实时识别服务跨会话合并推理，详细见 :class:`RealtimeASRServer`，
+    # 按采样率分组识别，无法识别的语音段结果为空字符串，不影响同一批的其它会话
+    :param items: (PCM数据, 采样率)的列表
+    :return: 与items顺序相同的识别结果
+    """
+    if ASR_SERVICE:
+        return [asr_remote(pcm, rate=rate) for pcm, rate in items]
+    texts: List[str] = [""] * len(items)
+    groups: dict = {}
+    for i, (_, rate) in enumerate(items):
+        groups.setdefault(rate, []).append(i)
+    for rate, indexes in groups.items():
+        outputs = _recognize_many([bytes(items[i][0]) for i in indexes], rate)
+        for i, output in zip(indexes, outputs):
+            if isinstance(output, Exception):
+                print(output)
+            else:
+                texts[i] = output
+    return texts
+
+
+def synthetic_clip(seconds: float = 1.0) -> bytes:
+    """
+    # 生成一段16k单声道的wav(440Hz的正弦波)，用于预热
+    """
+    frames = b"".join(struct.pack("<h", int(3000 * math.sin(2 * math.pi * 440 * i / RATE)))
+                      for i in range(int(RATE * seconds)))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(CHANNELS)
+        f.setsampwidth(2)
+        f.setframerate(RATE)
+        f.writeframes(frames)
+    return buffer.getvalue()
+
+
+def warmup(device: str = None) -> float:
+    """
+    # 加载模型并识别一段合成的音频，让第一个真实请求不再承担加载和首次推理的耗时
+    :param device: 加载模型使用的设备
+    :return: 耗时(秒)
+    """
+    start = time.perf_counter()
+    pipeline_ = get_pipeline(device)
+    inputs, _ = _read_audio(synthetic_clip())
+    pipeline_(**inputs)
+    return time.perf_counter() - start
+
+
+class _ASRHandler(BaseHTTPRequestHandler):
+    """
+    共享识别服务的请求处理：POST /asr，请求体为wav文件的内容、16位单声道PCM(Content-Type: audio/L16; rate=16000)
+    或{"path": wav文件路径}，返回{"text": 识别结果}
+    """
+
+    # 同一个模型的推理依次执行
+    infer_lock = threading.Lock()
+
+    def _reply(self, status: int, data: dict):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"loaded": inference_pipeline is not None})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/asr":
+            self._reply(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("application/json"):
+                inputs, _ = _read_audio(json.loads(body)["path"])
+            elif content_type.startswith("audio/L16"):
+                rate = content_type.partition("rate=")[2].split(";")[0]
+                inputs = {"audio_in": body, "audio_fs": int(rate) if rate else RATE}
+            else:
+                inputs, _ = _read_audio(body)
+            start = time.perf_counter()
+            with self.infer_lock:
+                text = get_pipeline()(**inputs)["text"]
+            self._reply(200, {"text": text, "elapsed": time.perf_counter() - start})
+        except Exception as e:
+            self._reply(500, {"error": repr(e)})
+
+
+def serve(host: str = "127.0.0.1", port: int = 8890, device: str = None):
+    """
+    # 启动共享的本地识别服务，网关的多个工作进程设置ASR_SERVICE=host:port后共用这一个模型
+    """
+    print(f"预热耗时{warmup(device):.2f}秒")
+    server = ThreadingHTTPServer((host, port), _ASRHandler)
+    print(f"语音识别服务 http://{host}:{port}/asr")
+    server.serve_forever()
+
+
+# 在新的进程中测量启动和第一个请求的耗时，{load}为导入后立即执行的代码
+_STARTUP_CODE = """
+import json, time
+start = time.perf_counter()
+import {module}
+{load}
+ready = time.perf_counter()
+{module}.asr({module}.synthetic_clip())
+print(json.dumps({{"startup": ready - start, "first_request": time.perf_counter() - ready}}))
+"""
+
+
+def measure_startup() -> dict:
+    """
+    # 在新的进程中分别测量两种方式的启动耗时和第一个请求的耗时(秒)：
+    # eager为导入时就创建模型(原来的方式)，lazy为只导入本模块、第一个请求时才创建模型
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    result: dict = {}
+    for name, load in (("eager", f"{module}.get_pipeline()"), ("lazy", "")):
+        code = _STARTUP_CODE.format(module=module, load=load)
+        output = subprocess.run([sys.executable, "-c", code], cwd=directory, check=True, capture_output=True,
+                                text=True, env=dict(os.environ, ASR_SERVICE="")).stdout
+        result[name] = json.loads(output.strip().splitlines()[-1])
+    return result
+
+
+def _init_worker(device: str, threads: int):
+    import torch
+    # 每个工作进程只使用分到的CPU核，避免多个进程的torch线程互相争抢
+    torch.set_num_threads(threads)
+    get_pipeline(device)
+
+
+def _asr_batch(batch: List[Tuple[int, Audio]]) -> List[dict]:
+    """
+    # 在工作进程中识别一批音频：wav文件路径、相同采样率的内存wav各以一次模型调用识别，
+    # 详细见 :func:`_recognize_many`，单个音频失败不影响同一批的其它音频
+    """
+    results: List[dict] = []
+    # 采样率(文件路径为None) -> [(结果, audio_in)]
+    groups: dict = {}
+    for index, audio in batch:
+        result: dict = {"index": index, "source": audio if isinstance(audio, str) else None,
+                        "text": None, "duration": 0, "error": None}
+        results.append(result)
+        try:
+            inputs, result["duration"] = _read_audio(audio)
+        except Exception as e:
+            result["error"] = repr(e)
+            continue
+        groups.setdefault(inputs.get("audio_fs"), []).append((result, inputs["audio_in"]))
+    for audio_fs, group in groups.items():
+        try:
+            outputs = _recognize_many([audio_in for _, audio_in in group], audio_fs)
+        except Exception as e:
+            outputs = [e] * len(group)
+        for (result, _), output in zip(group, outputs):
+            if isinstance(output, Exception):
+                result["error"] = repr(output)
+            else:
+                result["text"] = output
+    return results
+
+
+def asr_batch(audios: Iterable[Audio], workers: int = None, batch_size: int = 8, device: str = None,
+              stats: dict = None) -> Iterator[dict]:
+    """
+    # 使用进程池批量识别音频，每个工作进程加载一个模型，每次分给工作进程batch_size个音频，哪一批先完成先返回哪一批
+    :param audios: wav文件路径或内存中wav文件的内容
+    :param workers: 工作进程数，默认为CPU核数，GPU上默认为1
+    :param batch_size: 每批的音频数
+    :param device: 运行的设备，None时有GPU则使用GPU
+    :param stats: 不为None时在结束后写入files、errors、audio_seconds、wall_seconds和throughput(音频秒数/耗时秒数)
+    :return: {"index": 输入中的序号, "source": 文件路径, "text": 识别结果, "duration": 音频秒数, "error": 异常}的生成器
+    """
+    device = device or default_device()
+    if workers is None:
+        workers = 1 if device.startswith("cuda") else os.cpu_count() or 1
+    items = list(enumerate(audios))
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    workers = max(1, min(workers, len(batches)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    start = time.perf_counter()
+    files, errors, audio_seconds = 0, 0, 0.0
+    # spawn的工作进程不继承父进程中已经初始化的torch和模型
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(device, threads)) as executor:
+        futures = [executor.submit(_asr_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            for result in future.result():
+                files += 1
+                errors += result["error"] is not None
+                audio_seconds += result["duration"]
+                yield result
+    if stats is not None:
+        wall_seconds = time.perf_counter() - start
+        stats.update(files=files, errors=errors, audio_seconds=audio_seconds, wall_seconds=wall_seconds,
+                     throughput=audio_seconds / wall_seconds if wall_seconds else 0)
+
+
 if __name__ == '__main__':
 
+    # 识别一个wav文件，或者批量识别一个目录下的全部wav文件
+    # 使用方式 python 音频保存文件.py ./recordings --workers 4 --batch-size 8 --output result.jsonl
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", default="/home/yuankun/project/债券关系大模型问答/output.wav")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", default=None, help="结果保存为jsonl文件")
+    parser.add_argument("--serve", action="store_true", help="启动共享的本地识别服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8890)
+    parser.add_argument("--measure-startup", action="store_true", help="对比导入时创建模型和第一个请求时创建模型的耗时")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.host, args.port)
+        sys.exit()
+    if args.measure_startup:
+        print(measure_startup())
+        sys.exit()
+
     # 记录开始时间
     start_time = time.time()
-    # 编写您的程序或函数
 
-    # 音频文件
-    audioFile = "/home/yuankun/project/债券关系大模型问答/output.wav"
-    result = asr(audioFile)
-    print(type(result))
-    print(result)
+    if os.path.isdir(args.path):
+        paths = sorted(os.path.join(args.path, name) for name in os.listdir(args.path) if name.lower().endswith(".wav"))
+        stats: dict = {}
+        output = open(args.output, "w", encoding="utf-8") if args.output else None
+        try:
+            for result in asr_batch(paths, workers=args.workers, batch_size=args.batch_size, stats=stats):
+                print(result["source"], result["error"] or result["text"])
+                if output is not None:
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        finally:
+            if output is not None:
+                output.close()
+        print(f"共{stats['files']}个文件，失败{stats['errors']}个，音频{stats['audio_seconds']:.1f}秒，"
+              f"耗时{stats['wall_seconds']:.1f}秒，吞吐量{stats['throughput']:.2f}音频秒/秒")
+    else:
+        result = asr(args.path)
+        print(type(result))
+        print(result)
 
     # 记录结束时间
     end_time = time.time()
     # 计算运行时间
     elapsed_time = end_time - start_time
     print(f"程序运行时间：{elapsed_time} 秒")
-